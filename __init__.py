@@ -4,3 +4,10 @@ import d2v.dictionary
 import d2v.ingestion
 import d2v.pairlist
 import d2v.graph
+import d2v.tokenizer
+import d2v.reader
+import d2v.model
+import d2v.trainer
+import d2v.sampler
+import d2v.gilbert
+import d2v.linalg
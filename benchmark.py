@@ -0,0 +1,238 @@
+"""
+Benchmarks for ingestion.
+
+Time each stage of `d2v.ingestion.ingest`, and measure peak resident memory,
+for every way of counting pairs, on a synthetic corpus:
+
+    python -m d2v.benchmark --num-objects 2000 --output benchmarks.jsonl
+
+Each mode runs in a fresh process so that its peak memory is measured
+independently of the others.  The pair count matrices written by every mode
+are checked to be identical to those of the first mode.  With --output, one
+JSON line holding the parameters and measurements is appended to the given
+file, so that runs against different versions can be compared.  The speed of
+each tokenizer in `d2v.tokenizer`, in tokens per second, is also reported.
+"""
+import os
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+import scipy.sparse
+import d2v
+
+
+def generate_objects(num_objects, tokens_per_object=20, num_tokens=1000,
+        refs_per_object=1, seed=0, fields_per_object=1, fan_in=1, depth=None):
+    """
+    Generate `num_objects` synthetic objects, with ids 'doc,,<index>'.
+
+    Inputs
+        - num_objects - int - the number of objects generated.
+        - tokens_per_object - int - the number of words in each text field.
+        - num_tokens - int - the size of the vocabulary words are drawn from.
+        - refs_per_object - int - the number of objects each object
+            references in its 'refs' field.
+        - seed - int - seed for the random number generator.
+        - fields_per_object - int - the number of text fields on each object,
+            named 'text', 'text1', 'text2', ...
+        - fan_in - int - the average number of references received by each
+            referenced object.  References are only made to the first
+            1 / `fan_in` of the objects available to be referenced.
+        - depth - int or None - if given, objects are split into `depth`
+            levels of equal size, and objects only reference objects in the
+            next level, so that chains of references are `depth` objects
+            long.  Otherwise objects reference any object defined later.
+
+    References never form cycles.
+    """
+    rand = random.Random(seed)
+    if depth is None:
+        level_size = num_objects
+    else:
+        level_size = max(1, -(-num_objects // depth))
+
+    objects = []
+    for index in range(num_objects):
+        obj = {'d2v-id': 'doc,,{}'.format(index)}
+        for field in range(fields_per_object):
+            name = 'text{}'.format(field) if field else 'text'
+            obj[name] = ' '.join(
+                'w{}'.format(rand.randrange(num_tokens))
+                for _ in range(tokens_per_object)
+            )
+
+        if depth is None:
+            targets = range(index + 1, num_objects)
+        else:
+            start = (index // level_size + 1) * level_size
+            targets = range(start, min(start + level_size, num_objects))
+        if fan_in > 1:
+            num_targets = -(-len(targets) * refs_per_object // fan_in)
+            targets = targets[:max(num_targets, refs_per_object)]
+        num_refs = min(refs_per_object, len(targets))
+        if num_refs > 0:
+            obj['refs'] = [
+                {'$ref': 'doc,,{}'.format(ref)}
+                for ref in rand.sample(targets, num_refs)
+            ]
+        objects.append(obj)
+    return objects
+
+
+def run_ingest(objects, path, pair_counting, results):
+    """
+    Ingest `objects`, and report the stats recorded by ingestion, along with
+    total wall time and peak memory, to `results`.
+    """
+    stats = {}
+    start = time.perf_counter()
+    d2v.ingestion.ingest(
+        objects, path, pair_counting=pair_counting, stats=stats)
+    stats['total_seconds'] = time.perf_counter() - start
+    stats['total_peak_rss'] = d2v.ingestion.peak_rss()
+    results.put(stats)
+
+
+def compare_pair_counting(objects, modes=('list', 'gram')):
+    """
+    Ingest `objects` once per pair counting mode in `modes`, each in its own
+    process.  Returns a dict mapping each mode to the stats recorded by
+    `run_ingest`, with throughput added in 'objects_per_second' and
+    'pairs_per_second'.  Raises AssertionError if any mode writes a pair count
+    matrix that differs from that of the first mode.
+    """
+    context = multiprocessing.get_context('spawn')
+    temp_dir = tempfile.mkdtemp()
+    try:
+        measurements = {}
+        for mode in modes:
+            path = os.path.join(temp_dir, mode)
+            os.makedirs(path)
+            results = context.Queue()
+            process = context.Process(
+                target=run_ingest, args=(objects, path, mode, results))
+            process.start()
+            measurements[mode] = results.get()
+            process.join()
+
+        expected = scipy.sparse.load_npz(
+            os.path.join(temp_dir, modes[0], 'pairs.npz'))
+        for mode in modes[1:]:
+            found = scipy.sparse.load_npz(
+                os.path.join(temp_dir, mode, 'pairs.npz'))
+            assert found.shape == expected.shape, mode
+            assert (found != expected).nnz == 0, mode
+    finally:
+        shutil.rmtree(temp_dir)
+
+    # Pairs are stored symmetrically; count each unordered pair once.
+    num_pairs = int(scipy.sparse.triu(expected).sum())
+    for stats in measurements.values():
+        stats['objects'] = len(objects)
+        stats['pairs'] = num_pairs
+        stats['objects_per_second'] = len(objects) / stats['total_seconds']
+        stats['pairs_per_second'] = num_pairs / stats['total_seconds']
+    return measurements
+
+
+def benchmark_tokenizers(objects, tokenizers=None):
+    """
+    Tokenize every string value in `objects` with each of `tokenizers`, a
+    dict mapping names to tokenizers (by default, those in d2v.tokenizer).
+    Returns a dict mapping each name to the number of tokens produced per
+    second.
+    """
+    if tokenizers is None:
+        tokenizers = {
+            'whitespace': d2v.tokenizer.WhitespaceTokenizer(),
+            'regex': d2v.tokenizer.RegexTokenizer(),
+            'cached-regex': d2v.tokenizer.CachedTokenizer(
+                d2v.tokenizer.RegexTokenizer()),
+        }
+    strings = [
+        value for obj in objects for field, value in obj.items()
+        if field != 'd2v-id' and isinstance(value, str)
+    ]
+    tokens_per_second = {}
+    for name, tokenizer in tokenizers.items():
+        start = time.perf_counter()
+        num_tokens = sum(len(tokenizer(string)) for string in strings)
+        tokens_per_second[name] = num_tokens / (time.perf_counter() - start)
+    return tokens_per_second
+
+
+def get_version():
+    """The git revision of the d2v source, or None if it is not available."""
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode('utf8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--num-objects', type=int, default=2000)
+    parser.add_argument('--fields-per-object', type=int, default=1)
+    parser.add_argument('--tokens-per-object', type=int, default=20)
+    parser.add_argument('--num-tokens', type=int, default=1000)
+    parser.add_argument('--refs-per-object', type=int, default=1)
+    parser.add_argument('--fan-in', type=int, default=1)
+    parser.add_argument('--depth', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--modes', nargs='+',
+        default=['list', 'stream', 'vectorized', 'external', 'gram']
+    )
+    parser.add_argument(
+        '--output', help='append results as a JSON line to this file')
+    args = parser.parse_args()
+
+    parameters = {
+        'num_objects': args.num_objects,
+        'fields_per_object': args.fields_per_object,
+        'tokens_per_object': args.tokens_per_object,
+        'num_tokens': args.num_tokens,
+        'refs_per_object': args.refs_per_object,
+        'fan_in': args.fan_in,
+        'depth': args.depth,
+        'seed': args.seed,
+    }
+    objects = generate_objects(**parameters)
+    tokens_per_second = benchmark_tokenizers(objects)
+    measurements = compare_pair_counting(objects, modes=args.modes)
+
+    for name, rate in tokens_per_second.items():
+        print('{:<12}{:>12.0f} tokens/s'.format(name, rate))
+
+    for mode, stats in measurements.items():
+        print('{:<12}{:>10.3f} s{:>10.1f} MB{:>12.0f} objects/s'.format(
+            mode, stats['total_seconds'], stats['total_peak_rss'] / 2**20,
+            stats['objects_per_second']
+        ))
+        for stage, seconds in stats['seconds'].items():
+            print('    {:<24}{:>10.3f} s{:>10.1f} MB'.format(
+                stage, seconds, stats['peak_rss'][stage] / 2**20))
+
+    if args.output is not None:
+        record = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'version': get_version(),
+            'parameters': parameters,
+            'results': measurements,
+            'tokens_per_second': tokens_per_second,
+        }
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+if __name__ == '__main__':
+    main()
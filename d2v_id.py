@@ -1,5 +1,13 @@
 import d2v
 import re
+import zlib
+import numbers
+import numpy as np
+
+# Fields holding information about an object, rather than its contents.
+# 'd2v-weight' is a number that weights the object's pairs (see
+# `get_weight`).
+METADATA_FIELDS = {'d2v-id', 'd2v-weight'}
 
 # Must have at least one character and no commas.
 VALID_TYPE = re.compile('[^,\t]+$')
@@ -29,6 +37,45 @@ VALID_PRIMITIVE_ID = re.compile('[^,\t]+,[^,\t]+,[^,\t]+$')
 VALID_NON_PRIMITIVE_ID = re.compile('[^,\t]+,,[^,\t]+$')
 
 
+# (type, field) contexts that have already been validated.
+VALID_CONTEXTS = set()
+
+
+def validate_context(obj_type, field):
+    """
+    Validate the type and field for a primitive, caching the result so that
+    each (type, field) is only checked against the regexes once.
+    """
+    try:
+        if (obj_type, field) in VALID_CONTEXTS:
+            return
+    except TypeError:
+        pass
+    validate_type(obj_type)
+    validate_field(field)
+    VALID_CONTEXTS.add((obj_type, field))
+
+
+def validate_object(obj):
+    """
+    Validate everything in `obj` that is used to make ids for it and its
+    children: the object's own d2v-id, and the type and field of each field
+    holding primitives.  Ids of referenced objects are not validated, as in
+    `join_id`.
+    """
+    obj_type, field, name = split_id(get_non_primitive_id(obj))
+    validate_type(obj_type)
+    for field, expression in obj.items():
+        if field in METADATA_FIELDS:
+            continue
+        if isinstance(expression, dict):
+            continue
+        if isinstance(expression, list) and all(
+                isinstance(element, dict) for element in expression):
+            continue
+        validate_context(obj_type, field)
+
+
 def validate_field(field):
     """Fields can be either None, or a conformant string."""
     if field is not None:
@@ -74,9 +121,11 @@ def is_primitive(d2v_id):
     return field is not None
 
 
-def join_id(obj_type, field, obj):
+def join_id(obj_type, field, obj, validate=True):
     """
     Construct the d2v_id from an obj_type, field name, and the object itself.
+    Validation of the type and field can be skipped if they are known to be
+    valid.
     """
     # Handle the case where `obj` is non-primitive, or is a 
     # reference to a non-primitive.
@@ -85,8 +134,8 @@ def join_id(obj_type, field, obj):
 
     # Otherwise the ID is formed by joining the context and string
     # representation of the object.  First validate the context.
-    validate_type(obj_type)
-    validate_field(field)
+    if validate:
+        validate_context(obj_type, field)
 
     # Serialize and join.
     if field is None:
@@ -118,34 +167,93 @@ def unordered_pair(id1, id2):
     return id2, id1
 
 
-def get_child_ids(obj):
-
+def get_weight(obj, weight_fields=None):
+    """
+    Get the weight of `obj`: the product of its 'd2v-weight', and of the
+    values of any of its fields that are among the (type, field) namespaces
+    in `weight_fields` (for example, ratings).  Objects with none of these
+    fields have weight 1.  Raises ValueError for weights that aren't numbers.
+    """
+    weight = 1
+    obj_type = None
+    for field, value in obj.items():
+        if field != 'd2v-weight':
+            if not weight_fields:
+                continue
+            if obj_type is None:
+                obj_type, _, _ = split_id(get_non_primitive_id(obj))
+            if (obj_type, field) not in weight_fields:
+                continue
+        if isinstance(value, bool) or not isinstance(value, numbers.Real):
+            raise ValueError(
+                'Weight in field "{}" is not a number: {!r}.'
+                .format(field, value)
+            )
+        weight *= value
+    return weight
+
+
+def get_child_ids(
+    obj, interner=None, validate=True, tokenizers=None, hasher=None,
+    weight_fields=None
+):
+    """
+    Get the ids of the children of `obj`.  If an `Interner` is given, the
+    ids are its integer codes, rather than strings.  The whole object is
+    validated at once (see `validate_object`), unless `validate` is False.
+    String values are split into tokens by the tokenizer that `tokenizers`
+    selects for their field (see `d2v.tokenizer.get_tokenizer`).  If a
+    `FeatureHasher` is given, primitive values in the namespaces it hashes
+    are replaced by their buckets.  Fields in the (type, field) namespaces
+    `weight_fields` hold weights (see `get_weight`), and have no children.
+    """
+    if validate:
+        validate_object(obj)
     parent_id = d2v.d2v_id.get_non_primitive_id(obj)
     obj_type, field, name = d2v.d2v_id.split_id(parent_id)
-    d2v.d2v_id.validate_type(obj_type)
     child_ids = []
     for field, expression in obj.items():
 
         # Skip d2v metadata fields.
-        if field == 'd2v-id': 
+        if field in METADATA_FIELDS:
+            continue
+        if weight_fields and (obj_type, field) in weight_fields:
             continue
 
         # All fields are handled treated as lists of values.  
-        value_list = as_list(expression)
+        value_list = as_list(
+            expression,
+            d2v.tokenizer.get_tokenizer(tokenizers, obj_type, field)
+        )
+        if hasher is not None and hasher.hashes(obj_type, field):
+            value_list = hasher.hash_values(obj_type, field, value_list)
 
         # Now get the id for each embeddable object in value_list.
-        child_ids.extend([
-            d2v.d2v_id.join_id(obj_type, field, val) for val in value_list
-        ])
+        if interner is None:
+            child_ids.extend([
+                d2v.d2v_id.join_id(obj_type, field, val, validate=False)
+                for val in value_list
+            ])
+        else:
+            child_ids.extend(interner.intern_values(
+                obj_type, field, value_list, validate=False))
 
     return child_ids
 
 
-def as_list(expression):
+def as_list(expression, tokenizer=None):
+    """
+    Get the list of values in `expression`.  Strings are split into tokens by
+    `tokenizer`, or else are lowercased and split on whitespace.
+    """
     if isinstance(expression, list):
         return [normalize(element) for element in expression]
     elif isinstance(expression, str):
-        return [normalize(token) for token in tokenize(expression)]
+        if tokenizer is not None:
+            return tokenizer(expression)
+        # Lowercasing the whole string is equivalent to normalizing each
+        # token, and faster.
+        return tokenize(expression.lower())
     else:
         return [normalize(expression)]
 
@@ -164,3 +272,191 @@ def tokenize(string):
     return string.split()
 
 
+
+
+class FeatureHasher:
+    """
+    Maps primitive values of chosen (type, field) namespaces to one of a
+    fixed number of buckets, using a stable hash (CRC-32) of the value's
+    string form, so that the number of ids in those namespaces is bounded no
+    matter how many distinct values occur.  The value in bucket `b` gets the
+    name '#b', that is, the id 'type,field,#b'.
+
+    Collisions are tracked in fixed memory: each bucket remembers a second,
+    independent hash of the first value that fell into it, and later values
+    whose second hash differs are counted as collisions (see
+    `collision_stats`).
+
+    Inputs
+     - num_buckets - int - the number of buckets per namespace.
+     - namespaces - iterable<tuple> or None - the (type, field) namespaces
+        to hash.  None means every primitive namespace.
+    """
+    FINGERPRINT_SEED = 0x9e3779b9
+
+    def __init__(self, num_buckets, namespaces=None):
+        if num_buckets < 1:
+            raise ValueError(
+                'num_buckets must be positive, got {}.'.format(num_buckets))
+        self.num_buckets = num_buckets
+        self.namespaces = None if namespaces is None else set(namespaces)
+        self.fingerprints = {}
+        self.counts = {}
+
+    def config(self):
+        """
+        Get the settings of the hasher, as a dict that can be stored as JSON
+        and given to `from_config`.
+        """
+        namespaces = self.namespaces
+        if namespaces is not None:
+            namespaces = sorted([obj_type, field]
+                for obj_type, field in namespaces)
+        return {'num_buckets': self.num_buckets, 'namespaces': namespaces}
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Make a hasher having the settings returned by `config`, which hashes
+        values into the same buckets.
+        """
+        namespaces = config['namespaces']
+        if namespaces is not None:
+            namespaces = [tuple(namespace) for namespace in namespaces]
+        return cls(config['num_buckets'], namespaces)
+
+    def hashes(self, obj_type, field):
+        """Whether values in `field` of objects of `obj_type` are hashed."""
+        return self.namespaces is None or (obj_type, field) in self.namespaces
+
+    def hash_values(self, obj_type, field, values):
+        """
+        Replace each primitive value in `values` by the name of its bucket.
+        References to other objects are left unchanged.
+        """
+        namespace = (obj_type, field)
+        if namespace not in self.fingerprints:
+            self.fingerprints[namespace] = np.full(
+                self.num_buckets, -1, dtype=np.int64)
+            self.counts[namespace] = {'values': 0, 'collisions': 0}
+        fingerprints = self.fingerprints[namespace]
+        counts = self.counts[namespace]
+
+        hashed = []
+        for value in values:
+            if isinstance(value, dict):
+                hashed.append(value)
+                continue
+            encoded = str(value).encode('utf8')
+            bucket = zlib.crc32(encoded) % self.num_buckets
+            fingerprint = zlib.crc32(encoded, self.FINGERPRINT_SEED)
+            if fingerprints[bucket] == -1:
+                fingerprints[bucket] = fingerprint
+            elif fingerprints[bucket] != fingerprint:
+                counts['collisions'] += 1
+            counts['values'] += 1
+            hashed.append('#{}'.format(bucket))
+        return hashed
+
+    def collision_stats(self):
+        """
+        Returns a dict mapping each hashed namespace to a dict of: 'values',
+        the number of values hashed; 'buckets_used', the number of buckets
+        that received a value; and 'collisions', the number of values that
+        fell into a bucket already taken by a different value.
+        """
+        return {
+            namespace: dict(
+                counts,
+                buckets_used=int(np.sum(self.fingerprints[namespace] != -1))
+            )
+            for namespace, counts in self.counts.items()
+        }
+
+
+
+class Interner:
+    """
+    Assigns compact integer codes to d2v_ids, so that ids don't need to be
+    built, split, and hashed as 'type,field,name' strings.  Each (type,
+    field) namespace gets a small integer code, and each name gets an integer
+    code within its namespace.  The code for an id packs both into one int:
+    `namespace << NAME_BITS | name`.  The string form of an id is only
+    produced on demand (see `to_string`).
+    """
+    NAME_BITS = 40
+
+    def __init__(self):
+        self.namespaces = d2v.dictionary.Dictionary()
+        self.names = []
+
+    def intern(self, obj_type, field, name):
+        """Get the code for the id having the given parts."""
+        namespace = self.namespaces.add((obj_type, field))
+        if namespace == len(self.names):
+            self.names.append(d2v.dictionary.Dictionary())
+        return namespace << self.NAME_BITS | self.names[namespace].add(name)
+
+    def intern_value(self, obj_type, field, obj):
+        """
+        Get the code for a value found in `field` of an object of type
+        `obj_type`.  Equivalent to interning `join_id(obj_type, field, obj)`.
+        """
+        if isinstance(obj, dict):
+            return self.intern_id(get_non_primitive_id(obj))
+        validate_context(obj_type, field)
+        return self.intern(obj_type, field, str(obj))
+
+    def intern_values(self, obj_type, field, values, validate=True):
+        """
+        Get the codes for a list of values found in `field` of an object of
+        type `obj_type`.  The namespace is only looked up once.
+        """
+        if all(isinstance(obj, dict) for obj in values):
+            return [self.intern_id(get_non_primitive_id(obj)) for obj in values]
+        if validate:
+            validate_context(obj_type, field)
+        namespace = self.namespaces.add((obj_type, field))
+        if namespace == len(self.names):
+            self.names.append(d2v.dictionary.Dictionary())
+        add_name = self.names[namespace].add
+        prefix = namespace << self.NAME_BITS
+        return [
+            self.intern_id(get_non_primitive_id(obj))
+            if isinstance(obj, dict) else prefix | add_name(str(obj))
+            for obj in values
+        ]
+
+    def intern_id(self, d2v_id):
+        """
+        Get the code for a d2v_id given as a string.  Raises ValueError if
+        `d2v_id` isn't a type, field, and name separated by commas.
+        """
+        try:
+            obj_type, field, name = split_id(d2v_id)
+        except (ValueError, AttributeError):
+            raise ValueError(
+                'Invalid d2v_id, expecting "type,field,name".  Got "{}" ({}).'
+                .format(d2v_id, type(d2v_id).__name__)
+            ) from None
+        return self.intern(obj_type, field, name)
+
+    def split(self, code):
+        """Get the (type, field, name) of the id having the given `code`."""
+        namespace = code >> self.NAME_BITS
+        obj_type, field = self.namespaces.keys[namespace]
+        name = self.names[namespace].keys[code & ((1 << self.NAME_BITS) - 1)]
+        return obj_type, field, name
+
+    def namespace(self, code):
+        """Get the (type, field) of the id having the given `code`."""
+        return self.namespaces.keys[code >> self.NAME_BITS]
+
+    def is_primitive(self, code):
+        obj_type, field = self.namespace(code)
+        return field is not None
+
+    def to_string(self, code):
+        """Get the d2v_id string for the given `code`."""
+        obj_type, field, name = self.split(code)
+        return ','.join((obj_type, field or '', name))
@@ -1,3 +1,15 @@
+import mmap
+import numpy as np
+from collections import defaultdict
+import d2v
+
+
+# Identifies the binary dictionary format (see `write_binary_dictionary`).
+BINARY_DICTIONARY_MAGIC = b'D2VDICT1'
+
+# Name of the id that stands in for pruned ids of a (type, field) namespace.
+UNK_NAME = '<unk>'
+
 
 def read_dictionary(path):
     """
@@ -19,16 +31,32 @@ def write_dictionary(path, dictionary):
     in order.  Each key is written on the line corresponding to its integer id.
     """
     with open(path, 'w') as dictionary_file:
-        for key in dictionary.keys:
+        for key in iter_key_strings(dictionary):
             dictionary_file.write(key + '\n')
 
 
+def iter_key_strings(dictionary):
+    """
+    Yield the keys of `dictionary` in id order, as strings, converting keys
+    that are codes of an `interner` if it has one.
+    """
+    interner = getattr(dictionary, 'interner', None)
+    if interner is None:
+        return iter(dictionary.keys)
+    return (interner.to_string(key) for key in dictionary.keys)
+
+
 class Dictionary(dict):
     """
     Assigns keys an autoincrementing id starting from zero.
+
+    Keys are usually d2v_id strings.  If an `interner` (see
+    `d2v.d2v_id.Interner`) is given, keys are instead the interner's integer
+    codes, and are converted to strings when the dictionary is written.
     """
-    def __init__(self):
+    def __init__(self, interner=None):
         self.keys = []
+        self.interner = interner
         super().__init__()
 
     def add(self, key):
@@ -43,4 +71,302 @@ class Dictionary(dict):
     def get_many(self, key_iterable):
         return [self[key] for key in key_iterable]
 
+    def namespace(self, index):
+        """Get the (type, field) of the key having id `index`."""
+        if self.interner is not None:
+            return self.interner.namespace(self.keys[index])
+        obj_type, field, name = d2v.d2v_id.split_id(self.keys[index])
+        return obj_type, field
+
+    def merge(self, other):
+        """
+        Add all keys of the Dictionary `other`, in order.  Returns a list
+        mapping each of `other`'s ids to the corresponding id in this
+        Dictionary.
+        """
+        return self.add_many(other.keys)
+
+
+def prune_dictionary(
+    dictionary, counts, min_count=None, max_vocab=None, unk=False
+):
+    """
+    Remove rare primitive ids from `dictionary`.  Non-primitive ids are
+    always kept.
+
+    Inputs
+     - dictionary - Dictionary - the dictionary to prune.
+     - counts - numpy.ndarray - the number of occurrences of each id.
+     - min_count - int, dict, or None - ids occurring fewer times than this
+        are pruned.  A dict gives the setting for each (type, field)
+        namespace; namespaces missing from it aren't pruned.
+     - max_vocab - int, dict, or None - at most this many ids, the most
+        frequent, are kept in each namespace.  Ties are broken in favour of
+        the lower id.  Given per namespace like `min_count`.
+     - unk - bool - if True, pruned ids are mapped to the id
+        'type,field,<unk>' of their namespace, rather than dropped.
+
+    Returns `(pruned_dictionary, remap)`, where `remap` is an array mapping
+    each id of `dictionary` to its id in the new Dictionary, or to -1 if it
+    was dropped.  Kept ids keep their order, so new ids form a dense range.
+    """
+    namespaces = [
+        dictionary.namespace(index) for index in range(len(dictionary))]
+    namespace_ids = defaultdict(list)
+    for index, (obj_type, field) in enumerate(namespaces):
+        if field is not None:
+            namespace_ids[obj_type, field].append(index)
+
+    keep = np.ones(len(dictionary), dtype=bool)
+    for namespace, ids in namespace_ids.items():
+        ids = np.array(ids)
+        namespace_counts = counts[ids]
+        pruned = np.zeros(len(ids), dtype=bool)
+        namespace_min_count = namespace_setting(min_count, namespace)
+        if namespace_min_count is not None:
+            pruned |= namespace_counts < namespace_min_count
+        namespace_max_vocab = namespace_setting(max_vocab, namespace)
+        if namespace_max_vocab is not None:
+            order = np.argsort(-namespace_counts, kind='stable')
+            pruned[order[namespace_max_vocab:]] = True
+        keep[ids[pruned]] = False
+
+    pruned_dictionary = Dictionary(dictionary.interner)
+    remap = np.full(len(dictionary), -1, dtype=np.int64)
+    for index, key in enumerate(dictionary.keys):
+        if keep[index]:
+            remap[index] = pruned_dictionary.add(key)
+        elif unk:
+            remap[index] = pruned_dictionary.add(
+                unk_key(dictionary, *namespaces[index]))
+    return pruned_dictionary, remap
+
+
+def namespace_layout(dictionary):
+    """
+    Permute the ids of `dictionary` so that the ids of each (type, field)
+    namespace, including the (type, None) namespace of objects, form a
+    contiguous range.  Namespaces are laid out in the order of their first
+    ids, and ids keep their order within a namespace, so a dictionary that
+    is already laid out this way is unchanged.
+
+    Returns `(laid_out_dictionary, remap)`, where `remap` is an array
+    mapping each id of `dictionary` to its id in the new Dictionary, like
+    `prune_dictionary`.  See `namespace_ranges` for the ranges.
+    """
+    namespace_ids = defaultdict(list)
+    for index in range(len(dictionary)):
+        namespace_ids[dictionary.namespace(index)].append(index)
+    order = np.array(
+        [index for ids in namespace_ids.values() for index in ids],
+        dtype=np.int64
+    )
+    remap = np.empty(len(dictionary), dtype=np.int64)
+    remap[order] = np.arange(len(order))
+
+    laid_out_dictionary = Dictionary(getattr(dictionary, 'interner', None))
+    laid_out_dictionary.add_many(dictionary.keys[index] for index in order)
+    return laid_out_dictionary, remap
+
+
+def namespace_ranges(dictionary):
+    """
+    Get the range of ids of each (type, field) namespace of a `dictionary`
+    laid out by `namespace_layout`, as a dict mapping each namespace to a
+    tuple `(start, stop)`.  Raises ValueError if the ids of a namespace
+    aren't contiguous.
+    """
+    ranges = {}
+    previous = None
+    for index in range(len(dictionary)):
+        namespace = dictionary.namespace(index)
+        if namespace != previous:
+            if namespace in ranges:
+                raise ValueError(
+                    'The ids of namespace {} are not contiguous.'
+                    .format(namespace)
+                )
+            if previous is not None:
+                ranges[previous] = (ranges[previous][0], index)
+            ranges[namespace] = (index, None)
+            previous = namespace
+    if previous is not None:
+        ranges[previous] = (ranges[previous][0], len(dictionary))
+    return ranges
+
+
+def namespace_setting(setting, namespace):
+    """
+    Get the value of a pruning `setting` (see `prune_dictionary`) for a
+    (type, field) `namespace`.
+    """
+    if isinstance(setting, dict):
+        return setting.get(namespace)
+    return setting
+
+
+def unk_key(dictionary, obj_type, field):
+    """
+    Get the key that stands in for pruned ids of the namespace (`obj_type`,
+    `field`) in `dictionary`.
+    """
+    if dictionary.interner is not None:
+        return dictionary.interner.intern(obj_type, field, UNK_NAME)
+    return ','.join((obj_type, field, UNK_NAME))
+
+
+
+
+def write_binary_dictionary(path, dictionary):
+    """
+    Writes the dictionary in a compact binary format that can be opened
+    without loading it (see `MappedDictionary`).  The file consists of:
+
+     - an 8-byte magic string, followed by the number of keys and the total
+        length of the encoded keys as 8-byte unsigned integers;
+     - an int64 array of offsets: key i occupies bytes `offsets[i]` to
+        `offsets[i+1]` of the encoded keys;
+     - an int64 array of ids, sorted by their keys, for binary search;
+     - the UTF-8 encoded keys, concatenated in id order.
+    """
+    encoded = [key.encode('utf8') for key in iter_key_strings(dictionary)]
+    offsets = np.zeros(len(encoded) + 1, dtype='<i8')
+    np.cumsum([len(key) for key in encoded], out=offsets[1:])
+    sorted_ids = np.array(
+        sorted(range(len(encoded)), key=encoded.__getitem__), dtype='<i8')
+    header = np.array([len(encoded), offsets[-1]], dtype='<u8')
+    with open(path, 'wb') as dictionary_file:
+        dictionary_file.write(BINARY_DICTIONARY_MAGIC)
+        dictionary_file.write(header.tobytes())
+        dictionary_file.write(offsets.tobytes())
+        dictionary_file.write(sorted_ids.tobytes())
+        dictionary_file.write(b''.join(encoded))
+
+
+def read_binary_dictionary(path):
+    """
+    Opens a dictionary written by `write_binary_dictionary`.
+    """
+    return MappedDictionary(path)
+
+
+class MappedDictionary:
+    """
+    Read-only dictionary backed by a memory-mapped file written by
+    `write_binary_dictionary`.  Opening it takes constant time, and keys are
+    only decoded when they are looked up, so it can be shared by many
+    processes without each holding every key as a Python object.
+
+    It supports the same lookups as `Dictionary`: `dictionary[key]` gives the
+    id of `key`, and `dictionary.keys[id]` gives the key for `id`.  Key to id
+    lookups are binary searches over the keys' sorted order.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as dictionary_file:
+            self.mmap = mmap.mmap(
+                dictionary_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mmap[:len(BINARY_DICTIONARY_MAGIC)] != BINARY_DICTIONARY_MAGIC:
+            raise ValueError('Not a binary dictionary: "{}".'.format(path))
+
+        position = len(BINARY_DICTIONARY_MAGIC)
+        num_keys, num_bytes = np.frombuffer(
+            self.mmap, dtype='<u8', count=2, offset=position)
+        position += 16
+        self.offsets = np.frombuffer(
+            self.mmap, dtype='<i8', count=num_keys+1, offset=position)
+        position += self.offsets.nbytes
+        self.sorted_ids = np.frombuffer(
+            self.mmap, dtype='<i8', count=num_keys, offset=position)
+        position += self.sorted_ids.nbytes
+        self.start = position
+        self.keys = MappedKeys(self)
+
+    def key_bytes(self, index):
+        start, stop = self.offsets[index:index+2] + self.start
+        return self.mmap[start:stop]
+
+    def find(self, key):
+        """Return the id of `key`, or -1 if it isn't in the dictionary."""
+        encoded = key.encode('utf8')
+        low, high = 0, len(self.sorted_ids)
+        while low < high:
+            middle = (low + high) // 2
+            if self.key_bytes(self.sorted_ids[middle]) < encoded:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self.sorted_ids):
+            index = int(self.sorted_ids[low])
+            if self.key_bytes(index) == encoded:
+                return index
+        return -1
+
+    def __getitem__(self, key):
+        index = self.find(key)
+        if index < 0:
+            raise KeyError(key)
+        return index
+
+    def __contains__(self, key):
+        return self.find(key) >= 0
+
+    def __len__(self):
+        return len(self.sorted_ids)
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def __eq__(self, other):
+        return (
+            len(self) == len(other)
+            and all(other.get(key) == index
+                for index, key in enumerate(self.keys))
+        )
+
+    def namespace(self, index):
+        """Get the (type, field) of the key having id `index`."""
+        obj_type, field, name = d2v.d2v_id.split_id(self.keys[index])
+        return obj_type, field
+
+    def get(self, key, default=None):
+        index = self.find(key)
+        return default if index < 0 else index
+
+    def get_many(self, key_iterable):
+        return [self[key] for key in key_iterable]
+
+    def close(self):
+        # Views into the mmap must be released before it can be closed.
+        self.offsets = self.sorted_ids = None
+        self.mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class MappedKeys:
+    """
+    The sequence of keys of a `MappedDictionary`, in id order, decoded as
+    they are accessed.
+    """
+    def __init__(self, dictionary):
+        self.dictionary = dictionary
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self.dictionary.key_bytes(index).decode('utf8')
+
+    def __len__(self):
+        return len(self.dictionary)
 
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
@@ -4,8 +4,182 @@ Given the set of entities found in the primitive and non-primitive dictionaries,
     of a given type-field.
  - provide head-tail encoding for large vocabularies
 """
+import os
 import numpy as np
 from collections import defaultdict
+import d2v
 
 
+# The arrays saved by `HeadTailEmbeddings.save`.
+ARRAYS = ('head', 'tail', 'projection', 'rows', 'is_head')
 
+
+def head_size_for_coverage(counts, coverage):
+    """
+    Get the smallest number of the most frequent ids whose `counts` add up
+    to at least the fraction `coverage` of all counts, as a `head_size` for
+    `HeadTailEmbeddings`.
+    """
+    counts = np.sort(np.asarray(counts, dtype=np.float64))[::-1]
+    cumulative = np.cumsum(counts)
+    if len(counts) == 0 or cumulative[-1] == 0:
+        return 0
+    return int(np.searchsorted(cumulative, coverage * cumulative[-1]) + 1)
+
+
+class HeadTailEmbeddings:
+    """
+    Embedding parameters for a long-tailed vocabulary, using much less
+    memory than a dense matrix of float32 vectors.  The `head_size` ids with
+    the highest `counts` (ties going to the lower id) each get a full vector
+    of `dimensions` floats.  The other, "tail", ids each get a vector of only
+    `tail_dimensions` floats, which is multiplied by a shared, learned
+    projection to give a full vector.  If `tail_buckets` is given, tail ids
+    also share vectors: each is hashed to one of `tail_buckets` vectors.
+
+    Whatever the storage, `lookup` gives full vectors of any ids, and `add`
+    applies updates to them, so that the store can stand in for a dense
+    matrix both in training and in serving.  In training, a second store can
+    hold the context vectors, so that no dense matrix is needed at all (see
+    `d2v.trainer.SGNSTrainer`).
+
+    Inputs
+     - counts - numpy.ndarray - the count of each id, like `d2v.model.Model.
+        counts`, from which the head is chosen.
+     - dimensions - int - the length of every vector given by `lookup`.
+     - head_size - int - the number of ids with full vectors.  See
+        `head_size_for_coverage`.
+     - tail_dimensions - int or None - the length of tail vectors.  By
+        default, a quarter of `dimensions`.
+     - tail_buckets - int or None - the number of vectors that tail ids are
+        hashed to.  By default, each tail id has its own vector.
+     - seed - int or None - seed for initialization.
+    """
+    def __init__(
+        self, counts, dimensions=100, head_size=None, tail_dimensions=None,
+        tail_buckets=None, seed=None
+    ):
+        counts = np.asarray(counts)
+        num_ids = len(counts)
+        if head_size is None:
+            head_size = head_size_for_coverage(counts, 0.9)
+        head_size = min(head_size, num_ids)
+        if tail_dimensions is None:
+            tail_dimensions = max(1, dimensions // 4)
+        rng = np.random.default_rng(seed)
+
+        order = np.argsort(-counts, kind='stable')
+        self.is_head = np.zeros(num_ids, dtype=bool)
+        self.is_head[order[:head_size]] = True
+        # The row of each id in `head`, or in `tail`.
+        self.rows = np.empty(
+            num_ids,
+            dtype=np.int32 if num_ids <= np.iinfo(np.int32).max else np.int64
+        )
+        self.rows[order[:head_size]] = np.arange(head_size)
+        tail_ids = np.sort(order[head_size:])
+        if tail_buckets is None:
+            self.rows[tail_ids] = np.arange(len(tail_ids))
+            num_tail_rows = len(tail_ids)
+        else:
+            self.rows[tail_ids] = hash_ids(tail_ids, tail_buckets)
+            num_tail_rows = tail_buckets
+
+        self.head = (
+            (rng.random((head_size, dimensions), dtype=np.float32) - 0.5)
+            / dimensions
+        )
+        self.tail = (
+            (rng.random((num_tail_rows, tail_dimensions), dtype=np.float32)
+                - 0.5)
+            / dimensions
+        )
+        # Scaled so that projected tail vectors start out like head vectors.
+        self.projection = (
+            rng.standard_normal((tail_dimensions, dimensions))
+            / np.sqrt(tail_dimensions)
+        ).astype(np.float32)
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def dimensions(self):
+        return self.projection.shape[1]
+
+    @property
+    def nbytes(self):
+        """The memory used by the parameters and the index of the ids."""
+        return sum(array.nbytes for array in (
+            self.head, self.tail, self.projection, self.rows, self.is_head))
+
+    @property
+    def dense_nbytes(self):
+        """The memory that a dense matrix of float32 vectors would use."""
+        return len(self) * self.dimensions * 4
+
+    def lookup(self, ids):
+        """The full vectors of `ids`, as an array of shape (len(ids), d)."""
+        ids = np.asarray(ids)
+        vectors = np.empty((len(ids), self.dimensions), dtype=np.float32)
+        is_head = self.is_head[ids]
+        rows = self.rows[ids]
+        vectors[is_head] = self.head[rows[is_head]]
+        vectors[~is_head] = self.tail[rows[~is_head]] @ self.projection
+        return vectors
+
+    def add(self, ids, updates):
+        """
+        Add `updates`, an array of shape (len(ids), d) of changes to the full
+        vectors of `ids`, such as gradient steps.  Repeated ids accumulate.
+        A head vector changes by its update.  For tail ids, the update is
+        passed back through the projection (by the chain rule), changing
+        both the tail vectors and the projection.
+        """
+        ids = np.asarray(ids)
+        updates = np.asarray(updates, dtype=np.float32)
+        is_head = self.is_head[ids]
+        rows = self.rows[ids]
+        if is_head.any():
+            d2v.trainer.scatter_add(
+                self.head, rows[is_head], updates[is_head])
+        if not is_head.all():
+            tail_rows = rows[~is_head]
+            tail_updates = updates[~is_head]
+            projection_update = self.tail[tail_rows].T @ tail_updates
+            d2v.trainer.scatter_add(
+                self.tail, tail_rows, tail_updates @ self.projection.T)
+            self.projection += projection_update
+
+    def save(self, path):
+        """
+        Write the store into the directory `path` as raw numpy arrays, so
+        that it can be memory-mapped by `load`.
+        """
+        os.makedirs(path, exist_ok=True)
+        for name in ARRAYS:
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Load a store written by `save`.  If `mmap` is True, its arrays are
+        read-only memory-mapped views, which is enough for `lookup`.
+        """
+        store = cls.__new__(cls)
+        for name in ARRAYS:
+            setattr(store, name, np.load(
+                os.path.join(path, name + '.npy'),
+                mmap_mode='r' if mmap else None
+            ))
+        return store
+
+
+def hash_ids(ids, num_buckets):
+    """
+    Hash the integer `ids` to buckets in range(num_buckets), by Fibonacci
+    hashing, which spreads consecutive ids over the buckets.
+    """
+    hashed = np.asarray(ids).astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+    return ((hashed >> np.uint64(32)) % np.uint64(num_buckets)).astype(
+        np.int64)
@@ -1,4 +1,6 @@
 import d2v
+import collections.abc
+import numpy as np
 import scipy.sparse
 
 
@@ -44,20 +46,324 @@ import scipy.sparse
 
 def graph_to_csr(graph, shape=None, dtype=int):
     """
-    Convert the `graph` into an adjacency matrix.
+    Convert the `graph` into an adjacency matrix.  `graph` is either a
+    GraphBuilder, or a dict mapping each parent index to the list of its
+    child indices.  See `GraphBuilder.to_csr` for `shape` and `dtype`.
     """
-    data, I, J = [], [], []
+    if not isinstance(graph, GraphBuilder):
+        builder = GraphBuilder()
+        for parent_index, child_indices in graph.items():
+            builder[parent_index] = child_indices
+        graph = builder
+    return graph.to_csr(shape=shape, dtype=dtype)
+
+
+class GraphBuilder(collections.abc.Mapping):
+    """
+    A graph, mapping each parent index to the list of its child indices,
+    whose child indices are stored in a single typed buffer that grows as
+    parents are added, rather than in a Python list per parent.  Storing a
+    graph takes `index_dtype`'s size in bytes per edge, plus a constant
+    amount per parent, and its adjacency matrix is built directly from the
+    buffer (see `to_csr`).
+
+    Behaves like a read-only dict for lookups, iterating over parents in the
+    order that they were first added.  Adding a parent again replaces its
+    children, as when assigning to a dict.
+    """
+    def __init__(self, index_dtype=np.int64):
+        self.children = GrowableArray(index_dtype)
+        self.offsets = GrowableArray(np.int64)
+        self.offsets.extend([0])
+        # Maps each parent to the number of its latest segment of children.
+        self.segments = {}
+        # Weights of parents whose weight isn't 1.
+        self.weights = {}
+
+    def add(self, parent_index, child_indices, weight=1):
+        """
+        Record that `parent_index` has the children `child_indices`, and the
+        given `weight` (see `d2v.d2v_id.get_weight`).
+        """
+        self.children.extend(child_indices)
+        self.segments[parent_index] = len(self.offsets) - 1
+        self.offsets.extend([len(self.children)])
+        if weight != 1:
+            self.weights[parent_index] = weight
+        else:
+            self.weights.pop(parent_index, None)
+
+    __setitem__ = add
+
+    def object_weights(self, num_rows):
+        """
+        Return an array of the weight of each of `num_rows` indices, which is
+        1 except for weighted parents.
+        """
+        weights = np.ones(num_rows)
+        for parent_index, weight in self.weights.items():
+            weights[parent_index] = weight
+        return weights
+
+    def __getitem__(self, parent_index):
+        segment = self.segments[parent_index]
+        offsets = self.offsets.array()
+        return self.children.array()[
+            offsets[segment]:offsets[segment+1]].tolist()
+
+    def __contains__(self, parent_index):
+        return parent_index in self.segments
+
+    def __iter__(self):
+        return iter(self.segments)
+
+    def __len__(self):
+        return len(self.segments)
+
+    def to_csr(self, shape=None, dtype=int):
+        """
+        Build the adjacency matrix of the graph, in which each row counts
+        the occurrences of each column among the children of that row, as a
+        scipy.sparse.csr_matrix of `dtype` (such as bool, np.int32 or float).
+        The `indptr` of the matrix is calculated from the number of children
+        of each parent, and the children are gathered straight into its
+        `indices`, without building a COO matrix first.  If `shape` is None,
+        it is the smallest that holds every parent and child,
+        as for a COO matrix.
+        """
+        parents = np.fromiter(self.segments, dtype=np.int64,
+            count=len(self.segments))
+        segments = np.fromiter(self.segments.values(), dtype=np.int64,
+            count=len(self.segments))
+        order = np.argsort(parents, kind='stable')
+        parents, segments = parents[order], segments[order]
+        segment_indptr, gathered = gather_segments(
+            self.offsets.array(), segments)
+        indices = self.children.array()[gathered]
+
+        if shape is None:
+            shape = (parents.max(initial=-1) + 1, indices.max(initial=-1) + 1)
+        lengths = np.zeros(shape[0], dtype=np.int64)
+        lengths[parents] = np.diff(segment_indptr)
+        indptr = np.concatenate(([0], np.cumsum(lengths)))
+
+        matrix = scipy.sparse.csr_matrix(
+            (np.ones(len(indices), dtype=dtype), indices, indptr),
+            shape=shape
+        )
+        # Repeated children are counted, as they are when converting COO.
+        matrix.sum_duplicates()
+        return matrix
+
+
+def remap_graph(graph, remap):
+    """
+    Make a copy of `graph` (a GraphBuilder or dict) in which every index is
+    replaced by `remap[index]`.  Children remapped to a negative index are
+    dropped.  Returns a GraphBuilder.
+    """
+    remap = np.asarray(remap)
+    weights = getattr(graph, 'weights', {})
+    remapped = GraphBuilder()
     for parent_index, child_indices in graph.items():
-        data.extend([1 for _ in range(len(child_indices))])
-        I.extend([parent_index for _ in range(len(child_indices))])
-        J.extend(child_indices)
-    return scipy.sparse.csr_matrix(
-        (data, (I, J)), shape=shape, dtype=dtype
-    )
+        child_indices = remap[np.asarray(child_indices, dtype=np.int64)]
+        remapped.add(
+            int(remap[parent_index]), child_indices[child_indices >= 0],
+            weights.get(parent_index, 1)
+        )
+    return remapped
 
 
-def get_index(the_id, prim_dict, non_prim_dict):
-    if d2v.d2v_id.is_primitive(the_id):
+def get_index(the_id, prim_dict, non_prim_dict, interner=None):
+    """
+    Get the index of `the_id`, which is an integer code of `interner`, if
+    given, and otherwise a d2v_id string.
+    """
+    if interner is not None:
+        is_primitive = interner.is_primitive(the_id)
+    else:
+        is_primitive = d2v.d2v_id.is_primitive(the_id)
+    if is_primitive:
         return prim_dict[the_id]
     return non_prim_dict[the_id] + len(prim_dict)
 
+
+
+def expand_csr(adjacency, parents):
+    """
+    Calculate the adjacency matrix of the expanded graph (see
+    `d2v.ingestion.make_pairs_and_expanded_graph`) from the adjacency matrix
+    of the graph, without building lists of descendents.
+
+    The expansion of a parent is the parent itself, plus the expansion of
+    each of its children, counted as many times as the child occurs.  Parents
+    are expanded one topological level at a time (see `topological_levels`),
+    so that the expansions of a whole level are obtained by a single sparse
+    matrix product with the already expanded rows.  Expanded rows are kept in
+    arrays that grow as levels are added, and shared by all later products,
+    so no expansion is ever copied into its parent.
+
+    Inputs
+     - adjacency - scipy.sparse matrix - number of times that each column
+        occurs as a child of each row.  If it holds floats, the expansion is
+        weighted: each child's expansion is scaled by its entry, so that
+        scaling every entry by a decay factor d weights descendents at
+        distance k by d**k.
+     - parents - iterable<int> - indices of the rows that are non-primitive
+        objects.  Children that are not parents are not expanded further.
+
+    Returns a scipy.sparse.csr_matrix in which each parent's row counts the
+    occurrences of its descendents (including itself).  Rows for non-parents
+    are empty, and the column indices within rows are not sorted.  Raises
+    ValueError if the graph contains a cycle.
+    """
+    dtype = np.float64 if adjacency.dtype.kind == 'f' else np.int64
+    adjacency = scipy.sparse.csr_matrix(adjacency, dtype=dtype)
+    adjacency.sum_duplicates()
+    num_rows = adjacency.shape[0]
+    is_parent = np.zeros(num_rows, dtype=bool)
+    is_parent[list(parents)] = True
+    levels = topological_levels(adjacency, is_parent)
+
+    # Arrange rows by level, non-parents (level -1) first.  Non-parents
+    # expand to themselves.
+    order = np.argsort(levels, kind='stable')
+    position = np.empty(num_rows, dtype=np.int64)
+    position[order] = np.arange(num_rows)
+    num_leaves = int(np.sum(~is_parent))
+    indptr = np.arange(num_rows + 1, dtype=np.int64)
+    indices = GrowableArray(np.int64)
+    indices.extend(order[:num_leaves])
+    data = GrowableArray(dtype)
+    data.extend(np.ones(num_leaves, dtype=dtype))
+
+    level_sizes = np.bincount(levels[is_parent], minlength=0)
+    start = num_leaves
+    for level_size in level_sizes:
+        stop = start + level_size
+        rows = order[start:stop]
+
+        # Children are all at lower levels, so their expansions are among
+        # the rows that were already expanded.  Gather just those rows.
+        block = adjacency[rows]
+        children, child_columns = np.unique(
+            position[block.indices], return_inverse=True)
+        block = scipy.sparse.csr_matrix(
+            (block.data, child_columns.ravel(), block.indptr),
+            shape=(len(rows), len(children))
+        )
+        child_indptr, gathered = gather_segments(indptr, children)
+        expanded = scipy.sparse.csr_matrix(
+            (data.array()[gathered], indices.array()[gathered], child_indptr),
+            shape=(len(children), num_rows)
+        )
+        selves = scipy.sparse.csr_matrix(
+            (np.ones(len(rows), dtype=dtype), rows,
+                np.arange(len(rows) + 1)),
+            shape=(len(rows), num_rows)
+        )
+        new_rows = (block @ expanded + selves).tocsr()
+
+        indptr[start+1:stop+1] = indptr[start] + new_rows.indptr[1:]
+        indices.extend(new_rows.indices)
+        data.extend(new_rows.data)
+        start = stop
+
+    # Put rows back in their original order.  Non-parents don't have a row
+    # in the expanded graph.
+    parent_rows = np.flatnonzero(is_parent)
+    parent_indptr, gathered = gather_segments(indptr, position[parent_rows])
+    lengths = np.zeros(num_rows, dtype=np.int64)
+    lengths[parent_rows] = np.diff(parent_indptr)
+    return scipy.sparse.csr_matrix(
+        (
+            data.array()[gathered], indices.array()[gathered],
+            np.concatenate(([0], np.cumsum(lengths)))
+        ),
+        shape=adjacency.shape
+    )
+
+
+def gather_segments(indptr, rows):
+    """
+    Find the positions, within the `indices` and `data` arrays of a CSR
+    matrix having the given `indptr`, of the entries for each row in `rows`.
+    Returns the `indptr` of the matrix made up of just those rows, and the
+    positions of its entries.
+    """
+    starts = indptr[rows]
+    lengths = indptr[np.asarray(rows) + 1] - starts
+    new_indptr = np.concatenate(([0], np.cumsum(lengths)))
+    positions = (
+        np.repeat(starts - new_indptr[:-1], lengths)
+        + np.arange(new_indptr[-1])
+    )
+    return new_indptr, positions
+
+
+def topological_levels(adjacency, is_parent):
+    """
+    Assign each parent a level, such that parents having no parents among
+    their children are at level 0, and every other parent is one level above
+    its highest child.  Non-parents get level -1.  Raises ValueError if the
+    parents' references form a cycle, since they can't then be assigned
+    levels.
+    """
+    # Only keep edges from parents to parents.
+    adjacency = scipy.sparse.csr_matrix(adjacency, dtype=bool)
+    adjacency = adjacency.multiply(is_parent[:,None])
+    adjacency = adjacency.multiply(is_parent[None,:]).tocsr()
+    adjacency.eliminate_zeros()
+    referrers = adjacency.T.tocsr()
+
+    levels = np.full(adjacency.shape[0], -1, dtype=np.int64)
+    remaining = np.diff(adjacency.indptr)
+    frontier = np.flatnonzero(is_parent & (remaining == 0))
+    level = 0
+    while len(frontier) > 0:
+        levels[frontier] = level
+        referring = referrers[frontier].indices
+        remaining -= np.bincount(referring, minlength=len(remaining))
+        candidates = np.unique(referring)
+        frontier = candidates[remaining[candidates] == 0]
+        level += 1
+
+    unassigned = np.flatnonzero(is_parent & (levels == -1))
+    if len(unassigned) > 0:
+        raise ValueError(
+            'Cycle of references involving {} objects, including index {}.'
+            .format(len(unassigned), unassigned[0])
+        )
+    return levels
+
+
+class GrowableArray:
+    """
+    A one-dimensional numpy array that can be efficiently extended, by
+    doubling its capacity as needed.
+    """
+    def __init__(self, dtype, capacity=1024):
+        self.buffer = np.empty(capacity, dtype=dtype)
+        self.size = 0
+
+    def extend(self, values):
+        values = np.asarray(values)
+        needed = self.size + len(values)
+        if needed > len(self.buffer):
+            capacity = max(needed, 2 * len(self.buffer))
+            buffer = np.empty(capacity, dtype=self.buffer.dtype)
+            buffer[:self.size] = self.buffer[:self.size]
+            self.buffer = buffer
+        self.buffer[self.size:needed] = values
+        self.size = needed
+
+    def __getstate__(self):
+        # Don't pickle unused capacity.
+        return {'buffer': self.array().copy(), 'size': self.size}
+
+    def array(self):
+        """Return a view of the values added so far."""
+        return self.buffer[:self.size]
+
+    def __len__(self):
+        return self.size
@@ -1,15 +1,59 @@
 import scipy
 import os
+import json
 import numpy
+import numpy as np
 from collections import Counter, defaultdict
 import itertools as it
+import functools
+import time
+import resource
+import contextlib
+import concurrent.futures
+import multiprocessing
 import numbers
 import d2v
 import scipy.sparse
+import scipy.sparse.linalg
 
 
+# The artifacts that `ingest` can write, and the stage of ingestion (see
+# `timed`) in which each is written.
+ARTIFACTS = {
+    'dictionary.txt': 'write_dictionary',
+    'graph.npz': 'save_graph',
+    'pairs.bin': 'write_pairlist',
+    'pairs.npz': 'save_pairs',
+    'expanded-graph.npz': 'save_expanded_graph',
+    'dictionary.bin': 'write_binary_dictionary',
+    'graph.csr': 'save_graph_csr',
+    'pairs.csr': 'save_pairs_csr',
+    'expanded-graph.csr': 'save_expanded_graph_csr',
+    'counts.npy': 'save_counts',
+    'parents.npz': 'save_parents',
+}
 
-def ingest(object_iterator, path):
+# The artifacts that `ingest` writes by default.  The others are formats that
+# can be memory-mapped by `d2v.model.Model`.
+DEFAULT_OUTPUTS = (
+    'dictionary.txt', 'graph.npz', 'pairs.bin', 'pairs.npz',
+    'expanded-graph.npz', 'counts.npy', 'parents.npz'
+)
+
+PAIR_COUNTING_MODES = ('list', 'stream', 'vectorized', 'external', 'gram')
+
+# Records the settings of `ingest` that `ingest_incremental` must respect (see
+# `write_settings`).
+SETTINGS = 'settings.json'
+
+
+def ingest(
+    object_iterator, path, pair_counting='list', max_memory=None,
+    block_size=None, intern_ids=False, validation='full',
+    validation_sample=1000, min_count=None, max_vocab=None, unk=False,
+    tokenizers=None, hasher=None, weight_fields=None, decay=1,
+    outputs=None, compressed=True, write_threads=2, stats=None
+):
     """
     Record the data in an internal datastructure that is fit for the purpose
     of counting interactions and measuring relationships.
@@ -30,11 +74,105 @@ def ingest(object_iterator, path):
        `graph`) and two dictionaries (mappings of string IDs in
        `graph` to integer IDs.
 
+     - pair_counting - str - how cooccurring pairs are counted.  'list'
+        builds the full list of pairs and counts it.  'stream' adds pairs
+        directly into a compact `d2v.pairlist.PairCounter`, never holding the
+        full list of pairs.  'vectorized' generates the pairs for whole
+        batches of rows of the expanded graph's adjacency matrix at once
+        using numpy, and counts them in a `d2v.pairlist.PairCounter`.
+        'external' generates pairs like 'vectorized', but counts them out of
+        core, spilling sorted runs to a temporary directory under `path`, and
+        merging them straight into 'pairs.bin' and the pair count matrix (see
+        `d2v.pairlist.ExternalPairCounter` and `write_external_pairs`).
+        'gram' skips generating pairs entirely, and calculates the pair counts
+        as a sparse matrix product of the expanded graph's adjacency matrix
+        with itself (see `gram_pairs_adjacency`).  All modes produce the same
+        results.
+
+     - max_memory - int or None - limit, in bytes, on the memory used to count
+        pairs when `pair_counting` is 'stream' or 'vectorized'.  When it is
+        'external', this only bounds the buffer of pairs held before spilling
+        to disk.
+
+     - block_size - int or None - when `pair_counting='gram'`, compute the
+        pair counts this many rows at a time.  By default, all at once.
+
+     - intern_ids - bool - if True, ids are represented during ingestion by
+        the integer codes of a `d2v.d2v_id.Interner` rather than by strings.
+        The returned dictionary's keys are then those codes, and its
+        `interner` converts them back to strings.
+
+     - validation - str - 'full' validates every object (see
+        `d2v.d2v_id.validate_object`).  'trusted' only validates the first
+        `validation_sample` objects, and trusts the rest to be valid.
+
+     - validation_sample - int - see `validation`.
+
+     - min_count, max_vocab, unk - if `min_count` or `max_vocab` is given,
+        rare primitive ids are pruned from the dictionary before pairs are
+        counted, either dropping them or, if `unk` is True, mapping them to
+        the id 'type,field,<unk>' of their namespace.  Settings can be given
+        per (type, field) namespace.  See `prune_vocabulary`.  Models whose
+        vocabulary was pruned can't be updated by `ingest_incremental`.
+
+     - tokenizers - the tokenizers used to split string values into tokens,
+        given as one tokenizer for every field, or as a dict mapping (type,
+        field) namespaces to tokenizers.  By default, strings are lowercased
+        and split on whitespace.  See `d2v.tokenizer.get_tokenizer`.  Models
+        ingested with tokenizers can't be updated by `ingest_incremental`.
+
+     - hasher - d2v.d2v_id.FeatureHasher or None - if given, primitive values
+        in the namespaces it hashes get the id of their hash bucket, rather
+        than one id per distinct value, which bounds the dictionary's size.
+        `ingest_incremental` hashes the values of updates the same way.
+
+     - weight_fields - iterable<tuple> or None - (type, field) namespaces
+        whose numeric values, like ratings, weight their objects rather than
+        being children.  Objects are also weighted by a 'd2v-weight' field
+        (see `d2v.d2v_id.get_weight`).  An object with weight w adds w, rather
+        than 1, to the count of each pair that it contains.
+
+     - decay - float - weight given to descendents at each level of nesting.
+        In an object's expanded graph row, a descendent at distance k (its
+        children being at distance 1) counts as decay**k occurrences.  Pairs
+        are then counted from these weighted occurrences: distinct
+        descendents weighted x and y form x * y pairs, and a descendent
+        whose occurrences have weights v sum(v * v) less pairs with itself
+        than sum(v) ** 2, halved (see `gram_pairs_adjacency`).  With weights
+        of 1 and no decay, these are the usual counts.
+
+        When objects are weighted, or `decay` isn't 1, pairs and expanded
+        graph are floats, and `pair_counting` must be 'gram'.
+
+     - outputs - iterable<str> or None - the artifacts to write into `path`,
+        among 'dictionary.txt', 'graph.npz', 'pairs.bin', 'pairs.npz',
+        'expanded-graph.npz', 'counts.npy' and 'parents.npz' (the default),
+        and the memory-mappable 'dictionary.bin', 'graph.csr', 'pairs.csr'
+        and 'expanded-graph.csr' (see `d2v.model.Model`).  'counts.npy'
+        holds the number of times that each id occurs as a child, counting
+        repeats within an object (see `id_counts`).  Matrices that aren't
+        needed for any output aren't calculated, so if `path` is None, only
+        the graph and dictionary are built.
+
+     - compressed - bool - whether to compress the .npz files.  Writing
+        uncompressed files is faster.
+
+     - write_threads - int - number of background threads that write the
+        artifacts while later ones are calculated (see `ArtifactWriter`).
+
+     - stats - dict or None - if given, measurements of the ingestion are
+        recorded in it: 'validation_seconds' is the time spent validating,
+        and 'validated_objects' the number of objects validated.  If the
+        vocabulary is pruned, 'pruned_ids' is the number of ids removed.  If
+        values are hashed, 'hash_collisions' holds the hasher's
+        `collision_stats`.  The time taken and peak memory after each stage
+        are recorded as described in `timed`.
+
     Returns:
     
      - (graph, dictionary)
 
-        graph - dict<list<str>> - for each object defined by the
+        graph - d2v.graph.GraphBuilder - for each object defined by the
             object iterator, it records a list of IDs corresponding to 
             its contents.  These IDs refer either to primitive objects or
             to non_primitive objcts (which must be done by reference).
@@ -45,64 +183,1085 @@ def ingest(object_iterator, path):
 
     """
 
+    if pair_counting not in PAIR_COUNTING_MODES:
+        raise ValueError(
+            'Unknown pair_counting mode: "{}".'.format(pair_counting))
+    if not decay > 0:
+        raise ValueError('decay must be positive, got {}.'.format(decay))
+    outputs = get_outputs(outputs, path)
+
     # Make sure we can write to path.
     if path is not None and not os.path.exists(path):
         os.makedirs(path)
         test_write(path)
 
-    # `graph` records the structure in each object.
-    dictionary = d2v.dictionary.Dictionary()
-    graph = {}
-
     # Assign int IDs to all values in obj_iterator; record structure as graph.
+    dictionary = None
+    if intern_ids:
+        dictionary = d2v.dictionary.Dictionary(d2v.d2v_id.Interner())
+    with timed(stats, 'assign_ids'):
+        graph, dictionary = build_graph(
+            object_iterator, dictionary, validation=validation,
+            validation_sample=validation_sample, tokenizers=tokenizers,
+            hasher=hasher, weight_fields=weight_fields, stats=stats
+        )
+
+    # Prune rare ids before they can make pairs.
+    if min_count is not None or max_vocab is not None:
+        with timed(stats, 'prune_vocabulary'):
+            num_ids = len(dictionary)
+            graph, dictionary = prune_vocabulary(
+                graph, dictionary, min_count=min_count, max_vocab=max_vocab,
+                unk=unk
+            )
+        if stats is not None:
+            stats['pruned_ids'] = num_ids - len(dictionary)
+
+    weighted = bool(graph.weights) or decay != 1
+    if weighted and pair_counting != 'gram':
+        raise ValueError(
+            "Weighted objects or decay need pair_counting='gram'.")
+
+    # If we don't need to write then we're done, return the results.
+    if not outputs:
+        return graph, dictionary
+
+    settings = {}
+    if min_count is not None or max_vocab is not None:
+        settings['pruned'] = True
+    if tokenizers is not None:
+        settings['tokenizers'] = True
+    if hasher is not None:
+        settings['hasher'] = hasher.config()
+    write_settings(path, settings)
+
+    # Artifacts are written in the background as soon as they are ready.
+    with ArtifactWriter(
+        path, outputs, compressed=compressed, weighted=weighted,
+        threads=write_threads, stats=stats
+    ) as writer:
+        writer.write('dictionary.txt', dictionary)
+        writer.write('dictionary.bin', dictionary)
+        shape = (len(dictionary), len(dictionary))
+        if writer.wants(
+            'graph.npz', 'graph.csr', 'counts.npy', 'parents.npz'
+        ):
+            with timed(stats, 'graph_to_csr'):
+                graph_adjacency = d2v.graph.graph_to_csr(
+                    graph, shape=shape, dtype=bool)
+            writer.write('graph.npz', graph_adjacency)
+            writer.write('graph.csr', graph_adjacency)
+            if writer.wants('counts.npy'):
+                writer.write('counts.npy', id_counts(
+                    d2v.graph.graph_to_csr(graph, shape=shape, dtype=int)))
+            if writer.wants('parents.npz'):
+                writer.write(
+                    'parents.npz', parents_adjacency(graph_adjacency))
+
+        # Skip counting pairs entirely if they aren't wanted.
+        if not writer.wants('pairs.bin', 'pairs.npz', 'pairs.csr'):
+            if writer.wants('expanded-graph.npz', 'expanded-graph.csr'):
+                with timed(stats, 'expand_graph'):
+                    expanded_graph_adjacency = expand_graph_adjacency(
+                        graph, shape, decay=decay)
+                    if weighted:
+                        expanded_graph_adjacency = (
+                            expanded_graph_adjacency.astype(np.float64))
+                writer.write('expanded-graph.npz', expanded_graph_adjacency)
+                writer.write('expanded-graph.csr', expanded_graph_adjacency)
+            return graph, dictionary
+
+        if weighted:
+            pairs_adjacency, expanded_graph_adjacency = count_weighted_pairs(
+                graph, shape, writer, decay=decay, block_size=block_size,
+                stats=stats
+            )
+        else:
+            pairs_adjacency, expanded_graph_adjacency = count_pairs(
+                graph, shape, pair_counting, writer, max_memory=max_memory,
+                block_size=block_size, directory=path, stats=stats
+            )
+        writer.write('pairs.bin', pairs_adjacency)
+        writer.write('pairs.npz', pairs_adjacency)
+        writer.write('pairs.csr', pairs_adjacency)
+    return graph, dictionary
+
+
+def write_settings(path, settings):
+    """
+    Write the dict `settings`, describing how the model in the directory
+    `path` was ingested, to its `SETTINGS` file as JSON, so that
+    `ingest_incremental` can respect them.  'pruned' is True if the
+    vocabulary was pruned, 'tokenizers' is True if strings were split by
+    tokenizers other than the default, and 'hasher' holds the `config` of
+    the `d2v.d2v_id.FeatureHasher` that values were hashed with.  Nothing
+    is written if there are no settings, and any earlier file is removed,
+    so that it can't describe another model.
+    """
+    settings_path = os.path.join(path, SETTINGS)
+    if not settings:
+        if os.path.exists(settings_path):
+            os.remove(settings_path)
+        return
+    with open(settings_path, 'w') as settings_file:
+        json.dump(settings, settings_file)
+
+
+def read_settings(path):
+    """
+    Read the settings written by `write_settings` for the model in the
+    directory `path`.  Returns an empty dict if there are none.
+    """
+    settings_path = os.path.join(path, SETTINGS)
+    if not os.path.exists(settings_path):
+        return {}
+    with open(settings_path) as settings_file:
+        return json.load(settings_file)
+
+
+def get_outputs(outputs, path):
+    """
+    Get the set of artifacts that `ingest` should write into `path`, given
+    the artifact names `outputs` (see `ARTIFACTS`), or None for the
+    `DEFAULT_OUTPUTS`.  Raises ValueError
+    for unknown names.
+    """
+    if path is None:
+        return set()
+    if outputs is None:
+        return set(DEFAULT_OUTPUTS)
+    outputs = set(outputs)
+    unknown = outputs - set(ARTIFACTS)
+    if unknown:
+        raise ValueError('Unknown outputs: {}.'.format(sorted(unknown)))
+    return outputs
+
+
+def count_weighted_pairs(
+    graph, shape, writer, decay=1, block_size=None, stats=None
+):
+    """
+    Like `count_pairs` using `pair_counting='gram'`, but for weighted objects
+    and decay (see `ingest`).  Returns float matrices `(pairs_adjacency,
+    expanded_graph_adjacency)`.
+    """
+    with timed(stats, 'expand_graph'):
+        expanded_graph_adjacency, squares = expand_weighted_graph(
+            graph, shape, decay=decay)
+    writer.write('expanded-graph.npz', expanded_graph_adjacency)
+    writer.write('expanded-graph.csr', expanded_graph_adjacency)
+
+    with timed(stats, 'pair_generation'):
+        pairs_adjacency = gram_pairs_adjacency(
+            expanded_graph_adjacency, block_size=block_size, squares=squares,
+            weights=graph.object_weights(shape[0])
+        )
+    return pairs_adjacency, expanded_graph_adjacency
+
+
+def expand_weighted_graph(graph, shape, decay=1):
+    """
+    Calculate the float adjacency matrix of the expanded graph, with
+    descendents weighted by `decay` (see `expand_graph_adjacency`), and the
+    matrix `squares` holding the sum of the squared weights of each
+    descendent's occurrences (see `gram_pairs_adjacency`).  Returns
+    `(expanded_graph_adjacency, squares)`.
+    """
+    expanded_graph_adjacency = expand_graph_adjacency(
+        graph, shape, decay=decay).astype(np.float64)
+    squares = expanded_graph_adjacency
+    if decay != 1:
+        squares = expand_graph_adjacency(graph, shape, decay=decay**2)
+    return expanded_graph_adjacency, squares
+
+
+def count_pairs(
+    graph, shape, pair_counting, writer, max_memory=None, block_size=None,
+    directory=None, stats=None
+):
+    """
+    Count the cooccurring pairs in `graph`, and calculate the adjacency
+    matrix of the expanded graph, as described in `ingest`.  The expanded
+    graph is given to the ArtifactWriter `writer` as soon as it is ready, so
+    that it can be written while pairs are counted.  Returns
+    `(pairs_adjacency, expanded_graph_adjacency)`.
+    """
+    # Count pairs and create an expanded graph.
+    if pair_counting == 'list':
+        with timed(stats, 'pair_generation'):
+            pairs, expanded_graph = make_pairs_and_expanded_graph(graph)
+        with timed(stats, 'pairlist_to_coo'):
+            pairs_adjacency = d2v.pairlist.pairlist_to_coo(
+                Counter(pairs), shape=shape, symmetric=True
+            )
+    elif pair_counting == 'stream':
+        counter = d2v.pairlist.PairCounter(shape, max_memory=max_memory)
+        with timed(stats, 'pair_generation'):
+            expanded_graph = count_pairs_and_expand_graph(graph, counter)
+        with timed(stats, 'pairlist_to_coo'):
+            pairs_adjacency = counter.to_coo(symmetric=True)
+    else:
+        expanded_graph = None
+
+    # Convert expanded graph to CSR sparse matrix
+    if expanded_graph is None:
+        with timed(stats, 'expand_graph'):
+            expanded_graph_adjacency = expand_graph_adjacency(graph, shape)
+    else:
+        with timed(stats, 'expanded_graph_to_csr'):
+            expanded_graph_adjacency = d2v.graph.graph_to_csr(
+                expanded_graph, shape=shape, dtype=int)
+    writer.write('expanded-graph.npz', expanded_graph_adjacency)
+    writer.write('expanded-graph.csr', expanded_graph_adjacency)
+
+    if pair_counting in ('vectorized', 'external'):
+        if pair_counting == 'external':
+            counter = d2v.pairlist.ExternalPairCounter(
+                shape, directory=directory, max_memory=max_memory)
+        else:
+            counter = d2v.pairlist.PairCounter(shape, max_memory=max_memory)
+        with counter:
+            with timed(stats, 'pair_generation'):
+                count_pairs_vectorized(expanded_graph_adjacency, counter)
+            if pair_counting == 'external':
+                pairs_adjacency = write_external_pairs(
+                    counter, writer, stats=stats)
+            else:
+                with timed(stats, 'pairlist_to_coo'):
+                    pairs_adjacency = counter.to_coo(symmetric=True)
+    elif pair_counting == 'gram':
+        with timed(stats, 'pair_generation'):
+            pairs_adjacency = gram_pairs_adjacency(
+                expanded_graph_adjacency, block_size=block_size)
+
+    return pairs_adjacency, expanded_graph_adjacency
+
+
+def write_external_pairs(counter, writer, stats=None):
+    """
+    Stream the pairs merged by the `d2v.pairlist.ExternalPairCounter`
+    `counter` straight into 'pairs.bin', and into the symmetric pair count
+    matrix, without gathering the distinct pairs in memory first.  The
+    pairlist is written right away, since the counter's runs are removed once
+    it is closed.  Returns the matrix, as a float64 scipy.sparse.coo_matrix
+    like those of the other pair counting modes (see
+    `d2v.pairlist.arrays_to_coo`), or None if the ArtifactWriter `writer`
+    doesn't want it.
+    """
+    if writer.wants('pairs.bin'):
+        with timed(stats, ARTIFACTS['pairs.bin']):
+            counter.write_binary(
+                os.path.join(writer.path, 'pairs.bin'),
+                index_dtype=pair_index_dtype(counter.shape[0])
+            )
+        writer.mark_written('pairs.bin')
+    if not writer.wants('pairs.npz', 'pairs.csr'):
+        return None
+    with timed(stats, 'pairlist_to_coo'):
+        return counter.to_symmetric_csr(dtype=np.float64).tocoo()
+
+
+def timed(stats, stage):
+    """
+    Context manager that records, in `stats`, the time taken by a `stage` of
+    ingestion in stats['seconds'][stage], and the peak resident memory of the
+    process so far, in bytes, in stats['peak_rss'][stage].  Does nothing if
+    `stats` is None.
+    """
+    if stats is None:
+        return contextlib.nullcontext()
+    return _timed(stats, stage)
+
+
+@contextlib.contextmanager
+def _timed(stats, stage):
+    start = time.perf_counter()
+    yield
+    stats.setdefault('seconds', {})[stage] = time.perf_counter() - start
+    stats.setdefault('peak_rss', {})[stage] = peak_rss()
+
+
+def peak_rss():
+    """Peak resident memory of this process so far, in bytes."""
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def build_graph(
+    object_iterator, dictionary=None, validation='full',
+    validation_sample=1000, tokenizers=None, hasher=None, weight_fields=None,
+    stats=None
+):
+    """
+    Assign int IDs to all values in the objects yielded by `object_iterator`,
+    and record the structure of the objects as a graph.  Returns `(graph,
+    dictionary)`, as described in `ingest`.  If `dictionary` is given, IDs
+    are added to it, rather than to a new Dictionary.  See `ingest` for
+    `validation`, `validation_sample`, `tokenizers`, `hasher`,
+    `weight_fields`, and `stats`.
+    """
+    if validation not in ('full', 'trusted'):
+        raise ValueError('Unknown validation mode: "{}".'.format(validation))
+
+    # `graph` records the structure in each object.
+    if dictionary is None:
+        dictionary = d2v.dictionary.Dictionary()
+    interner = dictionary.interner
+    graph = d2v.graph.GraphBuilder()
+    validation_seconds = 0
+    validated_objects = 0
     for obj in object_iterator:
-        obj_id = dictionary.add(d2v.d2v_id.get_non_primitive_id(obj))
-        child_ids = dictionary.add_many(d2v.d2v_id.get_child_ids(obj))
-        graph[obj_id] = child_ids
 
-    # Convert graph to CSR sparse matrix
-    shape = (len(dictionary), len(dictionary))
-    graph_adjacency = d2v.graph.graph_to_csr(graph, shape=shape, dtype=bool)
+        # Validate each object as a whole, rather than value by value.
+        if validation == 'full' or validated_objects < validation_sample:
+            start = time.perf_counter()
+            d2v.d2v_id.validate_object(obj)
+            validation_seconds += time.perf_counter() - start
+            validated_objects += 1
+
+        obj_id = d2v.d2v_id.get_non_primitive_id(obj)
+        if interner is not None:
+            obj_id = interner.intern_id(obj_id)
+        obj_id = dictionary.add(obj_id)
+        child_ids = dictionary.add_many(
+            d2v.d2v_id.get_child_ids(
+                obj, interner, validate=False, tokenizers=tokenizers,
+                hasher=hasher, weight_fields=weight_fields
+            ))
+        graph.add(
+            obj_id, child_ids, d2v.d2v_id.get_weight(obj, weight_fields))
+
+    if stats is not None:
+        stats['validation_seconds'] = validation_seconds
+        stats['validated_objects'] = validated_objects
+        if hasher is not None:
+            stats['hash_collisions'] = hasher.collision_stats()
+    return graph, dictionary
+
+
+def id_counts(graph_adjacency):
+    """
+    Count the occurrences of each id as a child, from the integer adjacency
+    matrix of the graph (see `d2v.graph.graph_to_csr`), as written to
+    'counts.npy'.  An id that occurs several times in one object, like a
+    repeated token or reference, counts each time.  The stored 'graph.npz'
+    only records whether a child occurs, so its multiplicities are
+    recovered from the expanded graph where needed (see
+    `recover_graph_rows`).  See `d2v.sampler.NegativeSampler`.
+    """
+    return np.asarray(
+        graph_adjacency.sum(axis=0, dtype=np.int64)).ravel()
+
 
-    # Create a pairlist and an expanded graph; 
-    pairs, expanded_graph = make_pairs_and_expanded_graph(graph)
+def recover_graph_rows(rows, graph_adjacency, expanded_graph_adjacency):
+    """
+    Recover the rows of the integer adjacency matrix of the graph for the
+    objects `rows`, counting how many times each child occurs directly in
+    each, from the boolean `graph_adjacency`, which only records which
+    children occur, and the expanded graph (see `recover_multiplicities`).
+    Returns a CSR matrix whose rows correspond to `rows`.  Raises ValueError
+    if the expanded graph is weighted (see `ingest`), since multiplicities
+    can't be recovered from weighted occurrences.
+    """
+    if expanded_graph_adjacency.dtype.kind == 'f':
+        raise ValueError(
+            'Multiplicities cannot be recovered from a weighted expanded '
+            'graph.'
+        )
+    recovered = scipy.sparse.csr_matrix(
+        graph_adjacency[np.asarray(rows, dtype=np.int64)], dtype=np.int64)
+    for k, index in enumerate(rows):
+        start, stop = recovered.indptr[k:k+2]
+        recovered.data[start:stop] = recover_multiplicities(
+            index, recovered.indices[start:stop].astype(np.int64),
+            expanded_graph_adjacency
+        )
+    return recovered
 
-    # Convert both to CSR sparse matrix
-    expanded_graph_adjacency = d2v.graph.graph_to_csr(
-        expanded_graph, shape=shape, dtype=int)
-    pairs_adjacency = d2v.pairlist.pairlist_to_coo(
-        Counter(pairs), shape=shape, symmetric=True
+
+def parents_adjacency(graph_adjacency):
+    """
+    Transpose the graph's adjacency matrix, as written to 'parents.npz', so
+    that row c lists the objects having c as a child.  `ingest_incremental`
+    uses it to find the ancestors of updated objects.
+    """
+    return graph_adjacency.T.tocsr()
+
+
+def prune_vocabulary(
+    graph, dictionary, min_count=None, max_vocab=None, unk=False
+):
+    """
+    Count the occurrences of each id as a child in `graph`, and prune rare
+    primitive ids from `dictionary` (see `d2v.dictionary.prune_dictionary`
+    for the settings).  Returns `(graph, dictionary)` with ids remapped to
+    the pruned dictionary's dense range; dropped ids are removed from the
+    graph.
+    """
+    shape = (len(dictionary), len(dictionary))
+    counts = np.asarray(
+        d2v.graph.graph_to_csr(graph, shape=shape, dtype=np.int64)
+        .sum(axis=0)
+    ).ravel()
+    dictionary, remap = d2v.dictionary.prune_dictionary(
+        dictionary, counts, min_count=min_count, max_vocab=max_vocab,
+        unk=unk
     )
+    return d2v.graph.remap_graph(graph, remap), dictionary
+
+
+def ingest_parallel(
+    object_iterator, path, processes=None, shard_size=10000,
+    weight_fields=None, decay=1
+):
+    """
+    Like `ingest` using `pair_counting='vectorized'`, but spreads the work
+    over a pool of `processes` worker processes (by default, one per CPU).
+    The results are the same as those of `ingest` given the same objects in
+    the same order.  See `ingest` for `weight_fields` and `decay`.
+
+    The work is done in two phases.  First, `object_iterator` is split into
+    shards of `shard_size` objects, and each worker builds a local Dictionary
+    and graph for a shard (see `build_graph`).  The local dictionaries are
+    merged in shard order, which assigns every key the same id as `ingest`
+    would, and the local graphs are remapped to those ids.  Because an object
+    can reference objects defined in other shards, pairs can only be counted
+    once the graphs are merged.  So, in the second phase, the rows of the
+    expanded graph are split among the workers, each of which counts the
+    pairs in its rows, and the counts are summed.  Weighted counts (with
+    weighted objects or decay) aren't integers, so can't be split into
+    blocks of pairs, and are calculated after merging as in `ingest` using
+    `pair_counting='gram'`.
+    """
+    if not decay > 0:
+        raise ValueError('decay must be positive, got {}.'.format(decay))
+
+    # Make sure we can write to path.
+    if path is not None and not os.path.exists(path):
+        os.makedirs(path)
+        test_write(path)
+
+    if processes is None:
+        processes = os.cpu_count()
+    object_iterator = iter(object_iterator)
+    shards = iter(lambda: list(it.islice(object_iterator, shard_size)), [])
+    with multiprocessing.Pool(processes) as pool:
+
+        # Build local graphs, and remap them into the global id space.
+        dictionary = d2v.dictionary.Dictionary()
+        graph = d2v.graph.GraphBuilder()
+        for local_graph, local_dictionary in pool.imap(
+            functools.partial(build_graph, weight_fields=weight_fields),
+            shards
+        ):
+            remap = np.array(dictionary.merge(local_dictionary), dtype=int)
+            for local_obj_id, local_child_ids in local_graph.items():
+                graph.add(
+                    int(remap[local_obj_id]), remap[local_child_ids],
+                    local_graph.weights.get(local_obj_id, 1)
+                )
+
+        shape = (len(dictionary), len(dictionary))
+        graph_adjacency = d2v.graph.graph_to_csr(
+            graph, shape=shape, dtype=bool)
+
+        if graph.weights or decay != 1:
+            expanded_graph_adjacency, squares = expand_weighted_graph(
+                graph, shape, decay=decay)
+            pairs_adjacency = gram_pairs_adjacency(
+                expanded_graph_adjacency, squares=squares,
+                weights=graph.object_weights(shape[0])
+            )
+        else:
+            # Count pairs for blocks of rows in parallel, then sum the counts.
+            expanded_graph_adjacency = expand_graph_adjacency(graph, shape)
+            block_size = -(-shape[0] // processes) or 1
+            blocks = [
+                expanded_graph_adjacency[start:start+block_size]
+                for start in range(0, shape[0], block_size)
+            ]
+            counter = d2v.pairlist.PairCounter(shape)
+            for counts, I, J in pool.imap(count_block_pairs, blocks):
+                counter.add(I, J, counts)
+            pairs_adjacency = counter.to_coo(symmetric=True)
 
-    # If we don't need to write then we're done, return the results.
     if path is None:
         return graph, dictionary
 
-    # Save dictionary.
-    d2v.dictionary.write_dictionary(
-        os.path.join(path, 'dictionary.txt'),
-        dictionary
+    write_settings(path, {})
+    counts = id_counts(d2v.graph.graph_to_csr(graph, shape=shape, dtype=int))
+    write_ingested(
+        path, dictionary, graph_adjacency, pairs_adjacency,
+        expanded_graph_adjacency, counts
     )
+    return graph, dictionary
 
-    # Save graph as adjacency matrix
-    scipy.sparse.save_npz(os.path.join(path, 'graph.npz'), graph_adjacency)
 
-    # Save pairlist as edgelist and adjacency matrix.
-    d2v.pairlist.write_pairlist(os.path.join(path, 'pairs.tsv'), pairs)
-    scipy.sparse.save_npz(
-        os.path.join(path, 'pairs.npz'),
-        pairs_adjacency
-    )
+def count_block_pairs(expanded_graph_block):
+    """
+    Count the pairs in a block of rows of the expanded graph's adjacency
+    matrix.  Returns the arrays (counts, I, J) of distinct pairs.
+    """
+    shape = (expanded_graph_block.shape[1], expanded_graph_block.shape[1])
+    counter = d2v.pairlist.PairCounter(shape)
+    count_pairs_vectorized(expanded_graph_block, counter)
+    return counter.arrays()
+
+
+def ingest_incremental(object_iterator, path):
+    """
+    Add the objects yielded by `object_iterator` to the model previously
+    written into `path` by `ingest`, updating all of its artifacts as if
+    every object had been ingested together.  An object whose d2v-id was
+    already ingested replaces the earlier version: its old contribution to
+    the pair counts is subtracted, and the new one is added.
 
-    # Save expanded graph
-    scipy.sparse.save_npz(
-        os.path.join(path, 'expanded-graph.npz'),
-        expanded_graph_adjacency
+    Only the rows affected by the new objects are recalculated.  These are
+    the new objects, plus every object that contains one of them as a
+    descendent, which are found by following the stored parents of each
+    object (see `parents_adjacency`).  The change to the pair counts is
+    calculated from the entries of the affected rows that changed (see
+    `count_rows_pairs_delta`), and the affected rows of the stored matrices
+    are spliced in place of the old ones (see `replace_rows`).  So the
+    calculations cost about as much as the affected data, rather than the
+    whole corpus, although every artifact is still read and rewritten.
+    Memory-mappable artifacts already in `path` are rewritten too (see
+    `write_ingested`).  If the model's values were hashed (see `ingest`),
+    those of the new objects are hashed into the same buckets.
+
+    Returns `(graph, dictionary)`, where `graph` only contains the objects
+    just ingested (see `ingest`).  If there are none, the model is left
+    untouched.  Raises ValueError if the model or the new
+    objects are weighted (see `ingest`), since weighted counts can't be
+    updated this way.  Also raises ValueError if the model's vocabulary was
+    pruned, since which ids are pruned depends on the counts of the whole
+    corpus, or if it was ingested with custom tokenizers, which can't be
+    stored with the model to tokenize the new objects the same way.
+    """
+    settings = read_settings(path)
+    if settings.get('pruned'):
+        raise ValueError(
+            'Models whose vocabulary was pruned cannot be updated '
+            'incrementally.'
+        )
+    if settings.get('tokenizers'):
+        raise ValueError(
+            'Models ingested with custom tokenizers cannot be updated '
+            'incrementally.'
+        )
+
+    dictionary = d2v.dictionary.read_dictionary(
+        os.path.join(path, 'dictionary.txt'))
+    graph_adjacency = scipy.sparse.load_npz(
+        os.path.join(path, 'graph.npz')).tocsr()
+    expanded_graph_adjacency = scipy.sparse.load_npz(
+        os.path.join(path, 'expanded-graph.npz')).tocsr()
+    pairs_adjacency = scipy.sparse.load_npz(
+        os.path.join(path, 'pairs.npz')).tocsr()
+    # Models written without their parents get them from the graph.
+    parents_path = os.path.join(path, 'parents.npz')
+    if os.path.exists(parents_path):
+        parents = scipy.sparse.load_npz(parents_path).tocsr()
+    else:
+        parents = parents_adjacency(graph_adjacency)
+
+    # Weighted counts can't be updated, since the object weights and decay
+    # they were calculated with aren't stored.
+    if expanded_graph_adjacency.dtype.kind == 'f':
+        raise ValueError(
+            'Models ingested with weights or decay cannot be updated '
+            'incrementally.'
+        )
+
+    # Every object ingested so far has a row in the expanded graph, holding
+    # at least itself.
+    was_parent = np.diff(expanded_graph_adjacency.indptr) > 0
+
+    hasher = None
+    if 'hasher' in settings:
+        hasher = d2v.d2v_id.FeatureHasher.from_config(settings['hasher'])
+    graph, dictionary = build_graph(object_iterator, dictionary, hasher=hasher)
+    if graph.weights:
+        raise ValueError('Weighted objects cannot be ingested incrementally.')
+
+    # With no new objects, no rows are affected, and nothing changes.
+    if not graph:
+        return graph, dictionary
+    shape = (len(dictionary), len(dictionary))
+    for matrix in (
+        graph_adjacency, expanded_graph_adjacency, pairs_adjacency, parents
+    ):
+        matrix.resize(shape)
+    was_parent = np.r_[was_parent, np.zeros(shape[0] - len(was_parent), bool)]
+
+    # Find the objects affected by the update.
+    updated = np.array(sorted(graph), dtype=np.int64)
+    affected = find_ancestors(parents, updated)
+    is_parent = was_parent.copy()
+    is_parent[updated] = True
+
+    new_rows = expand_affected_rows(
+        graph, graph_adjacency, expanded_graph_adjacency, updated, affected,
+        was_parent, is_parent
     )
 
+    # Replace the contributions of the affected rows to the pair counts.
+    old_rows = expanded_graph_adjacency[affected]
+    pairs_adjacency = (
+        pairs_adjacency + count_rows_pairs_delta(old_rows, new_rows, shape)
+    ).tocsr()
+    pairs_adjacency.eliminate_zeros()
+    pairs_adjacency = pairs_adjacency.tocoo()
+
+    # Replace the occurrences of the updated objects' children in the id
+    # counts.  Their old multiplicities are recovered from the old expanded
+    # graph.  Models written without counts get them from every object.
+    counts_path = os.path.join(path, 'counts.npy')
+    if os.path.exists(counts_path):
+        counts = np.load(counts_path)
+        counts = np.r_[counts, np.zeros(shape[0] - len(counts), np.int64)]
+    else:
+        counts = id_counts(recover_graph_rows(
+            np.flatnonzero(was_parent), graph_adjacency,
+            expanded_graph_adjacency
+        ))
+    new_graph_rows = d2v.graph.graph_to_csr(
+        graph, shape=shape, dtype=int)[updated]
+    counts += id_counts(new_graph_rows) - id_counts(recover_graph_rows(
+        updated, graph_adjacency, expanded_graph_adjacency))
+
+    # Replace the affected rows of the graph, its parents, and the expanded
+    # graph.
+    old_graph_rows = graph_adjacency[updated]
+    new_graph_rows = new_graph_rows.astype(bool)
+    parents = update_parents(parents, updated, old_graph_rows, new_graph_rows)
+    graph_adjacency = replace_rows(graph_adjacency, updated, new_graph_rows)
+    expanded_graph_adjacency = replace_rows(
+        expanded_graph_adjacency, affected, new_rows)
+
+    write_ingested(
+        path, dictionary, graph_adjacency, pairs_adjacency,
+        expanded_graph_adjacency, counts, parents=parents
+    )
     return graph, dictionary
 
 
+def find_ancestors(parents, indices):
+    """
+    Find the objects in `indices`, plus all of their ancestors, by following
+    the adjacency matrix of `parents` (see `parents_adjacency`) one
+    generation at a time.  Returns them as a sorted array.
+    """
+    found = np.zeros(parents.shape[0], dtype=bool)
+    frontier = np.unique(indices)
+    while len(frontier) > 0:
+        found[frontier] = True
+        _, positions = d2v.graph.gather_segments(parents.indptr, frontier)
+        frontier = np.unique(parents.indices[positions])
+        frontier = frontier[~found[frontier]]
+    return np.flatnonzero(found)
+
+
+def update_parents(parents, updated, old_graph_rows, new_graph_rows):
+    """
+    Update the adjacency matrix of `parents` (see `parents_adjacency`) for
+    the `updated` objects, whose rows in the graph's adjacency matrix change
+    from `old_graph_rows` to `new_graph_rows`.  Only the rows of children
+    that were added or removed are replaced.
+    """
+    change = (
+        new_graph_rows.astype(np.int8) - old_graph_rows.astype(np.int8)
+    ).tocoo()
+    change = scipy.sparse.csr_matrix(
+        (change.data, (change.col, updated[change.row])), shape=parents.shape)
+    children = np.flatnonzero(np.diff(change.indptr))
+    new_rows = (parents[children].astype(np.int8) + change[children]).tocsr()
+    new_rows.eliminate_zeros()
+    return replace_rows(parents, children, new_rows.astype(bool))
+
+
+def expand_affected_rows(
+    graph, graph_adjacency, expanded_graph_adjacency, updated, affected,
+    was_parent, is_parent
+):
+    """
+    Recalculate the rows of the expanded graph for the `affected` objects,
+    during `ingest_incremental`.  Returns them as a CSR matrix whose rows
+    correspond to `affected`.
+
+    The `updated` objects (those in `graph`) are expanded from their new
+    children.  The other affected objects are unchanged themselves, but
+    contain updated objects as descendents.  Their original children aren't
+    available, so their expansions are adjusted instead: the expansion of
+    each direct child that changed is replaced, as many times as the child
+    occurs.  Those multiplicities are recovered from the old expanded graph
+    (see `recover_multiplicities`).
+    """
+    num_rows = graph_adjacency.shape[0]
+    is_affected = np.zeros(num_rows, dtype=bool)
+    is_affected[affected] = True
+    is_updated = np.zeros(num_rows, dtype=bool)
+    is_updated[updated] = True
+
+    # Affected rows depend on those of their affected children, so they are
+    # calculated in topological order.  Only references among the affected
+    # objects matter for that order.
+    adjacency = d2v.graph.graph_to_csr(
+        graph, shape=graph_adjacency.shape, dtype=int)
+    is_unchanged = ~is_updated[affected]
+    structure = (
+        scipy.sparse.csr_matrix(
+            graph_adjacency[affected].multiply(is_unchanged[:,None]),
+            dtype=bool
+        )
+        + adjacency[affected].astype(bool)
+    )[:, affected]
+    levels = d2v.graph.topological_levels(
+        structure, np.ones(len(affected), dtype=bool))
+    order = affected[np.argsort(levels, kind='stable')]
+
+    def old_row(index):
+        if not was_parent[index]:
+            return np.array([index]), np.array([1])
+        start, stop = expanded_graph_adjacency.indptr[index:index+2]
+        return (
+            expanded_graph_adjacency.indices[start:stop],
+            expanded_graph_adjacency.data[start:stop]
+        )
+
+    rows = {}
+    def current_row(index):
+        if index in rows:
+            return rows[index]
+        return old_row(index)
+
+    for index in order:
+        if is_updated[index]:
+            start, stop = adjacency.indptr[index:index+2]
+            children = adjacency.indices[start:stop]
+            multiplicities = adjacency.data[start:stop]
+            parts = [(np.array([index]), np.array([1]))]
+            for child, multiplicity in zip(children, multiplicities):
+                if is_parent[child]:
+                    indices, data = current_row(child)
+                    parts.append((indices, multiplicity * data))
+                else:
+                    parts.append((np.array([child]), np.array([multiplicity])))
+        else:
+            start, stop = graph_adjacency.indptr[index:index+2]
+            children = graph_adjacency.indices[start:stop]
+            children = children[is_affected[children]]
+            multiplicities = recover_multiplicities(
+                index, children, expanded_graph_adjacency)
+            parts = [old_row(index)]
+            for child, multiplicity in zip(children, multiplicities):
+                indices, data = rows[child]
+                parts.append((indices, multiplicity * data))
+                indices, data = old_row(child)
+                parts.append((indices, -multiplicity * data))
+        rows[index] = sum_sparse_rows(parts)
+
+    lengths = [len(rows[index][0]) for index in affected]
+    return scipy.sparse.csr_matrix(
+        (
+            np.concatenate([rows[index][1] for index in affected]),
+            np.concatenate([rows[index][0] for index in affected]),
+            np.concatenate(([0], np.cumsum(lengths)))
+        ),
+        shape=(len(affected), num_rows)
+    )
+
+
+def recover_multiplicities(index, children, expanded_graph_adjacency):
+    """
+    Find the number of times that each of the non-primitive `children` occurs
+    directly in the object `index`, using the old expanded graph, E.  For
+    each child c, E[index, c] counts the occurrences of c in the expansion
+    of each child (including c itself), weighted by that child's
+    multiplicity.  Only children that contain c contribute, and those are
+    affected whenever c is, so `children` need only hold the affected ones.
+
+    An object's expansion has more distinct entries than that of any object
+    it contains, so ordering the children by the size of their expansions,
+    largest first, makes the system of equations triangular, and it is
+    solved as a sparse triangular system.
+    """
+    if len(children) == 0:
+        return np.array([], dtype=np.int64)
+    indptr = expanded_graph_adjacency.indptr
+    order = np.argsort(-(indptr[children + 1] - indptr[children]),
+        kind='stable')
+    children = children[order]
+    expansions = expanded_graph_adjacency[children][:, children]
+    # Children that weren't ingested before only expand to themselves.
+    system = (
+        scipy.sparse.triu(expansions, k=1)
+        + scipy.sparse.identity(len(children))
+    ).T.tocsr()
+    counts = expanded_graph_adjacency[index, children].toarray().ravel()
+    solution = scipy.sparse.linalg.spsolve_triangular(
+        system, counts.astype(np.float64), lower=True, unit_diagonal=True)
+    multiplicities = np.empty(len(children), dtype=np.int64)
+    multiplicities[order] = np.rint(solution)
+    return multiplicities
+
+
+def sum_sparse_rows(parts):
+    """
+    Add up the sparse rows in `parts`, each given as a pair of arrays
+    (indices, data).  Zeros are dropped.
+    """
+    indices = np.concatenate([indices for indices, _ in parts])
+    data = np.concatenate([data for _, data in parts])
+    indices, inverse = np.unique(indices, return_inverse=True)
+    data = np.bincount(inverse.ravel(), weights=data).astype(np.int64)
+    nonzero = data != 0
+    return indices[nonzero], data[nonzero]
+
+
+def count_rows_pairs_delta(old_rows, new_rows, shape):
+    """
+    Calculate the change to the symmetric pair count matrix having the given
+    `shape` when the `old_rows` of an expanded graph's adjacency matrix are
+    replaced by `new_rows`, both being CSR matrices with one row per row
+    replaced.  Returns a scipy.sparse.csr_matrix.
+
+    A row r forms r_i * r_j pairs of different children i and j, and
+    r_i * (r_i - 1) / 2 pairs of i with itself.  Writing the new row as
+    r + d, the pairs of different children change by the cross terms of
+    r d^T + d (r + d)^T, so only the entries that changed, d, are multiplied
+    with the row, rather than the whole row with itself.  Pairs of i with
+    itself change by d_i * (2 * r_i + d_i - 1) / 2.
+    """
+    old_rows = old_rows.sorted_indices()
+    new_rows = new_rows.sorted_indices()
+    changes = (new_rows - old_rows).tocsr()
+    changes.eliminate_zeros()
+    changes.sort_indices()
+
+    I, J, counts = [], [], []
+    for row in range(changes.shape[0]):
+        start, stop = changes.indptr[row:row+2]
+        if start == stop:
+            continue
+        changed, change = changes.indices[start:stop], changes.data[start:stop]
+        start, stop = old_rows.indptr[row:row+2]
+        old_indices, old_data = (
+            old_rows.indices[start:stop], old_rows.data[start:stop])
+        start, stop = new_rows.indptr[row:row+2]
+        new_indices, new_data = (
+            new_rows.indices[start:stop], new_rows.data[start:stop])
+
+        # d (r + d)^T and r d^T.
+        I.extend([
+            np.repeat(changed, len(new_indices)),
+            np.repeat(old_indices, len(changed))
+        ])
+        J.extend([
+            np.tile(new_indices, len(changed)),
+            np.tile(changed, len(old_indices))
+        ])
+        counts.extend([
+            np.outer(change, new_data).ravel(),
+            np.outer(old_data, change).ravel()
+        ])
+
+        # Correct the diagonal, which the cross terms gave as 2 r_i d_i +
+        # d_i^2.
+        old = np.zeros(len(changed), dtype=np.int64)
+        found = np.isin(changed, old_indices)
+        old[found] = old_data[np.searchsorted(old_indices, changed[found])]
+        I.append(changed)
+        J.append(changed)
+        counts.append(
+            change * (2 * old + change - 1) // 2
+            - (2 * old * change + change * change)
+        )
+
+    if not counts:
+        return scipy.sparse.csr_matrix(shape, dtype=np.int64)
+    return scipy.sparse.csr_matrix(
+        (
+            np.concatenate(counts).astype(np.int64),
+            (np.concatenate(I), np.concatenate(J))
+        ),
+        shape=shape
+    )
+
+
+def replace_rows(matrix, rows, new_rows):
+    """
+    Return a copy of the CSR `matrix` in which the given sorted `rows` are
+    replaced by the rows of the CSR matrix `new_rows`.  The arrays of the
+    matrix are copied a segment at a time, between the replaced rows,
+    without any sparse arithmetic.
+    """
+    indptr = matrix.indptr
+    new_indptr = new_rows.indptr
+    kept_starts = np.r_[0, indptr[rows + 1]]
+    kept_stops = np.r_[indptr[rows], indptr[-1]]
+    indices, data = [], []
+    for k in range(len(rows) + 1):
+        indices.append(matrix.indices[kept_starts[k]:kept_stops[k]])
+        data.append(matrix.data[kept_starts[k]:kept_stops[k]])
+        if k < len(rows):
+            indices.append(new_rows.indices[new_indptr[k]:new_indptr[k+1]])
+            data.append(new_rows.data[new_indptr[k]:new_indptr[k+1]])
+    lengths = np.diff(indptr)
+    lengths[rows] = np.diff(new_indptr)
+    return scipy.sparse.csr_matrix(
+        (
+            np.concatenate(data).astype(matrix.dtype),
+            np.concatenate(indices),
+            np.concatenate(([0], np.cumsum(lengths)))
+        ),
+        shape=matrix.shape
+    )
+
+
+def write_ingested(
+    path, dictionary, graph_adjacency, pairs_adjacency,
+    expanded_graph_adjacency, counts, parents=None, stats=None,
+    compressed=True
+):
+    """
+    Write all the artifacts calculated by `ingest` into the directory
+    `path`, one after the other, with `counts` written as 'counts.npy' (see
+    `id_counts`).  See `write_artifact`; the pairs are weighted if the
+    expanded graph holds floats.  The memory-mappable
+    artifacts (see `d2v.model.Model`) are only written if they are already
+    in `path`, so that they are never left out of date.  If `parents` isn't
+    given, it is calculated from the graph (see `parents_adjacency`).
+    """
+    if parents is None:
+        parents = parents_adjacency(graph_adjacency)
+    artifacts = {
+        'dictionary.txt': dictionary,
+        'graph.npz': graph_adjacency,
+        'pairs.bin': pairs_adjacency,
+        'pairs.npz': pairs_adjacency,
+        'expanded-graph.npz': expanded_graph_adjacency,
+        'counts.npy': counts,
+        'parents.npz': parents,
+    }
+    mappable_artifacts = {
+        'dictionary.bin': dictionary,
+        'graph.csr': graph_adjacency,
+        'pairs.csr': pairs_adjacency,
+        'expanded-graph.csr': expanded_graph_adjacency,
+    }
+    for name, value in mappable_artifacts.items():
+        if os.path.exists(os.path.join(path, name)):
+            artifacts[name] = value
+    for name, value in artifacts.items():
+        write_artifact(
+            path, name, value, compressed=compressed,
+            weighted=expanded_graph_adjacency.dtype.kind == 'f', stats=stats
+        )
+
+
+def write_artifact(
+    path, name, value, compressed=True, weighted=False, stats=None
+):
+    """
+    Write the artifact `name` (see `ARTIFACTS`), having the given `value`,
+    into the directory `path`.  The dictionary files are written from the
+    dictionary, and the others from their matrices.  The '.csr' artifacts
+    are directories of raw arrays (see `d2v.model.write_csr`), and '.npy'
+    artifacts are saved with `numpy.save`.  The distinct pairs, with
+    their counts, are written to 'pairs.bin' (see
+    `d2v.pairlist.write_binary_pairlist`), using int64 elements only if int32
+    can't hold every index, and float64 counts only if `weighted` (see
+    `d2v.pairlist.matrix_pair_blocks`).  Matrices are saved with
+    `scipy.sparse.save_npz`, uncompressed if `compressed` is False, which is
+    faster.
+    """
+    artifact_path = os.path.join(path, name)
+    with timed(stats, ARTIFACTS[name]):
+        if name == 'dictionary.txt':
+            d2v.dictionary.write_dictionary(artifact_path, value)
+        elif name == 'dictionary.bin':
+            d2v.dictionary.write_binary_dictionary(artifact_path, value)
+        elif name.endswith('.csr'):
+            d2v.model.write_csr(artifact_path, value)
+        elif name.endswith('.npy'):
+            np.save(artifact_path, value)
+        elif name == 'pairs.bin':
+            d2v.pairlist.write_binary_pairlist(
+                artifact_path,
+                d2v.pairlist.matrix_pair_blocks(value, weighted=weighted),
+                index_dtype=pair_index_dtype(value.shape[0])
+            )
+        else:
+            scipy.sparse.save_npz(artifact_path, value, compressed=compressed)
+
+
+def pair_index_dtype(num_ids):
+    """
+    The dtype in which 'pairs.bin' stores the ids of a dictionary of
+    `num_ids` ids: int32, unless it can't hold every index.
+    """
+    return np.int32 if num_ids <= np.iinfo(np.int32).max + 1 else np.int64
+
+
+class ArtifactWriter:
+    """
+    Writes artifacts of ingestion (see `write_artifact`) into the directory
+    `path` using a pool of `threads` background threads, so that writing
+    overlaps with the calculation of later artifacts.  Artifacts not named
+    in `outputs` are ignored.  Leaving a `with` block waits for all writes to
+    finish, and raises the first error encountered while writing.  Values
+    must not be modified once given to `write`.  `compressed` and `weighted`
+    are passed to `write_artifact`.
+    """
+    def __init__(
+        self, path, outputs=None, compressed=True, weighted=False, threads=2,
+        stats=None
+    ):
+        self.path = path
+        self.outputs = set(DEFAULT_OUTPUTS if outputs is None else outputs)
+        self.compressed = compressed
+        self.weighted = weighted
+        self.stats = stats
+        self.executor = concurrent.futures.ThreadPoolExecutor(threads)
+        self.futures = []
+
+    def wants(self, *names):
+        """Whether any of the artifacts `names` should be written."""
+        return any(name in self.outputs for name in names)
+
+    def write(self, name, value):
+        """Start writing artifact `name`, if it is wanted."""
+        if self.wants(name):
+            self.futures.append(self.executor.submit(
+                write_artifact, self.path, name, value,
+                compressed=self.compressed, weighted=self.weighted,
+                stats=self.stats
+            ))
+
+    def mark_written(self, name):
+        """
+        Record that artifact `name` was written directly, rather than by
+        `write`, so that it isn't written again.
+        """
+        self.outputs.discard(name)
+
+    def close(self):
+        """Wait for all writes to finish, raising any error."""
+        self.executor.shutdown(wait=True)
+        for future in self.futures:
+            future.result()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            return
+        self.close()
+
+
 
 def test_write(path):
     test_path = os.path.join(path, 'test') 
@@ -147,21 +1306,211 @@ def make_pairs_and_expanded_graph(graph):
     return pairs, expanded_graph
 
 
+def count_pairs_and_expand_graph(graph, counter):
+    """
+    Like `make_pairs_and_expanded_graph`, but rather than returning the list
+    of pairs, each pair is added to `counter` as it is generated, so that the
+    full list of pairs is never held in memory.
+
+    Inputs
+     - `graph` - dict<list<int>> - see `make_pairs_and_expanded_graph`.
+     - `counter` - d2v.pairlist.PairCounter - accumulates the pairs.
+
+    Outputs
+     - `expanded_graph` - see `make_pairs_and_expanded_graph`.
+    """
+    expanded_graph = {}
+    for index in graph:
+        indices = recursively_expand(index, graph, expanded_graph)
+        counter.add_pairs(
+            d2v.d2v_id.unordered_pair(id1, id2) 
+            for id1, id2 in it.combinations(indices, 2)
+        )
+    counter.flush()
+    return expanded_graph
+
+
+def expand_graph_adjacency(graph, shape, decay=1):
+    """
+    Calculate the adjacency matrix of the `expanded_graph` (see
+    `make_pairs_and_expanded_graph`) directly, without generating pairs or
+    lists of descendents.  If `decay` isn't 1, descendents at distance k are
+    weighted by decay**k, and the matrix holds floats.
+    """
+    adjacency = d2v.graph.graph_to_csr(graph, shape=shape, dtype=int)
+    if decay != 1:
+        adjacency = adjacency * float(decay)
+    return d2v.graph.expand_csr(adjacency, graph)
+
+
+def count_pairs_vectorized(expanded_graph_adjacency, counter,
+        batch_size=2**20):
+    """
+    Count the pairs that cooccur within each row of the expanded graph's
+    adjacency matrix, and add them to `counter`.  The counts are the same as
+    those obtained by listing all pairs using `make_pairs_and_expanded_graph`,
+    but pairs are generated with numpy for whole batches of rows at once.
+
+    Rows having the same number of distinct entries, k, are stacked into a
+    matrix of column indices, and all upper-triangular index pairs (including
+    the diagonal) are gathered from it in one step.  A child occurring c1
+    times in a row forms c1 * c2 pairs with a child occurring c2 times, and
+    c1 * (c1 - 1) / 2 pairs with itself.
+
+    Inputs
+     - `expanded_graph_adjacency` - scipy.sparse.csr_matrix - number of times
+        that each column occurs among the descendents of each row.
+     - `counter` - d2v.pairlist.PairCounter - accumulates the pairs.
+     - `batch_size` - int - approximate number of pairs generated at once.
+    """
+    adjacency = expanded_graph_adjacency.tocsr(copy=True)
+    adjacency.sum_duplicates()
+    row_lengths = np.diff(adjacency.indptr)
+    rows = np.flatnonzero(row_lengths)
+    rows = rows[np.argsort(row_lengths[rows], kind='stable')]
+    lengths = row_lengths[rows]
+    if len(rows) == 0:
+        return
+
+    # Process rows in groups of equal length.
+    boundaries = np.flatnonzero(np.r_[True, lengths[1:] != lengths[:-1]])
+    for start, stop in zip(boundaries, np.r_[boundaries[1:], len(rows)]):
+        k = lengths[start]
+        first, second = np.triu_indices(k)
+        rows_per_batch = max(1, batch_size // len(first))
+        for batch_start in range(start, stop, rows_per_batch):
+            batch_rows = rows[batch_start:min(stop, batch_start+rows_per_batch)]
+
+            # Positions of each row's entries within `indices` and `data`.
+            positions = adjacency.indptr[batch_rows][:,None] + np.arange(k)
+            indices = adjacency.indices[positions]
+            data = adjacency.data[positions].astype(np.int64)
+
+            # Gather the index pairs and the number of times each occurs.
+            I, J = indices[:,first], indices[:,second]
+            counts = data[:,first] * data[:,second]
+            diagonal = first == second
+            counts[:,diagonal] = (
+                data[:,first[diagonal]] * (data[:,first[diagonal]] - 1) // 2)
+
+            keep = counts > 0
+            counter.add(I[keep], J[keep], counts[keep])
+
+    counter.flush()
+
+
+def gram_pairs_adjacency(
+    expanded_graph_adjacency, block_size=None, squares=None, weights=None
+):
+    """
+    Calculate the symmetric pair count matrix directly from the expanded
+    graph's adjacency matrix, X, without generating pairs.
+
+    Two different children occurring c1 and c2 times within the same object
+    form c1 * c2 pairs, which is exactly what an off-diagonal entry of X^T X
+    sums over objects.  A child occurring c times forms c * (c - 1) / 2 pairs
+    with itself, whereas the diagonal of X^T X sums c * c, so the diagonal is
+    corrected to (sum(c * c) - sum(c)) / 2.  The result is the same as
+    calling `d2v.pairlist.pairlist_to_coo(..., symmetric=True)` on the pairs
+    listed by `make_pairs_and_expanded_graph`.
+
+    Weighted counts are calculated the same way (see `ingest`).  With object
+    weights W, the product is X^T W X.  A child whose occurrences in an
+    object have weights v forms (sum(v) ** 2 - sum(v * v)) / 2 pairs with
+    itself, where the sums of squares are given by the matrix `squares`
+    (equal to X when every weight is 1).
+
+    Inputs
+     - `expanded_graph_adjacency` - scipy.sparse.csr_matrix - number of times
+        that each column occurs among the descendents of each row.
+     - `block_size` - int or None - number of rows of the result to compute
+        at a time, which bounds the size of the intermediate products.  By
+        default, all rows are computed at once.
+     - `squares` - scipy.sparse matrix or None - sum of the squared weights
+        of the occurrences of each column in each row.  By default, X.
+     - `weights` - numpy.ndarray or None - weight of each row.  By default,
+        every row has weight 1.
+
+    The result holds integers if all inputs do, and floats otherwise.
+    """
+    weighted = (
+        squares is not None or weights is not None
+        or expanded_graph_adjacency.dtype.kind == 'f'
+    )
+    dtype = np.float64 if weighted else np.int64
+    X = expanded_graph_adjacency.tocsr().astype(dtype)
+    if squares is None:
+        squares = X
+    if weights is None:
+        weights = np.ones(X.shape[0], dtype=dtype)
+        X_transpose = X.T.tocsr()
+    else:
+        X_transpose = (X.T @ scipy.sparse.diags(weights)).tocsr()
+    num_rows = X.shape[1]
+    if block_size is None:
+        block_size = max(num_rows, 1)
+
+    self_pairs = squares.T.tocsr().astype(dtype) @ weights.astype(dtype)
+    blocks = []
+    for start in range(0, num_rows, block_size):
+        stop = min(start + block_size, num_rows)
+        block = X_transpose[start:stop] @ X
+        correction = block.diagonal(k=start) + self_pairs[start:stop]
+        correction = correction / 2 if weighted else correction // 2
+        block = block - scipy.sparse.diags(
+            correction, offsets=start, shape=block.shape)
+        block.eliminate_zeros()
+        blocks.append(block)
+
+    if not blocks:
+        return scipy.sparse.coo_matrix((num_rows, num_rows))
+    return scipy.sparse.vstack(blocks).tocoo()
+
+
 def recursively_expand(obj_id, object_graph, expanded):
+    """
+    Return the list of descendents of `obj_id` (including itself), given the
+    `object_graph` that maps parents to lists of children.  Expansions are
+    cached in `expanded`, and reused whenever a parent is reached again.
 
+    The graph is traversed iteratively, with an explicit stack, so deep
+    chains of references don't exceed Python's recursion limit.  Raises
+    ValueError if a cycle of references is found.  See
+    `d2v.graph.expand_csr` for an approach that avoids building lists.
+    """
     # Check the cache to see if we already expanded it.
     if obj_id in expanded:
         return expanded[obj_id]
 
-    # Otherwise expand it!
-    expanded[obj_id] = [obj_id]
-    for child_id in object_graph[obj_id]:
-        if child_id in object_graph:
-            expanded[obj_id].extend(
-                recursively_expand(child_id, object_graph, expanded)
-            )
+    # Parents on the stack whose children are still being expanded.
+    in_progress = set()
+    stack = [obj_id]
+    while stack:
+        current = stack[-1]
+        if current in expanded:
+            stack.pop()
+
+        # All children have been expanded, so expand `current` itself.
+        elif current in in_progress:
+            expansion = [current]
+            for child_id in object_graph[current]:
+                if child_id in object_graph:
+                    expansion.extend(expanded[child_id])
+                else:
+                    expansion.append(child_id)
+            expanded[current] = expansion
+            in_progress.remove(current)
+            stack.pop()
+
+        # Otherwise, first expand the children.
         else:
-            expanded[obj_id].append(child_id)
+            in_progress.add(current)
+            for child_id in object_graph[current]:
+                if child_id in in_progress:
+                    raise ValueError(
+                        'Cycle of references involving {}.'.format(child_id))
+                if child_id in object_graph and child_id not in expanded:
+                    stack.append(child_id)
 
     return expanded[obj_id]
 
@@ -0,0 +1,239 @@
+"""
+Compute embeddings by linear algebra rather than sampling, by factorizing a
+shifted positive pointwise mutual information (PPMI) matrix of the pair
+counts written by `d2v.ingestion.ingest`:
+
+    python -m d2v.linalg path/to/model --dimensions 100 --seed 0
+
+The PPMI matrix is calculated on the sparse pair counts, and factorized by a
+randomized truncated SVD.  Both work through the matrix in blocks of rows,
+so memory stays bounded by the sparse matrix, its transpose, and a few dense
+matrices of one row per id and a column per dimension, however many threads
+are used.  Dense products run in BLAS, which uses every core, and the sparse
+products of row blocks are spread over a pool of threads, each block writing
+its own rows of the result.  Given the same seed, the embeddings are the
+same.  They are saved in the model directory as 'embeddings.npy', like those
+of `d2v.trainer`.
+"""
+import os
+import time
+import argparse
+import concurrent.futures
+import multiprocessing
+import numpy as np
+import scipy.sparse
+import d2v
+
+
+def ppmi_matrix(pairs_adjacency, shift=1, alpha=0.75, block_size=2**16):
+    """
+    Calculate the shifted positive PMI matrix of the pair counts
+    `pairs_adjacency`, without densifying it.  The PMI of a pair (i, j)
+    counted c(i, j) times is
+
+        log(c(i, j) * C / (c(i) * c(j) ** alpha)) - log(shift)
+
+    where c(i) is the count of row i, and c(j) ** alpha is the count of
+    column j raised to `alpha` (which smooths the context distribution, like
+    the unigram power in negative sampling), summing to C.  Only positive
+    values are kept.  Shifting by log(k) makes the factorization equivalent
+    to skip-gram with k negative samples.
+
+    Inputs
+     - pairs_adjacency - scipy.sparse matrix - pair counts, like the
+        'pairs.npz' written by `d2v.ingestion.ingest`.
+     - shift - float - the number of negative samples k.
+     - alpha - float - the exponent smoothing the column counts.
+     - block_size - int - the number of rows transformed at a time, which
+        bounds the size of the temporary arrays.
+
+    Returns a float32 scipy.sparse.csr_matrix.
+    """
+    pairs_adjacency = scipy.sparse.csr_matrix(pairs_adjacency)
+    pairs_adjacency.sum_duplicates()
+    row_counts = np.asarray(
+        pairs_adjacency.sum(axis=1, dtype=np.float64)).ravel()
+    column_weights = np.power(
+        np.asarray(pairs_adjacency.sum(axis=0, dtype=np.float64)).ravel(),
+        alpha
+    )
+    log_total = np.log(column_weights.sum()) - np.log(shift)
+    with np.errstate(divide='ignore'):
+        log_rows = np.log(row_counts)
+        log_columns = np.log(column_weights)
+
+    indptr = pairs_adjacency.indptr
+    indices, data, row_lengths = [], [], []
+    for start in range(0, pairs_adjacency.shape[0], block_size):
+        stop = min(start + block_size, pairs_adjacency.shape[0])
+        entries = slice(indptr[start], indptr[stop])
+        block_indices = pairs_adjacency.indices[entries]
+        rows = np.repeat(
+            np.arange(start, stop), np.diff(indptr[start:stop+1]))
+        pmi = (
+            np.log(pairs_adjacency.data[entries].astype(np.float64))
+            + log_total - log_rows[rows] - log_columns[block_indices]
+        )
+        positive = pmi > 0
+        indices.append(block_indices[positive])
+        data.append(pmi[positive].astype(np.float32))
+        row_lengths.append(np.bincount(
+            rows[positive] - start, minlength=stop - start))
+
+    ppmi_indptr = np.zeros(pairs_adjacency.shape[0] + 1, dtype=np.int64)
+    np.cumsum(
+        np.concatenate(row_lengths + [np.zeros(0, np.int64)]),
+        out=ppmi_indptr[1:]
+    )
+    return scipy.sparse.csr_matrix(
+        (
+            np.concatenate(data + [np.zeros(0, np.float32)]),
+            np.concatenate(indices + [np.zeros(0, np.int32)]),
+            ppmi_indptr
+        ),
+        shape=pairs_adjacency.shape
+    )
+
+
+def randomized_svd(
+    matrix, rank, oversamples=10, power_iterations=2, block_size=2**16,
+    threads=None, seed=0
+):
+    """
+    Calculate the `rank` largest singular values of the sparse `matrix`, and
+    their singular vectors, by randomized range finding: the matrix is
+    multiplied by `rank + oversamples` random vectors, refined by
+    `power_iterations` rounds of multiplying by the matrix and its transpose,
+    and the small projection of the matrix onto the orthonormalized result is
+    decomposed exactly.
+
+    Products with the matrix, and with its transpose (built once, in CSR
+    format), are computed for `block_size` rows at a time by a pool of
+    `threads` threads (by default, one per CPU; see `multiply_blocks`).  The
+    dense matrices are float32, and none is held per thread, so memory stays
+    bounded for millions of rows.  The signs of the singular vectors are
+    chosen so that the largest entry of each column of U is positive, so the
+    results only depend on `seed`.
+
+    Returns `(U, S, Vt)`, like `numpy.linalg.svd(..., full_matrices=False)`
+    truncated to `rank`.
+    """
+    matrix = scipy.sparse.csr_matrix(matrix)
+    transpose = matrix.T.tocsr()
+    if threads is None:
+        threads = multiprocessing.cpu_count()
+    num_vectors = min(rank + oversamples, *matrix.shape)
+    rng = np.random.default_rng(seed)
+
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        def orthonormal(dense):
+            return np.linalg.qr(dense)[0]
+
+        random_vectors = rng.standard_normal(
+            (matrix.shape[1], num_vectors)).astype(np.float32)
+        Q = orthonormal(multiply_blocks(
+            matrix, random_vectors, block_size, executor))
+        for _ in range(power_iterations):
+            Q = orthonormal(multiply_blocks(
+                transpose, Q, block_size, executor))
+            Q = orthonormal(multiply_blocks(matrix, Q, block_size, executor))
+        projection = multiply_blocks(transpose, Q, block_size, executor).T
+
+    U, S, Vt = np.linalg.svd(projection, full_matrices=False)
+    U = Q @ U[:, :rank]
+    S, Vt = S[:rank], Vt[:rank]
+    signs = np.sign(U[np.argmax(np.abs(U), axis=0), np.arange(U.shape[1])])
+    signs[signs == 0] = 1
+    return U * signs, S, Vt * signs[:, None]
+
+
+def multiply_blocks(matrix, dense, block_size, executor):
+    """
+    Calculate the product of the CSR `matrix` and the array `dense`, one
+    block of `block_size` rows at a time, using the `executor`.  Each block
+    writes its own rows of the product, so no partial sums are held, and
+    the result doesn't depend on timing.
+    """
+    product = np.empty((matrix.shape[0], dense.shape[1]), dtype=dense.dtype)
+
+    def multiply(start):
+        stop = min(start + block_size, matrix.shape[0])
+        product[start:stop] = matrix[start:stop] @ dense
+
+    list(executor.map(multiply, range(0, matrix.shape[0], block_size)))
+    return product
+
+
+def svd_embeddings(
+    pairs_adjacency, dimensions=100, shift=1, alpha=0.75,
+    eigenvalue_weight=0.5, oversamples=10, power_iterations=2,
+    block_size=2**16, threads=None, seed=0, stats=None
+):
+    """
+    Calculate float32 embeddings, one row per id, by factorizing the shifted
+    PPMI matrix of `pairs_adjacency` (see `ppmi_matrix` for `shift`, `alpha`
+    and `block_size`) with a randomized truncated SVD of rank `dimensions`
+    (see `randomized_svd` for the other arguments).  The embeddings are the
+    left singular vectors scaled by the singular values raised to
+    `eigenvalue_weight`; 0.5 splits the singular values evenly between the
+    embeddings and context vectors, as skip-gram does.
+
+    If `stats` is given, stats['svd'] is set to a dict reporting the
+    'ppmi_seconds' and 'svd_seconds' elapsed, and the number of entries of
+    the PPMI matrix, 'ppmi_nnz'.
+    """
+    start = time.perf_counter()
+    ppmi = ppmi_matrix(
+        pairs_adjacency, shift=shift, alpha=alpha, block_size=block_size)
+    ppmi_seconds = time.perf_counter() - start
+    U, S, _ = randomized_svd(
+        ppmi, dimensions, oversamples=oversamples,
+        power_iterations=power_iterations, block_size=block_size,
+        threads=threads, seed=seed
+    )
+    embeddings = (U * np.power(S, eigenvalue_weight)).astype(np.float32)
+    if stats is not None:
+        stats['svd'] = {
+            'ppmi_seconds': ppmi_seconds,
+            'svd_seconds': time.perf_counter() - start - ppmi_seconds,
+            'ppmi_nnz': ppmi.nnz,
+        }
+    return embeddings
+
+
+def solve_model(path, stats=None, **kwargs):
+    """
+    Calculate embeddings from the pairs of the model directory `path` (see
+    `d2v.model.Model`) with `svd_embeddings`, taking the keyword arguments
+    `kwargs`.  Returns the embeddings.
+    """
+    with d2v.model.Model(path) as model:
+        return svd_embeddings(model.pairs, stats=stats, **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('path', help='model directory holding pairs')
+    parser.add_argument('--dimensions', type=int, default=100)
+    parser.add_argument('--shift', type=float, default=1)
+    parser.add_argument('--alpha', type=float, default=0.75)
+    parser.add_argument('--power-iterations', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    stats = {}
+    embeddings = solve_model(
+        args.path, dimensions=args.dimensions, shift=args.shift,
+        alpha=args.alpha, power_iterations=args.power_iterations,
+        threads=args.threads, seed=args.seed, stats=stats
+    )
+    np.save(os.path.join(args.path, 'embeddings.npy'), embeddings)
+    print('PPMI in {:.3f} s ({} entries), SVD in {:.3f} s'.format(
+        stats['svd']['ppmi_seconds'], stats['svd']['ppmi_nnz'],
+        stats['svd']['svd_seconds']
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,344 @@
+import os
+import json
+import numpy as np
+import scipy.sparse
+import d2v
+
+
+# Raw CSR directories (see `write_csr`) and the .npz files they replace.
+MATRICES = {
+    'graph': ('graph.csr', 'graph.npz'),
+    'pairs': ('pairs.csr', 'pairs.npz'),
+    'expanded_graph': ('expanded-graph.csr', 'expanded-graph.npz'),
+}
+
+
+def write_csr(path, matrix):
+    """
+    Write `matrix` in CSR format into the directory `path`, as the raw numpy
+    arrays 'indptr.npy', 'indices.npy', 'data.npy', and 'shape.npy', so that
+    it can be memory-mapped by `load_csr`.
+    """
+    matrix = scipy.sparse.csr_matrix(matrix)
+    # Rebuilding the matrix gives its index arrays the dtype that scipy
+    # chooses when loading, so that loading doesn't need to copy them.
+    matrix = scipy.sparse.csr_matrix(
+        (matrix.data, matrix.indices, matrix.indptr), shape=matrix.shape)
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, 'indptr.npy'), matrix.indptr)
+    np.save(os.path.join(path, 'indices.npy'), matrix.indices)
+    np.save(os.path.join(path, 'data.npy'), matrix.data)
+    np.save(os.path.join(path, 'shape.npy'), np.array(matrix.shape))
+
+
+def load_csr(path, mmap=True):
+    """
+    Load a matrix written by `write_csr` as a scipy.sparse.csr_matrix.  If
+    `mmap` is True, its arrays are read-only views of the memory-mapped
+    files, which are only read from disk as they are used, and are shared
+    through the page cache by every process that maps them.  Operations that
+    modify a matrix in place (like `sort_indices`) then fail.
+    """
+    mmap_mode = 'r' if mmap else None
+    arrays = [
+        np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+        for name in ('data', 'indices', 'indptr')
+    ]
+    shape = tuple(np.load(os.path.join(path, 'shape.npy')).tolist())
+    return scipy.sparse.csr_matrix(tuple(arrays), shape=shape, copy=False)
+
+
+def convert_model(path):
+    """
+    Add the memory-mappable artifacts to a model directory `path` written by
+    `d2v.ingestion.ingest`: a raw CSR directory for each .npz matrix, and a
+    binary dictionary.  Artifacts that are missing are skipped.
+    """
+    for raw_name, npz_name in MATRICES.values():
+        npz_path = os.path.join(path, npz_name)
+        if os.path.exists(npz_path):
+            write_csr(
+                os.path.join(path, raw_name), scipy.sparse.load_npz(npz_path))
+    text_path = os.path.join(path, 'dictionary.txt')
+    if os.path.exists(text_path):
+        d2v.dictionary.write_binary_dictionary(
+            os.path.join(path, 'dictionary.bin'),
+            d2v.dictionary.read_dictionary(text_path)
+        )
+
+
+def permute_matrix(matrix, remap):
+    """
+    Renumber the rows and columns of a square `matrix` by the array `remap`,
+    mapping each old id to its new id.  Returns a scipy.sparse.csr_matrix.
+    """
+    coo_matrix = scipy.sparse.coo_matrix(matrix)
+    return scipy.sparse.csr_matrix(
+        (coo_matrix.data, (remap[coo_matrix.row], remap[coo_matrix.col])),
+        shape=coo_matrix.shape
+    )
+
+
+def relayout_model(path):
+    """
+    Renumber the ids of the model directory `path` so that each (type,
+    field) namespace occupies a contiguous range of ids (see
+    `d2v.dictionary.namespace_layout`).  Every artifact of `d2v.ingestion.
+    ARTIFACTS` in `path`, and the embeddings in 'embeddings.npy' (see
+    `d2v.trainer`), are rewritten consistently.  The range of each namespace
+    is written to 'namespaces.json', which `Model.namespace_ranges` reads.
+    Returns the array mapping each old id to its new id.
+
+    The rows of a namespace in any matrix indexed by id, like the
+    embeddings, are then a contiguous slice, which numpy gives as a view
+    rather than a copy (see `Model.namespace_embeddings`).
+    """
+    # Everything is read into memory before any file is overwritten, since
+    # files that are memory-mapped must not change.
+    with Model(path, mmap=False) as model:
+        dictionary, remap = d2v.dictionary.namespace_layout(model.dictionary)
+        artifacts = {
+            'dictionary.txt': dictionary, 'dictionary.bin': dictionary}
+        if os.path.exists(os.path.join(path, 'counts.npy')):
+            artifacts['counts.npy'] = np.empty_like(model.counts)
+            artifacts['counts.npy'][remap] = model.counts
+        for name, (raw_name, npz_name) in MATRICES.items():
+            if not model.has_matrix(name):
+                continue
+            matrix = permute_matrix(model.load_matrix(name), remap)
+            artifacts[raw_name] = artifacts[npz_name] = matrix
+            if name == 'pairs':
+                artifacts['pairs.bin'] = matrix
+        parents_path = os.path.join(path, 'parents.npz')
+        if os.path.exists(parents_path):
+            artifacts['parents.npz'] = permute_matrix(
+                scipy.sparse.load_npz(parents_path), remap)
+
+    # Pairs keep the counts they were written with, weighted or not.
+    pairs_path = os.path.join(path, 'pairs.bin')
+    weighted = (
+        os.path.exists(pairs_path)
+        and d2v.pairlist.is_weighted_pairlist(pairs_path)
+    )
+    for name, value in artifacts.items():
+        if os.path.exists(os.path.join(path, name)):
+            d2v.ingestion.write_artifact(path, name, value, weighted=weighted)
+
+    embeddings_path = os.path.join(path, 'embeddings.npy')
+    if os.path.exists(embeddings_path):
+        embeddings = np.load(embeddings_path)
+        laid_out_embeddings = np.empty_like(embeddings)
+        laid_out_embeddings[remap] = embeddings
+        np.save(embeddings_path, laid_out_embeddings)
+
+    write_namespace_ranges(
+        os.path.join(path, 'namespaces.json'),
+        d2v.dictionary.namespace_ranges(dictionary), len(dictionary)
+    )
+    return remap
+
+
+def write_namespace_ranges(path, ranges, num_ids):
+    """
+    Write the `ranges` of the namespaces of a dictionary of `num_ids` ids
+    (see `d2v.dictionary.namespace_ranges`) as JSON, to be read by
+    `read_namespace_ranges`.
+    """
+    with open(path, 'w') as ranges_file:
+        json.dump({
+            'num_ids': num_ids,
+            'ranges': [
+                [obj_type, field, start, stop]
+                for (obj_type, field), (start, stop) in ranges.items()
+            ]
+        }, ranges_file)
+
+
+def read_namespace_ranges(path):
+    """
+    Read the namespace ranges written by `write_namespace_ranges`.  Returns
+    `(ranges, num_ids)`.
+    """
+    with open(path) as ranges_file:
+        record = json.load(ranges_file)
+    ranges = {
+        (obj_type, field): (start, stop)
+        for obj_type, field, start, stop in record['ranges']
+    }
+    return ranges, record['num_ids']
+
+
+def load_binary_pairs(path, num_ids):
+    """
+    Read a binary pairlist (see `d2v.pairlist.write_binary_pairlist`) of ids
+    below `num_ids` into a symmetric scipy.sparse.csr_matrix of pair counts.
+    """
+    blocks = list(d2v.pairlist.read_binary_pairlist(path))
+    I = np.concatenate([block[0] for block in blocks] + [np.zeros(0, int)])
+    J = np.concatenate([block[1] for block in blocks] + [np.zeros(0, int)])
+    counts = np.concatenate([
+        np.ones(len(block[0]), dtype=np.int64) if block[2] is None
+        else block[2] for block in blocks
+    ] + [np.zeros(0, dtype=np.int64)])
+    return d2v.pairlist.arrays_to_coo(
+        counts, I, J, shape=(num_ids, num_ids), symmetric=True).tocsr()
+
+
+class Model:
+    """
+    An ingested model directory, opened for reading.  The `dictionary`,
+    `counts`, `graph`, `pairs`, `expanded_graph`, and `embeddings` are each
+    loaded the first time they are used.  Matrices are loaded from their raw
+    CSR directories (see `write_csr`), memory-mapped if `mmap` is True, so
+    that opening a model takes about constant time.  If only the .npz file
+    of a matrix exists, it is loaded into memory instead.  Likewise, if
+    `mmap` is True, the dictionary is memory-mapped from 'dictionary.bin' if
+    it exists (see `d2v.dictionary.MappedDictionary`).  Otherwise it is read
+    into memory from 'dictionary.txt', or from 'dictionary.bin' if that is
+    the only one written.
+
+    After `relayout_model`, the ids of each (type, field) namespace are
+    contiguous, and `namespace_embeddings` gives a namespace's embeddings as
+    a view.
+    """
+    def __init__(self, path, mmap=True):
+        self.path = path
+        self.mmap = mmap
+        self.loaded = {}
+
+    @property
+    def dictionary(self):
+        if 'dictionary' not in self.loaded:
+            binary_path = os.path.join(self.path, 'dictionary.bin')
+            text_path = os.path.join(self.path, 'dictionary.txt')
+            if self.mmap and os.path.exists(binary_path):
+                dictionary = d2v.dictionary.read_binary_dictionary(binary_path)
+            elif os.path.exists(text_path):
+                dictionary = d2v.dictionary.read_dictionary(text_path)
+            else:
+                # Only the binary dictionary exists; copy it into memory.
+                dictionary = d2v.dictionary.Dictionary()
+                with d2v.dictionary.read_binary_dictionary(
+                    binary_path
+                ) as mapped_dictionary:
+                    dictionary.add_many(mapped_dictionary.keys)
+            self.loaded['dictionary'] = dictionary
+        return self.loaded['dictionary']
+
+    @property
+    def counts(self):
+        """
+        The number of times that each id occurs as a child, from 'counts.npy'
+        (see `d2v.ingestion.id_counts`).  If it is missing, the counts are
+        recovered from the graph and the expanded graph.
+        """
+        if 'counts' not in self.loaded:
+            counts_path = os.path.join(self.path, 'counts.npy')
+            if os.path.exists(counts_path):
+                counts = np.load(
+                    counts_path, mmap_mode='r' if self.mmap else None)
+            else:
+                graph = self.graph
+                counts = d2v.ingestion.id_counts(
+                    d2v.ingestion.recover_graph_rows(
+                        np.arange(graph.shape[0]), graph, self.expanded_graph
+                    ))
+            self.loaded['counts'] = counts
+        return self.loaded['counts']
+
+    @property
+    def namespace_ranges(self):
+        """
+        The range `(start, stop)` of ids of each (type, field) namespace, as
+        laid out by `relayout_model`.  Read from 'namespaces.json' if it
+        covers every id, and calculated from the dictionary otherwise, which
+        raises ValueError if the ids of a namespace aren't contiguous, for
+        example because ids were added by `d2v.ingestion.ingest_incremental`
+        since the model was laid out.
+        """
+        if 'namespace_ranges' not in self.loaded:
+            ranges_path = os.path.join(self.path, 'namespaces.json')
+            ranges = None
+            if os.path.exists(ranges_path):
+                ranges, num_ids = read_namespace_ranges(ranges_path)
+                if num_ids != len(self.dictionary):
+                    ranges = None
+            if ranges is None:
+                ranges = d2v.dictionary.namespace_ranges(self.dictionary)
+            self.loaded['namespace_ranges'] = ranges
+        return self.loaded['namespace_ranges']
+
+    def namespace_slice(self, obj_type, field):
+        """The slice of ids of the namespace (`obj_type`, `field`)."""
+        return slice(*self.namespace_ranges[obj_type, field])
+
+    @property
+    def embeddings(self):
+        """The embeddings in 'embeddings.npy' (see `d2v.trainer`)."""
+        if 'embeddings' not in self.loaded:
+            self.loaded['embeddings'] = np.load(
+                os.path.join(self.path, 'embeddings.npy'),
+                mmap_mode='r' if self.mmap else None
+            )
+        return self.loaded['embeddings']
+
+    def namespace_embeddings(self, obj_type, field):
+        """
+        The embeddings of the ids of the namespace (`obj_type`, `field`),
+        without copying them.
+        """
+        return self.embeddings[self.namespace_slice(obj_type, field)]
+
+    @property
+    def graph(self):
+        return self.load_matrix('graph')
+
+    @property
+    def pairs(self):
+        return self.load_matrix('pairs')
+
+    @property
+    def expanded_graph(self):
+        return self.load_matrix('expanded_graph')
+
+    def load_matrix(self, name):
+        """
+        Load one of the matrices in `MATRICES`, by name.  If only
+        'pairs.bin' holds the pairs, they are read from it into memory.
+        """
+        if name not in self.loaded:
+            raw_name, npz_name = MATRICES[name]
+            raw_path = os.path.join(self.path, raw_name)
+            npz_path = os.path.join(self.path, npz_name)
+            if os.path.isdir(raw_path):
+                matrix = load_csr(raw_path, mmap=self.mmap)
+            elif name == 'pairs' and not os.path.exists(npz_path):
+                matrix = load_binary_pairs(
+                    os.path.join(self.path, 'pairs.bin'), len(self.dictionary))
+            else:
+                matrix = scipy.sparse.load_npz(npz_path).tocsr()
+            self.loaded[name] = matrix
+        return self.loaded[name]
+
+    def has_matrix(self, name):
+        """Whether the matrix `name` (see `MATRICES`) was written."""
+        artifact_names = MATRICES[name]
+        if name == 'pairs':
+            artifact_names += ('pairs.bin',)
+        return any(
+            os.path.exists(os.path.join(self.path, artifact_name))
+            for artifact_name in artifact_names
+        )
+
+    def close(self):
+        """Close the memory-mapped dictionary, and forget loaded artifacts."""
+        dictionary = self.loaded.get('dictionary')
+        if isinstance(dictionary, d2v.dictionary.MappedDictionary):
+            dictionary.close()
+        self.loaded = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,5 +1,36 @@
+import os
+import zlib
+import itertools as it
+import shutil
+import struct
+import tempfile
+import numpy as np
 import scipy.sparse
 
+
+# Bytes used per distinct pair held by a `PairCounter` (int64 key and count).
+BYTES_PER_PAIR = 16
+
+# Bytes used per pair waiting in a `PairCounter`'s buffer (int64 key and
+# count).
+BYTES_PER_BUFFERED_PAIR = 16
+
+# Fewest keys that an `ExternalPairCounter` reads from a run at a time while
+# merging, unless its buffer is smaller.
+MIN_MERGE_BLOCK = 1024
+
+# Identifies files written by `write_binary_pairlist`.
+BINARY_PAIRLIST_MAGIC = b'D2VPAIR1'
+
+# Binary pairlist header: index itemsize, whether there are counts, whether
+# chunks are compressed, whether counts are float64 rather than int64, padded
+# to keep the chunks 8-byte aligned.
+BINARY_PAIRLIST_HEADER = struct.Struct('<BBBB4x')
+
+# Chunk header: number of pairs, and number of bytes that follow.
+BINARY_PAIRLIST_CHUNK = struct.Struct('<QQ')
+
+
 def write_pairlist(path, pairlist):
     with open(path, 'w') as pair_file:
         for pair in pairlist:
@@ -12,6 +43,176 @@ def read_pairlist(path):
             yield tuple(int(element) for element in line.strip().split(','))
 
 
+def write_binary_pairlist(
+    path, blocks, index_dtype=np.int32, counts=True, compression_level=1
+):
+    """
+    Write pairs to a binary pairlist file at `path`, as fixed-width columns
+    in chunks that are compressed independently, so that they can be read
+    back one block at a time (see `read_binary_pairlist`).
+
+    Inputs
+     - path - str - the file to write.
+     - blocks - iterable<tuple> - blocks of pairs, each being arrays
+        `(I, J)`, or `(I, J, counts)`, holding the first and second element
+        of each pair, and optionally the number of times it occurs.  Each
+        block is written as one chunk.
+     - index_dtype - numpy dtype - np.int32 or np.int64, the type in which
+        the elements of pairs are stored.
+     - counts - bool - whether to store a count column.  Otherwise, each pair
+        is repeated as many times as it occurs.  Counts are stored as int64,
+        unless the first block's counts are floats (weighted counts), in
+        which case they are stored as float64, and must be stored.
+     - compression_level - int - zlib compression level for chunks, or 0 to
+        store chunks uncompressed, which allows them to be memory-mapped.
+    """
+    index_dtype = np.dtype(index_dtype)
+    if index_dtype not in (np.dtype(np.int32), np.dtype(np.int64)):
+        raise ValueError('Unsupported index dtype: "{}".'.format(index_dtype))
+    blocks = iter(blocks)
+    first_block = next(blocks, None)
+    float_counts = (
+        first_block is not None and len(first_block) > 2
+        and np.asarray(first_block[2]).dtype.kind == 'f'
+    )
+    if float_counts and not counts:
+        raise ValueError('Weighted counts must be stored in a count column.')
+    count_dtype = np.float64 if float_counts else np.int64
+
+    with open(path, 'wb') as pair_file:
+        pair_file.write(BINARY_PAIRLIST_MAGIC)
+        pair_file.write(BINARY_PAIRLIST_HEADER.pack(
+            index_dtype.itemsize, counts, compression_level > 0,
+            float_counts
+        ))
+        if first_block is None:
+            return
+        for block in it.chain([first_block], blocks):
+            I, J = np.asarray(block[0]), np.asarray(block[1])
+            block_counts = (
+                np.ones(len(I), dtype=count_dtype) if len(block) < 3
+                else np.asarray(block[2], dtype=count_dtype)
+            )
+            columns = [I.astype(index_dtype), J.astype(index_dtype)]
+            if counts:
+                columns.append(block_counts)
+            else:
+                columns = [np.repeat(column, block_counts)
+                    for column in columns]
+            payload = b''.join(column.tobytes() for column in columns)
+            if compression_level > 0:
+                payload = zlib.compress(payload, compression_level)
+            pair_file.write(BINARY_PAIRLIST_CHUNK.pack(
+                len(columns[0]), len(payload)))
+            pair_file.write(payload)
+
+
+def is_weighted_pairlist(path):
+    """
+    Whether the binary pairlist at `path` (see `write_binary_pairlist`)
+    holds weighted, float64 counts.
+    """
+    with open(path, 'rb') as pair_file:
+        if pair_file.read(len(BINARY_PAIRLIST_MAGIC)) != BINARY_PAIRLIST_MAGIC:
+            raise ValueError('Not a binary pairlist: "{}".'.format(path))
+        header = pair_file.read(BINARY_PAIRLIST_HEADER.size)
+    return bool(BINARY_PAIRLIST_HEADER.unpack(header)[3])
+
+
+def read_binary_pairlist(path, mmap=False):
+    """
+    Read the binary pairlist at `path`, written by `write_binary_pairlist`.
+    Yields one block `(I, J, counts)` of numpy arrays per chunk, where
+    `counts` is None if the file has no count column, and holds floats if
+    the counts are weighted.  If `mmap` is True, and
+    the chunks are uncompressed, the blocks are read-only views of the
+    memory-mapped file, rather than copies.
+    """
+    with open(path, 'rb') as pair_file:
+        if pair_file.read(len(BINARY_PAIRLIST_MAGIC)) != BINARY_PAIRLIST_MAGIC:
+            raise ValueError('Not a binary pairlist: "{}".'.format(path))
+        itemsize, has_counts, compressed, float_counts = (
+            BINARY_PAIRLIST_HEADER.unpack(
+                pair_file.read(BINARY_PAIRLIST_HEADER.size))
+        )
+        index_dtype = np.dtype('<i{}'.format(itemsize))
+        count_dtype = '<f8' if float_counts else '<i8'
+        mapped = None
+        if mmap and not compressed:
+            mapped = np.memmap(path, dtype=np.uint8, mode='r')
+
+        while True:
+            chunk_header = pair_file.read(BINARY_PAIRLIST_CHUNK.size)
+            if not chunk_header:
+                break
+            num_pairs, num_bytes = BINARY_PAIRLIST_CHUNK.unpack(chunk_header)
+            if mapped is not None:
+                start = pair_file.tell()
+                payload = mapped[start:start+num_bytes]
+                pair_file.seek(num_bytes, 1)
+            else:
+                payload = pair_file.read(num_bytes)
+                if compressed:
+                    payload = zlib.decompress(payload)
+                payload = np.frombuffer(payload, dtype=np.uint8)
+
+            index_bytes = num_pairs * itemsize
+            I = payload[:index_bytes].view(index_dtype)
+            J = payload[index_bytes:2*index_bytes].view(index_dtype)
+            counts = None
+            if has_counts:
+                counts = payload[2*index_bytes:].view(count_dtype)
+            yield I, J, counts
+
+
+def iter_block_pairs(blocks):
+    """
+    Yield each pair in `blocks`, as read by `read_binary_pairlist`, as a
+    tuple, as many times as it occurs.
+    """
+    for I, J, counts in blocks:
+        if counts is not None:
+            I, J = np.repeat(I, counts), np.repeat(J, counts)
+        yield from zip(I.tolist(), J.tolist())
+
+
+def matrix_pair_blocks(matrix, weighted=False, block_size=2**20):
+    """
+    Yield blocks `(I, J, counts)` of the distinct pairs (i, j) with i <= j
+    counted by a symmetric pair count `matrix`, sorted by i then j, with at
+    most `block_size` pairs per block.  Counts are float64 if `weighted`
+    (see `d2v.ingestion.ingest`), even if they happen to be whole numbers,
+    and int64 otherwise, whatever the dtype of the matrix.
+    """
+    coo_matrix = scipy.sparse.triu(matrix).tocoo()
+    order = np.lexsort((coo_matrix.col, coo_matrix.row))
+    I, J = coo_matrix.row[order], coo_matrix.col[order]
+    counts = coo_matrix.data[order]
+    if weighted:
+        counts = counts.astype(np.float64)
+    else:
+        counts = np.rint(counts).astype(np.int64)
+    for start in range(0, len(counts), block_size):
+        stop = start + block_size
+        yield I[start:stop], J[start:stop], counts[start:stop]
+
+
+def iter_matrix_pairs(matrix):
+    """
+    Yield the pairs counted by a symmetric pair count `matrix`, as recorded
+    by `pairlist_to_coo(..., symmetric=True)`.  Each pair (i, j) with i <= j
+    is yielded as many times as it was counted.
+    """
+    coo_matrix = scipy.sparse.triu(matrix).tocoo()
+    order = np.lexsort((coo_matrix.col, coo_matrix.row))
+    rows = coo_matrix.row[order].tolist()
+    cols = coo_matrix.col[order].tolist()
+    counts = coo_matrix.data[order].astype(np.int64).tolist()
+    for i, j, count in zip(rows, cols, counts):
+        for _ in range(count):
+            yield i, j
+
+
 def pairlist_to_coo(pairs, shape=None, symmetric=False):
     """
     Convert `pairs` to a scipy.sparse.coo_matrix.
@@ -31,7 +232,14 @@ def pairlist_to_coo(pairs, shape=None, symmetric=False):
     data = list(pairs.values())
     I = [i for i,j in pairs.keys()]
     J = [j for i,j in pairs.keys()]
+    return arrays_to_coo(data, I, J, shape=shape, symmetric=symmetric)
 
+
+def arrays_to_coo(data, I, J, shape=None, symmetric=False):
+    """
+    Like `pairlist_to_coo`, but takes the counts, and the first and second
+    elements of each pair as three parallel sequences.
+    """
     coo_matrix = scipy.sparse.coo_matrix((data, (I, J)), shape=shape)
 
     if symmetric:
@@ -43,4 +251,414 @@ def pairlist_to_coo(pairs, shape=None, symmetric=False):
     return coo_matrix
 
 
+class PairCounter:
+    """
+    Counts occurrences of (i, j) index pairs without keeping the pairs
+    themselves.  Each pair is encoded as a single int64 key, `i * shape[1] +
+    j`.  Keys are collected in a fixed-size buffer, and whenever the buffer
+    fills it is sorted, reduced, and merged into the sorted arrays of distinct
+    `keys` and their `counts`.
+
+    Inputs
+     - shape - 2-tuple - shape of the matrix that the pairs index into.
+     - max_memory - int or None - limit, in bytes, on the memory used by the
+        buffer plus the distinct keys and counts (including the temporary
+        copies made while merging).  A MemoryError is raised if the distinct
+        pairs cannot be held within the limit.  `None` means no limit.
+     - buffer_size - int - number of pairs held in the buffer before merging.
+        Reduced as needed to respect `max_memory`.
+    """
+
+    def __init__(self, shape, max_memory=None, buffer_size=2**22):
+        self.shape = shape
+        self.max_memory = max_memory
+        if max_memory is not None:
+            buffer_size = min(
+                buffer_size, max_memory // (4 * BYTES_PER_BUFFERED_PAIR))
+            if buffer_size < 1:
+                raise ValueError(
+                    'max_memory of {} bytes is too small.'.format(max_memory))
+        self.buffer = np.empty(buffer_size, dtype=np.int64)
+        self.count_buffer = np.empty(buffer_size, dtype=np.int64)
+        self.num_buffered = 0
+        self.keys = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.int64)
 
+    def add(self, I, J, counts=None):
+        """
+        Count each of the pairs (I[k], J[k]).  If `counts` is given, the pair
+        (I[k], J[k]) is counted `counts[k]` times.
+        """
+        keys = (
+            np.asarray(I, dtype=np.int64) * self.shape[1]
+            + np.asarray(J, dtype=np.int64)
+        )
+        if counts is None:
+            counts = np.ones(len(keys), dtype=np.int64)
+        start = 0
+        while start < len(keys):
+            stop = min(
+                len(keys), start + len(self.buffer) - self.num_buffered)
+            buffered = slice(
+                self.num_buffered, self.num_buffered + stop - start)
+            self.buffer[buffered] = keys[start:stop]
+            self.count_buffer[buffered] = counts[start:stop]
+            self.num_buffered = buffered.stop
+            if self.num_buffered == len(self.buffer):
+                self.flush()
+            start = stop
+
+    def add_pairs(self, pairs):
+        """Count each pair yielded by the iterable `pairs` of 2-tuples."""
+        pairs = iter(pairs)
+        while True:
+            chunk = np.fromiter(
+                (index for _, pair in zip(range(len(self.buffer)), pairs)
+                    for index in pair),
+                dtype=np.int64
+            )
+            if len(chunk) == 0:
+                break
+            self.add(chunk[0::2], chunk[1::2])
+
+    def flush(self):
+        """Merge the buffered keys into the sorted keys and counts."""
+        if self.num_buffered == 0:
+            return
+        order = np.argsort(self.buffer[:self.num_buffered])
+        new_keys, new_counts = reduce_counts(
+            self.buffer[order], self.count_buffer[order])
+        self.num_buffered = 0
+        self.check_memory(len(self.keys) + len(new_keys))
+        self.keys, self.counts = merge_counts(
+            self.keys, self.counts, new_keys, new_counts)
+
+    def check_memory(self, num_pairs):
+        """
+        Raise MemoryError if merging up to `num_pairs` distinct pairs would
+        exceed `max_memory`.
+        """
+        if self.max_memory is None:
+            return
+        # Merging holds the old and merged keys and counts at the same time.
+        needed = (
+            2 * num_pairs * BYTES_PER_PAIR
+            + len(self.buffer) * BYTES_PER_BUFFERED_PAIR
+        )
+        if needed > self.max_memory:
+            raise MemoryError(
+                'Counting {} distinct pairs needs about {} bytes, exceeding '
+                'max_memory of {} bytes.'.format(
+                    num_pairs, needed, self.max_memory)
+            )
+
+    def arrays(self):
+        """Return the arrays (counts, I, J) of the distinct pairs counted."""
+        self.flush()
+        I, J = np.divmod(self.keys, self.shape[1])
+        return self.counts, I, J
+
+    def items(self):
+        """Yield ((i, j), count) for each distinct pair, in sorted order."""
+        counts, I, J = self.arrays()
+        for i, j, count in zip(I.tolist(), J.tolist(), counts.tolist()):
+            yield (i, j), count
+
+    def iter_pairs(self):
+        """Yield each pair as many times as it was counted."""
+        for pair, count in self.items():
+            for _ in range(count):
+                yield pair
+
+    def to_coo(self, symmetric=False):
+        """
+        Convert the counts to a scipy.sparse.coo_matrix, equivalent to
+        calling `pairlist_to_coo` on a Counter of the same pairs.
+        """
+        counts, I, J = self.arrays()
+        return arrays_to_coo(
+            counts, I, J, shape=self.shape, symmetric=symmetric)
+
+    def __len__(self):
+        self.flush()
+        return len(self.keys)
+
+    def close(self):
+        """Release any resources held by the counter."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ExternalPairCounter(PairCounter):
+    """
+    A PairCounter whose distinct pairs don't have to fit in memory.  Whenever
+    the buffer fills, it is sorted and reduced, and spilled to disk as a run
+    of sorted keys and counts, in a temporary directory created within
+    `directory` (by default, the system's temporary directory).  Counts are
+    read back by k-way merging the runs, a block of each at a time.  At most
+    `max_runs` runs are merged at once, and fewer if the buffer is too small
+    to read blocks of `MIN_MERGE_BLOCK` keys from each: if there are more,
+    groups of runs are first merged into longer runs on disk, in as many
+    passes as needed.  The blocks read from the runs being merged add up to
+    the buffer size, so memory use and the number of open files are bounded,
+    however many pairs are counted.
+
+    Temporary files are removed by `close`, which is called on leaving a
+    `with` block, including when an error is raised.  See PairCounter for
+    `shape`, `max_memory` (which here only bounds the buffer), and
+    `buffer_size`.
+    """
+
+    def __init__(self, shape, directory=None, max_memory=None,
+            buffer_size=2**22, max_runs=64):
+        super().__init__(shape, max_memory=max_memory, buffer_size=buffer_size)
+        if max_runs < 2:
+            raise ValueError('max_runs must be at least 2.')
+        self.max_runs = max(
+            2, min(max_runs, len(self.buffer) // MIN_MERGE_BLOCK))
+        self.run_dir = tempfile.mkdtemp(prefix='pair-runs-', dir=directory)
+        self.runs = []
+        self.num_runs_written = 0
+
+    def flush(self):
+        """Write the buffered keys to disk as a sorted run."""
+        if self.num_buffered == 0:
+            return
+        try:
+            order = np.argsort(self.buffer[:self.num_buffered])
+            run_path = self.write_run([reduce_counts(
+                self.buffer[order], self.count_buffer[order])])
+        except BaseException:
+            self.close()
+            raise
+        self.runs.append(run_path)
+        self.num_buffered = 0
+
+    def write_run(self, blocks):
+        """
+        Write the blocks (keys, counts) yielded by `blocks`, which must be
+        sorted and distinct across blocks, to disk as a new run.  Returns the
+        run's path, which is the prefix of its '-keys' and '-counts' files of
+        raw int64s.
+        """
+        run_path = os.path.join(
+            self.run_dir, 'run-{}'.format(self.num_runs_written))
+        self.num_runs_written += 1
+        with open(run_path + '-keys', 'wb') as keys_file, \
+                open(run_path + '-counts', 'wb') as counts_file:
+            for keys, counts in blocks:
+                np.asarray(keys, dtype=np.int64).tofile(keys_file)
+                np.asarray(counts, dtype=np.int64).tofile(counts_file)
+        return run_path
+
+    def read_run(self, run_path):
+        """Memory-map the arrays (keys, counts) of the run at `run_path`."""
+        arrays = []
+        for suffix in ('-keys', '-counts'):
+            if os.path.getsize(run_path + suffix) == 0:
+                arrays.append(np.empty(0, dtype=np.int64))
+            else:
+                arrays.append(
+                    np.memmap(run_path + suffix, dtype=np.int64, mode='r'))
+        return tuple(arrays)
+
+    def iter_blocks(self):
+        """
+        Yield blocks (counts, I, J) of the distinct pairs counted, merged
+        from the runs on disk, in sorted order.
+        """
+        for keys, counts in self.merge_runs():
+            I, J = np.divmod(keys, self.shape[1])
+            yield counts, I, J
+
+    def merge_runs(self):
+        """
+        Yield blocks of sorted distinct keys and their counts, merged from all
+        runs.  While there are more than `max_runs` runs, each group of
+        `max_runs` runs is first merged into one longer run, which replaces
+        them, so that the merging done here and in later calls reads from at
+        most `max_runs` runs.
+        """
+        self.flush()
+        try:
+            while len(self.runs) > self.max_runs:
+                runs = []
+                for start in range(0, len(self.runs), self.max_runs):
+                    group = self.runs[start:start + self.max_runs]
+                    if len(group) == 1:
+                        runs.append(group[0])
+                        continue
+                    runs.append(self.write_run(self.merge_group(group)))
+                    for run_path in group:
+                        os.remove(run_path + '-keys')
+                        os.remove(run_path + '-counts')
+                self.runs = runs
+        except BaseException:
+            self.close()
+            raise
+        yield from self.merge_group(self.runs)
+
+    def merge_group(self, run_paths):
+        """
+        Yield blocks of sorted distinct keys and their counts, merged from
+        the runs at `run_paths`.  A block of up to `len(self.buffer) //
+        len(run_paths)` keys is read from each run at a time.  Each time,
+        every key up to the smallest last key read from any unfinished run
+        can be safely merged, since all keys that follow it, in any run, are
+        larger.
+        """
+        runs = [self.read_run(run_path) for run_path in run_paths]
+        block_size = max(1, len(self.buffer) // max(1, len(runs)))
+        positions = [0] * len(runs)
+        while True:
+            active = [
+                k for k, (keys, _) in enumerate(runs)
+                if positions[k] < len(keys)
+            ]
+            if not active:
+                break
+            # The largest key that can be merged without reading further.
+            bound = min(
+                runs[k][0][min(positions[k] + block_size, len(runs[k][0])) - 1]
+                for k in active
+            )
+            key_blocks, count_blocks = [], []
+            for k in active:
+                keys, counts = runs[k]
+                stop = min(positions[k] + block_size, len(keys))
+                stop = positions[k] + int(np.searchsorted(
+                    keys[positions[k]:stop], bound, side='right'))
+                key_blocks.append(np.asarray(keys[positions[k]:stop]))
+                count_blocks.append(np.asarray(counts[positions[k]:stop]))
+                positions[k] = stop
+            keys = np.concatenate(key_blocks)
+            counts = np.concatenate(count_blocks)
+            order = np.argsort(keys, kind='stable')
+            yield reduce_counts(keys[order], counts[order])
+
+    def arrays(self):
+        """
+        Return the arrays (counts, I, J) of the distinct pairs counted.  These
+        hold every distinct pair in memory at once; see `write_binary` and
+        `to_symmetric_csr` for ways to use the pairs that don't.
+        """
+        blocks = list(self.iter_blocks())
+        if not blocks:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty, empty
+        return tuple(np.concatenate(column) for column in zip(*blocks))
+
+    def write_binary(self, path, index_dtype=np.int32):
+        """
+        Write the distinct pairs counted to a binary pairlist at `path` (see
+        `write_binary_pairlist`), one merged block at a time.
+        """
+        write_binary_pairlist(
+            path,
+            ((I, J, counts) for counts, I, J in self.iter_blocks()),
+            index_dtype=index_dtype
+        )
+
+    def to_symmetric_csr(self, dtype=np.int64):
+        """
+        Convert the counts to a symmetric scipy.sparse.csr_matrix of `dtype`,
+        equivalent to `to_coo(symmetric=True)`, by streaming the merged blocks
+        straight into the matrix (see `symmetric_blocks_to_csr`).  Every pair
+        must have been counted as (i, j) with i <= j.
+        """
+        return symmetric_blocks_to_csr(
+            self.iter_blocks, self.shape, dtype=dtype)
+
+    def __len__(self):
+        return sum(len(keys) for keys, _ in self.merge_runs())
+
+    def close(self):
+        """Remove the runs written to disk."""
+        shutil.rmtree(self.run_dir, ignore_errors=True)
+        self.runs = []
+
+
+def symmetric_blocks_to_csr(make_blocks, shape, dtype=np.int64):
+    """
+    Build the symmetric scipy.sparse.csr_matrix of pair counts, like
+    `arrays_to_coo(..., symmetric=True)`, from blocks (counts, I, J) of
+    distinct pairs having I <= J, sorted by I then J, as yielded by
+    `ExternalPairCounter.iter_blocks`.  Raises ValueError for pairs having
+    I > J.
+
+    `make_blocks` is called twice, and must yield the same blocks each
+    time.  The first pass counts the entries of each row, so that the arrays
+    of the matrix are allocated once, and the second places each pair (i, j)
+    and its mirror (j, i) directly into them.  So only the matrix and one
+    block are held in memory at a time.  Because the pairs are sorted, the
+    mirrored entries of a row, whose columns are less than the row, all
+    arrive before the row's own pairs, and the columns of every row end up
+    sorted.  The matrix holds counts of the given `dtype`.
+    """
+    lengths = np.zeros(shape[0], dtype=np.int64)
+    for counts, I, J in make_blocks():
+        if np.any(I > J):
+            raise ValueError('Pairs must be given as (i, j) with i <= j.')
+        lengths += np.bincount(I, minlength=shape[0])
+        lengths += np.bincount(J[I != J], minlength=shape[0])
+    nnz = int(lengths.sum())
+    index_dtype = (
+        np.int32 if max(shape[1], nnz) <= np.iinfo(np.int32).max
+        else np.int64
+    )
+    indptr = np.concatenate(([0], np.cumsum(lengths))).astype(index_dtype)
+    indices = np.empty(nnz, dtype=index_dtype)
+    data = np.empty(nnz, dtype=dtype)
+    next_positions = indptr[:-1].astype(np.int64)
+
+    def place(rows, columns, values):
+        if len(rows) == 0:
+            return
+        order = np.argsort(rows, kind='stable')
+        rows = rows[order]
+        starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+        sizes = np.diff(np.r_[starts, len(rows)])
+        positions = (
+            next_positions[rows] + np.arange(len(rows))
+            - np.repeat(starts, sizes)
+        )
+        indices[positions] = columns[order]
+        data[positions] = values[order]
+        next_positions[rows[starts]] += sizes
+
+    for counts, I, J in make_blocks():
+        mirrored = I != J
+        place(J[mirrored], I[mirrored], counts[mirrored])
+        place(I, J, counts)
+
+    matrix = scipy.sparse.csr_matrix((data, indices, indptr), shape=shape)
+    matrix.has_sorted_indices = True
+    return matrix
+
+
+def merge_counts(keys1, counts1, keys2, counts2):
+    """
+    Merge two sets of sorted, distinct `keys` having associated `counts` into
+    one, adding the counts of keys found in both.
+    """
+    keys = np.concatenate((keys1, keys2))
+    counts = np.concatenate((counts1, counts2))
+    # A stable sort merges the two sorted runs in linear time.
+    order = np.argsort(keys, kind='stable')
+    return reduce_counts(keys[order], counts[order])
+
+
+def reduce_counts(keys, counts):
+    """
+    Given sorted `keys` with associated `counts`, return the distinct keys,
+    and the sum of counts for each.
+    """
+    if len(keys) == 0:
+        return keys, counts
+    ends = np.flatnonzero(np.r_[keys[1:] != keys[:-1], True])
+    totals = np.cumsum(counts)[ends]
+    return keys[ends], np.diff(totals, prepend=0)
@@ -0,0 +1,167 @@
+import os
+import gzip
+import json
+import time
+import collections
+import multiprocessing
+
+
+def read_jsonl(
+    paths, processes=None, chunk_size=2**22, prefetch=None, stats=None
+):
+    """
+    Yield the objects in the JSON-lines files at `paths`, in order, for
+    example to be passed to `d2v.ingestion.ingest`.  Files whose names end in
+    '.gz' are decompressed.  See `iter_jsonl_batches` for the arguments.
+    """
+    for batch in iter_jsonl_batches(
+        paths, processes=processes, chunk_size=chunk_size, prefetch=prefetch,
+        stats=stats
+    ):
+        yield from batch
+
+
+def iter_jsonl_batches(
+    paths, processes=None, chunk_size=2**22, prefetch=None, stats=None
+):
+    """
+    Yield lists of the objects in the JSON-lines files at `paths`, in order.
+
+    The files are split into chunks of about `chunk_size` bytes of lines
+    (see `iter_chunks`), and each chunk is parsed by one of a pool of
+    `processes` worker processes (by default, one per CPU).  An uncompressed
+    chunk is read and split into lines by its worker, which is only sent the
+    chunk's location.  Compressed files are decompressed as a stream in this
+    process, which sends each chunk of decompressed lines to a worker.  At
+    most `prefetch` chunks are being parsed at once, and the objects of each
+    chunk are yielded as one batch, in the order of the chunks.  So memory
+    use is bounded by about `prefetch` chunks, however large the files are
+    and however fast or slow the consumer is.
+
+    Inputs
+     - paths - iterable<str> - the files to read, in order.
+     - processes - int or None - the number of parsing processes.
+     - chunk_size - int - the number of bytes of (decompressed) lines parsed
+        by a worker at a time.
+     - prefetch - int or None - the number of chunks that may be parsed ahead
+        of the consumer.  By default, twice `processes`.
+     - stats - dict or None - if given, stats['reader'] is set to a dict
+        reporting: 'objects' and 'bytes' read (after decompression);
+        'seconds' elapsed; 'objects_per_second' and 'bytes_per_second'
+        throughput; and 'parse_stalls' and 'parse_stall_seconds', the number
+        of times and total time that the consumer waited for a parsed chunk.
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if prefetch is None:
+        prefetch = 2 * processes
+    chunks = iter_chunks(paths, chunk_size)
+
+    start = time.perf_counter()
+    num_objects = 0
+    num_bytes = 0
+    parse_stalls = 0
+    parse_stall_seconds = 0
+    pending = collections.deque()
+    try:
+        with multiprocessing.Pool(processes) as pool:
+            finished = False
+            while not finished or pending:
+
+                # Keep up to `prefetch` chunks being parsed.
+                while not finished and len(pending) < prefetch:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        finished = True
+                    else:
+                        pending.append(pool.apply_async(*chunk))
+                if not pending:
+                    break
+
+                result = pending.popleft()
+                if not result.ready():
+                    parse_stalls += 1
+                    stall_start = time.perf_counter()
+                    result.wait()
+                    parse_stall_seconds += time.perf_counter() - stall_start
+                batch, chunk_bytes = result.get()
+                num_objects += len(batch)
+                num_bytes += chunk_bytes
+                yield batch
+    finally:
+        if stats is not None:
+            seconds = time.perf_counter() - start
+            stats['reader'] = {
+                'objects': num_objects,
+                'bytes': num_bytes,
+                'seconds': seconds,
+                'objects_per_second': num_objects / seconds,
+                'bytes_per_second': num_bytes / seconds,
+                'parse_stalls': parse_stalls,
+                'parse_stall_seconds': parse_stall_seconds,
+            }
+
+
+def iter_chunks(paths, chunk_size):
+    """
+    Yield the chunks that the files at `paths` are parsed in, as tasks
+    `(function, args)` for a worker, each returning `(objects, num_bytes)`.
+    Uncompressed files are split into byte ranges of `chunk_size` bytes,
+    read by `parse_chunk`.  Compressed files are decompressed here, lazily,
+    and cut into chunks of whole lines of about `chunk_size` bytes, parsed
+    by `parse_raw_chunk`.  Raises FileNotFoundError for missing files when
+    they are reached.
+    """
+    for path in paths:
+        if path.endswith('.gz'):
+            with gzip.open(path, 'rb') as jsonl_file:
+                while True:
+                    raw_chunk = jsonl_file.read(chunk_size)
+                    if not raw_chunk:
+                        break
+                    # Finish the last line, so chunks hold whole lines.
+                    if not raw_chunk.endswith(b'\n'):
+                        raw_chunk += jsonl_file.readline()
+                    yield parse_raw_chunk, (raw_chunk,)
+            continue
+        size = os.path.getsize(path)
+        for chunk_start in range(0, size, chunk_size):
+            yield parse_chunk, (
+                path, chunk_start, min(chunk_start + chunk_size, size))
+
+
+def parse_raw_chunk(raw_chunk):
+    """
+    Parse the lines in the bytes `raw_chunk`.  Returns `(objects,
+    num_bytes)`, like `parse_chunk`.
+    """
+    return parse_batch(raw_chunk), len(raw_chunk)
+
+
+def parse_chunk(path, start, stop):
+    """
+    Read and parse the lines of a chunk of the uncompressed JSON-lines file
+    at `path`.  A chunk holds every line that starts within the byte range
+    [`start`, `stop`), so that chunks covering a file together hold each of
+    its lines once.  Returns `(objects, num_bytes)`, where `num_bytes` is the
+    number of bytes read.
+    """
+    with open(path, 'rb') as jsonl_file:
+        # Skip the rest of the line running into the chunk, which belongs to
+        # the chunk before.
+        if start > 0:
+            jsonl_file.seek(start - 1)
+            jsonl_file.readline()
+        position = jsonl_file.tell()
+        raw_chunk = jsonl_file.read(max(0, stop - position))
+        # Finish the last line, which can run into the next chunk.
+        if raw_chunk and not raw_chunk.endswith(b'\n'):
+            raw_chunk += jsonl_file.readline()
+    return parse_raw_chunk(raw_chunk)
+
+
+def parse_batch(raw_batch):
+    """Parse each non-blank line in the bytes `raw_batch` as JSON."""
+    return [
+        json.loads(line) for line in raw_batch.splitlines() if line.strip()
+    ]
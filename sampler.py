@@ -0,0 +1,176 @@
+import numpy as np
+from collections import defaultdict
+
+
+class AliasTable:
+    """
+    Samples indices with probability proportional to `weights` in constant
+    time per sample, by Vose's alias method.  Each of the n buckets holds its
+    own index with probability `prob[k]`, and `alias[k]` otherwise, so that
+    a sample is a uniform bucket and a biased coin flip.
+
+    The table is built without a Python loop.  Buckets with less than the
+    average weight ("small") are topped up, in order, from the excess of the
+    others ("large"), each large bucket giving to a run of small buckets
+    until it falls below the average itself, at which point it is topped up
+    by the next large bucket.  The large bucket that tops up each small one
+    is found by a binary search of the cumulative excess for the cumulative
+    shortfall.
+
+    Inputs
+     - weights - numpy.ndarray - non-negative weights, not all zero.
+    """
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=np.float64)
+        total = weights.sum()
+        if len(weights) == 0 or not total > 0:
+            raise ValueError('Weights must have a positive sum.')
+        scaled = weights * (len(weights) / total)
+        self.prob = np.ones(len(weights), dtype=np.float64)
+        self.alias = np.arange(len(weights), dtype=np.int64)
+
+        small = np.flatnonzero(scaled < 1)
+        large = np.flatnonzero(scaled >= 1)
+        if len(small) == 0:
+            return
+        shortfall = np.cumsum(1 - scaled[small])
+        excess = np.cumsum(scaled[large] - 1)
+
+        # A small bucket is topped up by the large bucket that still has
+        # excess when the small buckets before it have been topped up.
+        givers = np.searchsorted(excess, shortfall - (1 - scaled[small]))
+        # Rounding errors can leave the last buckets without a giver; they
+        # are left to hold themselves.
+        topped_up = givers < len(large)
+        self.prob[small[topped_up]] = scaled[small[topped_up]]
+        self.alias[small[topped_up]] = large[givers[topped_up]]
+
+        # A large bucket falls below the average once the shortfall exceeds
+        # the excess up to it, and is topped up by the next large bucket.
+        # The last never does, other than by rounding errors.
+        spent = np.searchsorted(shortfall, excess[:-1], side='right')
+        falls = spent < len(small)
+        falling = np.flatnonzero(falls)
+        self.prob[large[falling]] = (
+            1 + excess[falling] - shortfall[spent[falling]])
+        self.alias[large[falling]] = large[falling + 1]
+
+    def __len__(self):
+        return len(self.prob)
+
+    def sample(self, size, rng):
+        """
+        Sample an array of indices of the given `size` (an int or shape),
+        using the numpy.random.Generator `rng`.
+        """
+        buckets = rng.integers(0, len(self.prob), size=size)
+        keep = rng.random(size) < self.prob[buckets]
+        return np.where(keep, buckets, self.alias[buckets])
+
+
+class NegativeSampler:
+    """
+    Samples ids in proportion to their counts raised to `power`, separately
+    within each (type, field) namespace, as needed by sample-based training
+    algorithms (see README.md).  There is one `AliasTable` per namespace, so
+    sampling costs constant time per id, whatever the namespace's size.
+
+    Tables are built when first sampled from.  When counts change (see
+    `update`), only the tables of the namespaces whose counts changed are
+    rebuilt.
+
+    Inputs
+     - dictionary - d2v.dictionary.Dictionary or MappedDictionary - gives
+        the namespace of each id.
+     - counts - numpy.ndarray - the count of each id, like the 'counts.npy'
+        written by `d2v.ingestion.ingest` (see `d2v.model.Model.counts`).
+     - power - float - exponent applied to counts.  The default, 0.75,
+        flattens the distribution, sampling rare ids more often.
+     - seed - int or None - seed for sampling.
+    """
+    def __init__(self, dictionary, counts, power=0.75, seed=None):
+        self.power = power
+        self.rng = np.random.default_rng(seed)
+        self.counts = np.zeros(0, dtype=np.float64)
+        self.namespace_index = np.zeros(0, dtype=np.int64)
+        self.namespaces = []
+        self.namespace_ids = {}
+        self.tables = {}
+        self.update(dictionary, counts)
+
+    def update(self, dictionary, counts):
+        """
+        Replace the counts by `counts`, which covers every id of
+        `dictionary`, including ids added since the sampler was created (for
+        example by `d2v.ingestion.ingest_incremental`).  Returns the set of
+        namespaces whose tables will be rebuilt.
+        """
+        counts = np.asarray(counts, dtype=np.float64)
+        if len(counts) != len(dictionary):
+            raise ValueError(
+                'Expected {} counts, got {}.'
+                .format(len(dictionary), len(counts))
+            )
+        num_known = len(self.counts)
+        if len(counts) < num_known:
+            raise ValueError('Ids cannot be removed from a sampler.')
+
+        # Assign new ids to their namespaces.
+        new_ids = defaultdict(list)
+        for index in range(num_known, len(counts)):
+            new_ids[dictionary.namespace(index)].append(index)
+        namespace_index = np.empty(len(counts) - num_known, dtype=np.int64)
+        for namespace, ids in new_ids.items():
+            if namespace not in self.namespace_ids:
+                self.namespace_ids[namespace] = np.zeros(0, dtype=np.int64)
+                self.namespaces.append(namespace)
+            self.namespace_ids[namespace] = np.concatenate(
+                [self.namespace_ids[namespace], ids])
+            namespace_index[np.array(ids) - num_known] = (
+                self.namespaces.index(namespace))
+        self.namespace_index = np.concatenate(
+            [self.namespace_index, namespace_index])
+
+        changed = np.flatnonzero(counts[:num_known] != self.counts)
+        stale = {
+            self.namespaces[index]
+            for index in np.unique(self.namespace_index[changed])
+        }
+        stale.update(new_ids)
+        for namespace in stale:
+            self.tables.pop(namespace, None)
+        self.counts = counts
+        return stale
+
+    def table(self, namespace):
+        """The AliasTable of `namespace`, built if it is missing."""
+        if namespace not in self.tables:
+            ids = self.namespace_ids[namespace]
+            self.tables[namespace] = AliasTable(
+                np.power(self.counts[ids], self.power))
+        return self.tables[namespace]
+
+    def sample(self, namespace, size):
+        """
+        Sample an array of ids of the (type, field) `namespace`, of the given
+        `size` (an int or shape).  Raises ValueError if none of its ids have
+        been counted.
+        """
+        if namespace not in self.namespace_ids:
+            raise ValueError('Unknown namespace: {}.'.format(namespace))
+        table = self.table(namespace)
+        return self.namespace_ids[namespace][table.sample(size, self.rng)]
+
+    def sample_like(self, ids, num_samples):
+        """
+        Sample `num_samples` ids from the namespace of each of `ids`.
+        Returns an array of shape `(len(ids), num_samples)`.
+        """
+        ids = np.asarray(ids)
+        samples = np.empty((len(ids), num_samples), dtype=np.int64)
+        namespace_index = self.namespace_index[ids]
+        for index in np.unique(namespace_index):
+            rows = np.flatnonzero(namespace_index == index)
+            samples[rows] = self.sample(
+                self.namespaces[index], (len(rows), num_samples))
+        return samples
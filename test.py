@@ -7,6 +7,8 @@ import d2v
 import shutil
 import itertools as it
 import json
+import zlib
+import gzip
 
 
 class TestD2vId(TestCase):
@@ -163,6 +165,24 @@ class TestD2vId(TestCase):
             d2v.d2v_id.validate_type('')
 
 
+    def test_validate_object(self):
+        d2v.d2v_id.validate_object(
+            {'d2v-id': 'profile,,1', 'title': 'AI', 'a,b': [{'$ref': 'x,,1'}]})
+        with self.assertRaises(ValueError):
+            d2v.d2v_id.validate_object({'d2v-id': 'profile,,1', 'a,b': 'AI'})
+        with self.assertRaises(ValueError):
+            d2v.d2v_id.validate_object({'d2v-id': 'pro\tfile,,1'})
+
+        # Invalid contexts are never cached as valid.
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                d2v.d2v_id.validate_context('profile', 'a,b')
+            with self.assertRaises(ValueError):
+                d2v.d2v_id.validate_context(['profile'], 'title')
+        with self.assertRaises(ValueError):
+            d2v.d2v_id.get_child_ids({'d2v-id': 'profile,,1', 'a\tb': 1})
+
+
     def test_is_primitive(self):
         self.assertTrue(d2v.d2v_id.is_primitive('profile,title,aws'))
         self.assertFalse(d2v.d2v_id.is_primitive('skill,,1'))
@@ -187,6 +207,40 @@ class TestD2vId(TestCase):
         self.assertEqual(pair, expected_pair)
 
 
+    def test_interner(self):
+        interner = d2v.d2v_id.Interner()
+        code1 = interner.intern('profile', 'title', 'ai')
+        code2 = interner.intern_value('profile', 'title', 'ai')
+        code3 = interner.intern_value('profile', 'skills', {'$ref': 'skill,,1'})
+        code4 = interner.intern_id('profile,title,research')
+        self.assertEqual(code1, code2)
+        self.assertEqual(len({code1, code3, code4}), 3)
+
+        # The namespace is shared by ids in the same type and field.
+        self.assertEqual(
+            code1 >> interner.NAME_BITS, code4 >> interner.NAME_BITS)
+        self.assertEqual(interner.split(code3), ('skill', None, '1'))
+        self.assertEqual(interner.namespace(code1), ('profile', 'title'))
+        self.assertEqual(interner.to_string(code1), 'profile,title,ai')
+        self.assertEqual(interner.to_string(code3), 'skill,,1')
+        self.assertTrue(interner.is_primitive(code1))
+        self.assertFalse(interner.is_primitive(code3))
+
+        # Validation still applies.
+        with self.assertRaises(ValueError):
+            interner.intern_value('profile', 'ti,tle', 'ai')
+        with self.assertRaisesRegex(ValueError, 'skill1'):
+            interner.intern_value('profile', 'skills', {'$ref': 'skill1'})
+
+        # Child ids can be given as codes.
+        obj = {'d2v-id': 'skill,,1', 'name': 'Deep Learning'}
+        codes = d2v.d2v_id.get_child_ids(obj, interner)
+        self.assertEqual(
+            [interner.to_string(code) for code in codes],
+            d2v.d2v_id.get_child_ids(obj)
+        )
+
+
     def test_as_list(self):
         """
         `as_list` should convert all values into lists.
@@ -330,6 +384,61 @@ class TestGraph(TestCase):
 
 
 
+    def test_expand_csr(self):
+        """
+        The expanded graph calculated from the graph's adjacency matrix
+        matches the one obtained by listing descendents.
+        """
+        graph = {
+            0: [3, 4, 4, 1], 1: [5, 3, 6, 6, 6], 2: [1, 1, 7, 0], 8: [9],
+            10: []
+        }
+        shape = (11, 11)
+        _, expanded_graph = d2v.ingestion.make_pairs_and_expanded_graph(graph)
+        expected = d2v.graph.graph_to_csr(expanded_graph, shape=shape)
+
+        adjacency = d2v.graph.graph_to_csr(graph, shape=shape)
+        found = d2v.graph.expand_csr(adjacency, graph)
+        self.assertEqual(found.shape, shape)
+        self.assertTrue(np.array_equal(found.todense(), expected.todense()))
+
+        # Cycles of references are an error.
+        graph = {0: [1, 5], 1: [2], 2: [0, 6]}
+        adjacency = d2v.graph.graph_to_csr(graph, shape=(7, 7))
+        with self.assertRaises(ValueError):
+            d2v.graph.expand_csr(adjacency, graph)
+
+
+    def test_graph_builder(self):
+        graph = {5: [3, 4, 4, 1], 1: [0, 3], 2: [], 0: [6, 6, 6]}
+        builder = d2v.graph.GraphBuilder(index_dtype=np.int32)
+        builder[5] = [9, 9]
+        for parent, children in graph.items():
+            builder.add(parent, children)
+
+        # The last children given for a parent win.
+        self.assertEqual(builder, graph)
+        self.assertEqual(list(builder), [5, 1, 2, 0])
+        self.assertEqual(builder[5], [3, 4, 4, 1])
+        self.assertNotIn(3, builder)
+
+        dense = np.zeros((7, 7), dtype=int)
+        for parent, children in graph.items():
+            for child in children:
+                dense[parent, child] += 1
+        for dtype in (bool, np.int32, float):
+            found = builder.to_csr(shape=(7, 7), dtype=dtype)
+            self.assertEqual(found.dtype, dtype)
+            self.assertTrue(np.array_equal(
+                found.toarray(), dense.astype(dtype)))
+
+        # Without a shape, the matrix just holds every index.
+        self.assertEqual(builder.to_csr().shape, (6, 7))
+        self.assertTrue(np.array_equal(
+            d2v.graph.graph_to_csr(graph).toarray(), dense[:6]))
+
+
+
 class TestIngest(TestCase):
 
 
@@ -359,9 +468,13 @@ class TestIngest(TestCase):
 
         # Check that pairs were recorded correctly as list.
         # (Equality is only up to number of occurrences, not ordering.)
-        pair_path = os.path.join(path, 'pairs.tsv')
-        pair_list = list(d2v.pairlist.read_pairlist(pair_path))
-        self.assertEqual(Counter(pair_list), Counter(TestData.pair_list()))
+        pair_path = os.path.join(path, 'pairs.bin')
+        pair_list = d2v.pairlist.iter_block_pairs(
+            d2v.pairlist.read_binary_pairlist(pair_path))
+        self.assertEqual(
+            Counter(pair_list),
+            Counter(tuple(sorted(pair)) for pair in TestData.pair_list())
+        )
 
         # Check that pairs were recorded correctly as a sparse matrix
         pair_adjacency_path = os.path.join(path, 'pairs.npz')
@@ -383,6 +496,616 @@ class TestIngest(TestCase):
         ))
 
 
+    def test_ingest_pair_counting(self):
+        """
+        All pair counting modes should write the same results.
+        """
+        paths = {}
+        modes = ['list', 'stream', 'vectorized', 'external', 'gram']
+        for pair_counting in modes:
+            path = os.path.join(
+                d2v.CONSTANTS.TEST_DIR, 'test-ingest-' + pair_counting)
+            ensure_dir(path)
+            d2v.ingestion.ingest(
+                sample_objects(), path, pair_counting=pair_counting)
+            paths[pair_counting] = path
+
+        expected_path = paths.pop('list')
+        expected = scipy.sparse.load_npz(
+            os.path.join(expected_path, 'pairs.npz'))
+        self.assertEqual(expected.dtype, np.float64)
+        for path in paths.values():
+            assert_same_ingestion(self, path, expected_path)
+            found = scipy.sparse.load_npz(os.path.join(path, 'pairs.npz'))
+            self.assertEqual(found.format, expected.format)
+            self.assertEqual(found.dtype, expected.dtype)
+
+        with self.assertRaises(ValueError):
+            d2v.ingestion.ingest(sample_objects(), None, pair_counting='nope')
+
+
+    def test_ingest_validation(self):
+        objects = sample_objects() + [{'d2v-id': 'skill,,5', 'a,b': 'bad'}]
+
+        stats = {}
+        with self.assertRaises(ValueError):
+            d2v.ingestion.ingest(objects, None, stats=stats)
+
+        # Trusted ingestion only validates a sample of objects.
+        d2v.ingestion.ingest(
+            objects, None, validation='trusted', validation_sample=2,
+            stats=stats
+        )
+        self.assertEqual(stats['validated_objects'], 2)
+        self.assertGreaterEqual(stats['validation_seconds'], 0)
+
+        with self.assertRaises(ValueError):
+            d2v.ingestion.ingest(
+                objects, None, validation='trusted',
+                validation_sample=len(objects)
+            )
+
+
+    def test_ingest_stats(self):
+        path = os.path.join(d2v.CONSTANTS.TEST_DIR, 'test-ingest-stats')
+        ensure_dir(path)
+        stats = {}
+        d2v.ingestion.ingest(
+            sample_objects(), path, pair_counting='stream', stats=stats)
+        stages = [
+            'assign_ids', 'graph_to_csr', 'pair_generation',
+            'pairlist_to_coo', 'expanded_graph_to_csr', 'write_dictionary',
+            'save_graph', 'write_pairlist', 'save_pairs',
+            'save_expanded_graph', 'save_counts', 'save_parents'
+        ]
+        # Artifacts are written in the background, in no particular order.
+        self.assertEqual(set(stats['seconds']), set(stages))
+        self.assertEqual(set(stats['peak_rss']), set(stages))
+        self.assertTrue(all(rss > 0 for rss in stats['peak_rss'].values()))
+
+
+    def test_ingest_prune(self):
+        """
+        Pruned ids are dropped as if they had never occurred, or replaced by
+        the <unk> id of their namespace.
+        """
+        expected_objects = sample_objects()
+        expected_objects[1]['title'] = 'for'
+        expected_objects[2]['title'] = 'for'
+        expected_path = os.path.join(d2v.CONSTANTS.TEST_DIR, 'test-ingest')
+        ensure_dir(expected_path)
+        d2v.ingestion.ingest(expected_objects, expected_path)
+
+        path = os.path.join(d2v.CONSTANTS.TEST_DIR, 'test-ingest-prune')
+        ensure_dir(path)
+        stats = {}
+        d2v.ingestion.ingest(
+            sample_objects(), path, min_count={('profile', 'title'): 2},
+            stats=stats
+        )
+        assert_same_ingestion(self, path, expected_path)
+        self.assertEqual(stats['pruned_ids'], 9)
+
+        # Pruned models can't be updated, since ids that were pruned might
+        # no longer be.
+        with self.assertRaises(ValueError):
+            d2v.ingestion.ingest_incremental(
+                [{'d2v-id': 'profile,,3', 'title': 'for'}], path)
+        clear_path(path)
+        clear_path(expected_path)
+
+        for intern_ids in (False, True):
+            graph, dictionary = d2v.ingestion.ingest(
+                sample_objects(), None, max_vocab=1, unk=True,
+                intern_ids=intern_ids
+            )
+            keys = list(d2v.dictionary.iter_key_strings(dictionary))
+            self.assertEqual(
+                [key for key in keys if d2v.d2v_id.is_primitive(key)], [
+                    'profile,title,<unk>', 'profile,title,for',
+                    'profile,years,5', 'skill,name,orchestration',
+                    'skill,category,<unk>', 'skill,name,<unk>',
+                    'skill,category,dev'
+                ]
+            )
+            profile = keys.index('profile,,2')
+            self.assertEqual(
+                [keys[index] for index in graph[profile]],
+                ['profile,title,<unk>'] * 2 + ['profile,title,for']
+                + ['profile,title,<unk>'] * 3
+                + ['skill,,2', 'skill,,3', 'profile,years,5']
+            )
+
+
+    def test_ingest_hashing(self):
+        hasher = d2v.d2v_id.FeatureHasher(4, [('profile', 'title')])
+        stats = {}
+        graph, dictionary = d2v.ingestion.ingest(
+            sample_objects(), None, hasher=hasher, stats=stats)
+
+        # Only the hashed namespace is affected, and it has at most 4 ids.
+        keys = [key for key in dictionary.keys if ',title,' in key]
+        self.assertLessEqual(len(keys), 4)
+        self.assertTrue(all(
+            key.split(',')[2] in {'#0', '#1', '#2', '#3'} for key in keys))
+        self.assertIn('skill,name,jenkins', dictionary)
+        self.assertIn('profile,,1', dictionary)
+
+        # Values land in stable buckets.
+        self.assertEqual(
+            hasher.hash_values('profile', 'title', ['for', {'$ref': 'x,,1'}]),
+            ['#{}'.format(zlib.crc32(b'for') % 4), {'$ref': 'x,,1'}]
+        )
+
+        # 10 distinct titles in 4 buckets must collide.
+        collisions = stats['hash_collisions'][('profile', 'title')]
+        self.assertEqual(collisions['values'], 11)
+        self.assertEqual(collisions['buckets_used'], len(keys))
+        self.assertGreaterEqual(collisions['collisions'], 10 - len(keys))
+
+        # Incremental updates hash values into the same buckets, as if all
+        # objects had been ingested together.
+        path = os.path.join(d2v.CONSTANTS.TEST_DIR, 'test-ingest-hashing')
+        ensure_dir(path)
+        d2v.ingestion.ingest(
+            sample_objects(), path,
+            hasher=d2v.d2v_id.FeatureHasher(4, [('profile', 'title')])
+        )
+        update = {'d2v-id': 'profile,,3', 'title': 'Quantum computing'}
+        d2v.ingestion.ingest_incremental([update], path)
+        expected_path = os.path.join(d2v.CONSTANTS.TEST_DIR, 'test-ingest')
+        ensure_dir(expected_path)
+        d2v.ingestion.ingest(
+            sample_objects() + [update], expected_path,
+            hasher=d2v.d2v_id.FeatureHasher(4, [('profile', 'title')])
+        )
+        assert_same_ingestion(self, path, expected_path)
+        clear_path(path)
+        clear_path(expected_path)
+
+
+    def test_ingest_weights(self):
+        """
+        Weighted objects and decay give float pair counts, accumulated from
+        the weighted occurrences of each object's descendents.
+        """
+        objects = [
+            {
+                'd2v-id': 'doc,,a', 'd2v-weight': 2, 'text': 'x y',
+                'refs': [{'$ref': 'doc,,b'}]
+            },
+            {'d2v-id': 'doc,,b', 'rating': 0.5, 'text': 'x'},
+        ]
+        path = os.path.join(d2v.CONSTANTS.TEST_DIR, 'test-ingest-weights')
+        ensure_dir(path)
+        graph, dictionary = d2v.ingestion.ingest(
+            objects, path, pair_counting='gram',
+            weight_fields=[('doc', 'rating')], decay=0.5
+        )
+        self.assertNotIn('doc,rating,0.5', dictionary)
+        a, b, x, y = dictionary.get_many(
+            ['doc,,a', 'doc,,b', 'doc,text,x', 'doc,text,y'])
+
+        # Row a holds a itself, x twice (at distances 1 and 2), y and b; row
+        # b holds b itself and x.
+        expanded = scipy.sparse.load_npz(
+            os.path.join(path, 'expanded-graph.npz')).toarray()
+        self.assertEqual(expanded[a, a], 1)
+        self.assertEqual(expanded[a, x], 0.75)
+        self.assertEqual(expanded[a, y], 0.5)
+        self.assertEqual(expanded[a, b], 0.5)
+        self.assertEqual(expanded[b, x], 0.5)
+
+        pairs = scipy.sparse.load_npz(
+            os.path.join(path, 'pairs.npz')).toarray()
+        expected = np.zeros_like(pairs)
+        for i, j, count in [
+            (a, x, 2 * 0.75), (a, y, 2 * 0.5), (a, b, 2 * 0.5),
+            (x, y, 2 * 0.75 * 0.5), (y, b, 2 * 0.5 * 0.5),
+            (x, x, 2 * 0.5 * 0.25), (x, b, 2 * 0.75 * 0.5 + 0.5 * 0.5)
+        ]:
+            expected[i, j] = expected[j, i] = count
+        np.testing.assert_allclose(pairs, expected)
+
+        # The binary pairlist keeps the float counts.
+        found = {}
+        for I, J, counts in d2v.pairlist.read_binary_pairlist(
+            os.path.join(path, 'pairs.bin')
+        ):
+            self.assertEqual(counts.dtype, np.float64)
+            found.update(zip(zip(I.tolist(), J.tolist()), counts.tolist()))
+        self.assertEqual(found[min(x, y), max(x, y)], 0.75)
+        self.assertEqual(found[x, x], 0.25)
+
+        # Weighted counts stay floats when they are all whole numbers, however
+        # they are ingested or rewritten.
+        whole_objects = [
+            dict(obj, **{'d2v-weight': 2}) for obj in sample_objects()]
+        parallel_path = os.path.join(
+            d2v.CONSTANTS.TEST_DIR, 'test-ingest-weights-parallel')
+        ensure_dir(parallel_path)
+        d2v.ingestion.ingest(whole_objects, path, pair_counting='gram')
+        d2v.ingestion.ingest_parallel(
+            whole_objects, parallel_path, processes=2, shard_size=2)
+        d2v.model.relayout_model(parallel_path)
+        for model_path in [path, parallel_path]:
+            pair_path = os.path.join(model_path, 'pairs.bin')
+            self.assertTrue(d2v.pairlist.is_weighted_pairlist(pair_path))
+            for I, J, counts in d2v.pairlist.read_binary_pairlist(pair_path):
+                self.assertEqual(counts.dtype, np.float64)
+                self.assertTrue(np.array_equal(counts, np.round(counts)))
+        clear_path(parallel_path)
+
+        # Other pair counting modes are unweighted.
+        with self.assertRaises(ValueError):
+            d2v.ingestion.ingest(objects, None, pair_counting='vectorized',
+                weight_fields=[('doc', 'rating')])
+        with self.assertRaises(ValueError):
+            d2v.ingestion.ingest(objects, None, decay=0)
+
+        # Weighted models can't be updated incrementally, and are left as
+        # they were.
+        for kwargs in [{'decay': 0.5}, {'weight_fields': [('doc', 'rating')]}]:
+            ensure_dir(path)
+            d2v.ingestion.ingest(
+                objects, path, pair_counting='gram', **kwargs)
+            expanded = scipy.sparse.load_npz(
+                os.path.join(path, 'expanded-graph.npz'))
+            with self.assertRaises(ValueError):
+                d2v.ingestion.ingest_incremental(
+                    [{'d2v-id': 'doc,,c', 'text': 'x z'}], path)
+            self.assertEqual(
+                (scipy.sparse.load_npz(
+                    os.path.join(path, 'expanded-graph.npz')) != expanded
+                ).nnz,
+                0
+            )
+
+        # Weights of 1 give the usual counts.
+        unweighted_path = os.path.join(
+            d2v.CONSTANTS.TEST_DIR, 'test-ingest-unweighted')
+        ensure_dir(unweighted_path)
+        d2v.ingestion.ingest(
+            [dict(obj, **{'d2v-weight': 1}) for obj in sample_objects()],
+            unweighted_path
+        )
+        expected_path = os.path.join(d2v.CONSTANTS.TEST_DIR, 'test-ingest')
+        ensure_dir(expected_path)
+        d2v.ingestion.ingest(sample_objects(), expected_path)
+        assert_same_ingestion(self, unweighted_path, expected_path)
+        clear_path(path)
+        clear_path(unweighted_path)
+        clear_path(expected_path)
+
+
+    def test_ingest_outputs(self):
+        """
+        Only the chosen outputs are calculated and written, with the same
+        contents as when everything is written.
+        """
+        expected_path = os.path.join(d2v.CONSTANTS.TEST_DIR, 'test-ingest')
+        ensure_dir(expected_path)
+        d2v.ingestion.ingest(sample_objects(), expected_path)
+
+        for outputs, stages in [
+            (['pairs.npz'],
+                {'save_pairs', 'pair_generation', 'expand_graph'}),
+            (['expanded-graph.npz', 'graph.npz'],
+                {'save_expanded_graph', 'expand_graph', 'save_graph'}),
+        ]:
+            path = os.path.join(d2v.CONSTANTS.TEST_DIR, 'test-ingest-outputs')
+            ensure_dir(path)
+            stats = {}
+            d2v.ingestion.ingest(
+                sample_objects(), path, pair_counting='gram',
+                outputs=outputs, compressed=False, stats=stats
+            )
+            self.assertEqual(sorted(os.listdir(path)), sorted(outputs))
+            self.assertEqual(
+                set(stats['seconds']) - {'assign_ids', 'graph_to_csr'},
+                stages
+            )
+            for name in outputs:
+                found = scipy.sparse.load_npz(os.path.join(path, name))
+                expected = scipy.sparse.load_npz(
+                    os.path.join(expected_path, name))
+                self.assertTrue(np.array_equal(
+                    found.todense(), expected.todense()))
+
+        # Nothing but the graph and dictionary is calculated without a path.
+        stats = {}
+        d2v.ingestion.ingest(sample_objects(), None, stats=stats)
+        self.assertEqual(set(stats['seconds']), {'assign_ids'})
+
+        with self.assertRaises(ValueError):
+            d2v.ingestion.ingest(sample_objects(), path, outputs=['pairs.tsv'])
+
+
+    def test_ingest_intern_ids(self):
+        """
+        Interning ids doesn't change the results.
+        """
+        expected_path = os.path.join(d2v.CONSTANTS.TEST_DIR, 'test-ingest')
+        ensure_dir(expected_path)
+        expected_graph, expected_dictionary = d2v.ingestion.ingest(
+            sample_objects(), expected_path)
+
+        path = os.path.join(d2v.CONSTANTS.TEST_DIR, 'test-ingest-interned')
+        ensure_dir(path)
+        graph, dictionary = d2v.ingestion.ingest(
+            sample_objects(), path, intern_ids=True)
+
+        self.assertEqual(graph, expected_graph)
+        self.assertEqual(
+            list(d2v.dictionary.iter_key_strings(dictionary)),
+            expected_dictionary.keys
+        )
+        assert_same_ingestion(self, path, expected_path)
+
+
+    def test_ingest_parallel(self):
+        """
+        Parallel ingestion writes the same results as serial ingestion.
+        """
+        expected_path = os.path.join(d2v.CONSTANTS.TEST_DIR, 'test-ingest')
+        ensure_dir(expected_path)
+        expected_graph, expected_dictionary = d2v.ingestion.ingest(
+            sample_objects(), expected_path)
+
+        path = os.path.join(d2v.CONSTANTS.TEST_DIR, 'test-ingest-parallel')
+        ensure_dir(path)
+        graph, dictionary = d2v.ingestion.ingest_parallel(
+            iter(sample_objects()), path, processes=2, shard_size=2)
+
+        self.assertEqual(graph, expected_graph)
+        self.assertEqual(dictionary.keys, expected_dictionary.keys)
+        assert_same_ingestion(self, path, expected_path)
+
+        # Weighted objects and decay are counted as by `ingest`.
+        objects = [
+            dict(obj, **{'d2v-weight': 2}) if i % 2 else obj
+            for i, obj in enumerate(sample_objects())
+        ]
+        for i, obj in enumerate(objects):
+            if obj['d2v-id'].startswith('skill'):
+                obj['level'] = i
+        for kwargs in [
+            {'decay': 0.5}, {'weight_fields': [('skill', 'level')]}
+        ]:
+            ensure_dir(expected_path)
+            d2v.ingestion.ingest(
+                objects, expected_path, pair_counting='gram', **kwargs)
+            ensure_dir(path)
+            d2v.ingestion.ingest_parallel(
+                iter(objects), path, processes=2, shard_size=2, **kwargs)
+            assert_same_ingestion(self, path, expected_path)
+        with self.assertRaises(ValueError):
+            d2v.ingestion.ingest_parallel(objects, None, decay=0)
+        clear_path(path)
+        clear_path(expected_path)
+
+
+    def test_ingest_incremental(self):
+        """
+        Ingesting objects incrementally, including updates to objects that
+        were already ingested, writes the same results as ingesting the
+        final versions of all objects at once.
+        """
+        objects = sample_objects()
+        updates = [
+            # A new object, referencing an existing one.
+            {'d2v-id': 'joblist,,2', 'profiles': [{'$ref': 'profile,,2'}]},
+            # Changes to objects referenced by others.
+            {'d2v-id': 'skill,,2', 'name': 'jenkins ci', 'level': 3},
+            {
+                'd2v-id': 'profile,,2', 'title': 'Deep learning developer',
+                'skills': [{'$ref': 'skill,,3'}] * 2 + [{'$ref': 'skill,,4'}]
+            },
+            # Defines an object that was only referenced so far.
+            {'d2v-id': 'skill,,4', 'name': 'python'},
+        ]
+        objects.append({
+            'd2v-id': 'team,,1',
+            'members': [{'$ref': 'profile,,2'}, {'$ref': 'profile,,2'}],
+            'lead': {'$ref': 'profile,,1'},
+            'skills': {'$ref': 'skill,,4'}
+        })
+
+        path = os.path.join(d2v.CONSTANTS.TEST_DIR, 'test-ingest-incremental')
+        ensure_dir(path)
+        d2v.ingestion.ingest(objects, path)
+        d2v.ingestion.ingest_incremental(updates[:2], path)
+        d2v.ingestion.ingest_incremental(updates[2:], path)
+
+        # Ingest the final version of every object, keeping the order in
+        # which their ids first appeared.
+        final = {obj['d2v-id']: obj for obj in objects + updates}
+        expected_path = os.path.join(d2v.CONSTANTS.TEST_DIR, 'test-ingest')
+        ensure_dir(expected_path)
+        d2v.ingestion.ingest(list(final.values()), expected_path)
+
+        found_dictionary = d2v.dictionary.read_dictionary(
+            os.path.join(path, 'dictionary.txt'))
+        expected_dictionary = d2v.dictionary.read_dictionary(
+            os.path.join(expected_path, 'dictionary.txt'))
+
+        # Ids can be ordered differently, and the incremental dictionary also
+        # keeps ids that are no longer used.
+        self.assertTrue(
+            set(expected_dictionary.keys) <= set(found_dictionary.keys))
+        permutation = found_dictionary.get_many(expected_dictionary.keys)
+        for name in [
+            'graph.npz', 'pairs.npz', 'expanded-graph.npz', 'parents.npz'
+        ]:
+            found = scipy.sparse.load_npz(os.path.join(path, name)).tocsr()
+            expected = scipy.sparse.load_npz(os.path.join(expected_path, name))
+            self.assertEqual(found.sum(), expected.sum())
+            found = found[permutation][:, permutation]
+            self.assertTrue(np.array_equal(
+                found.todense(), expected.todense()), name)
+        found = np.load(os.path.join(path, 'counts.npy'))
+        expected = np.load(os.path.join(expected_path, 'counts.npy'))
+        self.assertEqual(found.sum(), expected.sum())
+        self.assertTrue(np.array_equal(found[permutation], expected))
+
+
+    def test_id_counts(self):
+        """
+        Ids are counted each time they occur in an object, by every way of
+        ingesting, and when the counts are recovered from the graphs.
+        """
+        objects = [
+            {
+                'd2v-id': 'doc,,a', 'text': 'x y x',
+                'refs': [{'$ref': 'doc,,b'}, {'$ref': 'doc,,b'}]
+            },
+            {'d2v-id': 'doc,,b', 'text': 'x', 'refs': [{'$ref': 'doc,,c'}]},
+        ]
+        path = os.path.join(d2v.CONSTANTS.TEST_DIR, 'test-id-counts')
+        ensure_dir(path)
+        graph, dictionary = d2v.ingestion.ingest(objects, path)
+        counts = np.load(os.path.join(path, 'counts.npy'))
+        expected = {'doc,text,x': 3, 'doc,text,y': 1, 'doc,,b': 2, 'doc,,c': 1}
+        self.assertEqual(
+            {key: counts[dictionary[key]] for key in expected}, expected)
+        self.assertEqual(counts.sum(), sum(expected.values()))
+
+        parallel_path = os.path.join(
+            d2v.CONSTANTS.TEST_DIR, 'test-id-counts-parallel')
+        ensure_dir(parallel_path)
+        d2v.ingestion.ingest_parallel(
+            objects, parallel_path, processes=2, shard_size=1)
+        self.assertTrue(np.array_equal(
+            np.load(os.path.join(parallel_path, 'counts.npy')), counts))
+
+        # Without counts.npy, the model recovers them from the graphs.
+        os.remove(os.path.join(path, 'counts.npy'))
+        with d2v.model.Model(path) as model:
+            self.assertTrue(np.array_equal(model.counts, counts))
+
+        # Incremental updates replace the occurrences of updated objects,
+        # also when the model has no counts.npy.
+        update = {'d2v-id': 'doc,,a', 'text': 'y y', 'refs': {'$ref': 'doc,,c'}}
+        d2v.ingestion.ingest_incremental([update], path)
+        counts = np.load(os.path.join(path, 'counts.npy'))
+        expected = {
+            'doc,text,x': 1, 'doc,text,y': 2, 'doc,,b': 0, 'doc,,c': 2}
+        self.assertEqual(
+            {key: counts[dictionary[key]] for key in expected}, expected)
+        self.assertEqual(counts.sum(), sum(expected.values()))
+        update = {'d2v-id': 'doc,,b', 'text': 'x x z'}
+        d2v.ingestion.ingest_incremental([update], path)
+        dictionary = d2v.dictionary.read_dictionary(
+            os.path.join(path, 'dictionary.txt'))
+        counts = np.load(os.path.join(path, 'counts.npy'))
+        expected = {
+            'doc,text,x': 2, 'doc,text,y': 2, 'doc,text,z': 1, 'doc,,c': 1}
+        self.assertEqual(
+            {key: counts[dictionary[key]] for key in expected}, expected)
+        self.assertEqual(counts.sum(), sum(expected.values()))
+        clear_path(path)
+        clear_path(parallel_path)
+
+
+    def test_ingest_incremental_empty(self):
+        """An empty batch of objects leaves the model untouched."""
+        path = os.path.join(
+            d2v.CONSTANTS.TEST_DIR, 'test-ingest-incremental-empty')
+        ensure_dir(path)
+        d2v.ingestion.ingest(sample_objects(), path)
+
+        def read_artifacts():
+            artifacts = {}
+            for name in os.listdir(path):
+                with open(os.path.join(path, name), 'rb') as artifact_file:
+                    artifacts[name] = artifact_file.read()
+            return artifacts
+
+        expected = read_artifacts()
+        graph, dictionary = d2v.ingestion.ingest_incremental([], path)
+        self.assertEqual(len(graph), 0)
+        self.assertEqual(
+            dictionary, d2v.dictionary.read_dictionary(
+                os.path.join(path, 'dictionary.txt')))
+        self.assertEqual(read_artifacts(), expected)
+        clear_path(path)
+
+
+    def test_count_rows_pairs_delta(self):
+        """
+        The change in pair counts when rows of the expanded graph change is
+        the difference between the pairs counted in the new and old rows.
+        """
+        shape = (6, 6)
+        old_rows = scipy.sparse.csr_matrix(np.array([
+            [1, 2, 0, 1, 0, 0],
+            [0, 1, 3, 0, 0, 1],
+            [1, 0, 0, 0, 0, 0],
+        ]))
+        new_rows = scipy.sparse.csr_matrix(np.array([
+            [1, 2, 0, 1, 0, 0],
+            [2, 1, 1, 0, 4, 1],
+            [0, 0, 0, 0, 0, 0],
+        ]))
+
+        def count(rows):
+            counter = d2v.pairlist.PairCounter(shape)
+            d2v.ingestion.count_pairs_vectorized(rows, counter)
+            return counter.to_coo(symmetric=True).toarray()
+
+        delta = d2v.ingestion.count_rows_pairs_delta(
+            old_rows, new_rows, shape)
+        self.assertTrue(np.array_equal(
+            delta.toarray(), count(new_rows) - count(old_rows)))
+
+
+    def test_count_pairs_vectorized(self):
+        """
+        Vectorized counting agrees with counting the listed pairs, including
+        for children that occur multiple times within an object.
+        """
+        graph = {
+            0: [3, 4, 4, 1], 1: [5, 3, 6, 6, 6], 2: [1, 1, 7], 8: [9]
+        }
+        shape = (10, 10)
+        pairs, expanded_graph = d2v.ingestion.make_pairs_and_expanded_graph(
+            graph)
+        expanded_graph_adjacency = d2v.graph.graph_to_csr(
+            expanded_graph, shape=shape)
+
+        # Use a small batch size so that rows get split across batches.
+        counter = d2v.pairlist.PairCounter(shape)
+        d2v.ingestion.count_pairs_vectorized(
+            expanded_graph_adjacency, counter, batch_size=4)
+        self.assertEqual(dict(counter.items()), Counter(pairs))
+
+
+    def test_gram_pairs_adjacency(self):
+        """
+        The pair counts calculated as a matrix product match those obtained
+        from listing pairs, whether or not they are calculated in blocks.
+        """
+        graph = {
+            0: [3, 4, 4, 1], 1: [5, 3, 6, 6, 6], 2: [1, 1, 7], 8: [9]
+        }
+        shape = (10, 10)
+        pairs, expanded_graph = d2v.ingestion.make_pairs_and_expanded_graph(
+            graph)
+        expected = d2v.pairlist.pairlist_to_coo(
+            Counter(pairs), shape=shape, symmetric=True)
+        expanded_graph_adjacency = d2v.graph.graph_to_csr(
+            expanded_graph, shape=shape)
+
+        for block_size in [None, 1, 3]:
+            found = d2v.ingestion.gram_pairs_adjacency(
+                expanded_graph_adjacency, block_size=block_size)
+            self.assertEqual(found.shape, shape)
+            self.assertEqual((found != expected).nnz, 0)
+
+        self.assertEqual(
+            Counter(d2v.pairlist.iter_matrix_pairs(found)), Counter(pairs))
+
+
     def test_make_pairs_and_expanded_graph(self):
         """
         Test that pairs and expanded_graph are calculated correctly.  Assumes
@@ -430,6 +1153,23 @@ class TestIngest(TestCase):
 
 
 
+    def test_recursively_expand_deep_and_cyclic(self):
+
+        # Chains of references much deeper than the recursion limit are fine.
+        depth = 5000
+        graph = {index: [index + 1, -index - 1] for index in range(depth)}
+        graph[depth] = []
+        expansion = d2v.ingestion.recursively_expand(0, graph, {})
+        self.assertEqual(len(expansion), 2 * depth + 1)
+
+        # Cycles of references are an error.
+        graph = {0: [1, 5], 1: [2], 2: [0, 6]}
+        with self.assertRaises(ValueError):
+            d2v.ingestion.recursively_expand(0, graph, {})
+        with self.assertRaises(ValueError):
+            d2v.ingestion.recursively_expand(0, {0: [0]}, {})
+
+
     def test_recursively_expand(self):
 
         d2v_id = 'joblist,,1'
@@ -484,6 +1224,116 @@ class TestIngest(TestCase):
 
 class TestPairlist(TestCase):
 
+    def test_pair_counter(self):
+        pair_list = [
+            (0, 7), (1, 7), (0, 7), (5, 9), (6, 6), (0, 7), (1, 7), (6, 6),
+            (2, 3), (5, 9), (4, 11)
+        ]
+        shape = (12, 12)
+
+        # Use a tiny buffer so that several merges happen.
+        counter = d2v.pairlist.PairCounter(shape, buffer_size=3)
+        counter.add_pairs(iter(pair_list))
+        self.assertEqual(dict(counter.items()), Counter(pair_list))
+        self.assertEqual(Counter(counter.iter_pairs()), Counter(pair_list))
+
+        # The matrix agrees with the one built from a Counter.
+        expected = d2v.pairlist.pairlist_to_coo(
+            Counter(pair_list), shape=shape, symmetric=True)
+        found = counter.to_coo(symmetric=True)
+        self.assertTrue(np.array_equal(found.todense(), expected.todense()))
+
+        # Exceeding max_memory is an error.
+        counter = d2v.pairlist.PairCounter(shape, max_memory=100)
+        with self.assertRaises(MemoryError):
+            counter.add_pairs(pair_list)
+            counter.flush()
+
+
+    def test_external_pair_counter(self):
+        shape = (300, 300)
+        rng = np.random.default_rng(0)
+        I = rng.integers(0, shape[0], 20000)
+        J = rng.integers(0, shape[1], 20000)
+        expected = d2v.pairlist.PairCounter(shape)
+        expected.add(I, J)
+
+        ensure_dir(d2v.CONSTANTS.TEST_DIR)
+        with d2v.pairlist.ExternalPairCounter(
+            shape, directory=d2v.CONSTANTS.TEST_DIR, buffer_size=3000
+        ) as counter:
+            counter.add(I, J)
+            counter.flush()
+            self.assertGreater(len(counter.runs), 5)
+            self.assertEqual(len(counter), len(expected))
+            for found_array, expected_array in zip(
+                counter.arrays(), expected.arrays()
+            ):
+                self.assertTrue(np.array_equal(found_array, expected_array))
+        self.assertEqual(os.listdir(d2v.CONSTANTS.TEST_DIR), [])
+
+        # With many runs, groups of runs are merged into longer runs first,
+        # in several passes, so that few runs are merged at once.
+        with d2v.pairlist.ExternalPairCounter(
+            shape, directory=d2v.CONSTANTS.TEST_DIR, buffer_size=1000,
+            max_runs=3
+        ) as counter:
+            counter.add(I, J)
+            counter.flush()
+            self.assertGreater(len(counter.runs), 9)
+            for found_array, expected_array in zip(
+                counter.arrays(), expected.arrays()
+            ):
+                self.assertTrue(np.array_equal(found_array, expected_array))
+            self.assertLessEqual(len(counter.runs), counter.max_runs)
+            self.assertLessEqual(counter.max_runs, 3)
+            self.assertEqual(
+                len(os.listdir(counter.run_dir)), 2 * len(counter.runs))
+            self.assertEqual(len(counter), len(expected))
+        self.assertEqual(os.listdir(d2v.CONSTANTS.TEST_DIR), [])
+        with self.assertRaises(ValueError):
+            d2v.pairlist.ExternalPairCounter(shape, max_runs=1)
+
+        # Pairs having i <= j can be streamed into a symmetric matrix and a
+        # binary pairlist.
+        I, J = np.minimum(I, J), np.maximum(I, J)
+        expected = d2v.pairlist.PairCounter(shape)
+        expected.add(I, J)
+        pairlist_path = os.path.join(
+            d2v.CONSTANTS.TEST_DIR, 'external-pairs.bin')
+        with d2v.pairlist.ExternalPairCounter(
+            shape, directory=d2v.CONSTANTS.TEST_DIR, buffer_size=3000
+        ) as counter:
+            counter.add(I, J)
+            found = counter.to_symmetric_csr()
+            counter.write_binary(pairlist_path)
+        self.assertTrue(found.has_sorted_indices)
+        self.assertTrue(np.array_equal(
+            found.toarray(), expected.to_coo(symmetric=True).toarray()))
+        blocks = d2v.pairlist.read_binary_pairlist(pairlist_path)
+        self.assertEqual(
+            list(d2v.pairlist.iter_block_pairs(blocks)),
+            list(expected.iter_pairs())
+        )
+        os.remove(pairlist_path)
+
+        with d2v.pairlist.ExternalPairCounter(
+            shape, directory=d2v.CONSTANTS.TEST_DIR
+        ) as counter:
+            counter.add([2], [1])
+            with self.assertRaises(ValueError):
+                counter.to_symmetric_csr()
+
+        # Runs are removed if counting fails.
+        with self.assertRaises(ValueError):
+            with d2v.pairlist.ExternalPairCounter(
+                shape, directory=d2v.CONSTANTS.TEST_DIR, buffer_size=3000
+            ) as counter:
+                counter.add(I, J)
+                raise ValueError()
+        self.assertEqual(os.listdir(d2v.CONSTANTS.TEST_DIR), [])
+
+
     def test_pairlist_to_coo(self):
 
         pairs = Counter({
@@ -519,6 +1369,50 @@ class TestPairlist(TestCase):
         self.assertEqual(read_pair_list, pair_list)
 
 
+    def test_read_write_binary_pairlist(self):
+        path = os.path.join(d2v.CONSTANTS.TEST_DIR, 'test-pairs.bin')
+        ensure_dir(d2v.CONSTANTS.TEST_DIR)
+        blocks = [
+            (np.array([0, 1, 5]), np.array([2, 1, 7]), np.array([1, 3, 2])),
+            (np.array([9]), np.array([4]), np.array([1])),
+        ]
+        pair_list = [(0, 2), (1, 1), (1, 1), (1, 1), (5, 7), (5, 7), (9, 4)]
+        for index_dtype in (np.int32, np.int64):
+            for counts in (True, False):
+                for compression_level in (0, 6):
+                    d2v.pairlist.write_binary_pairlist(
+                        path, blocks, index_dtype=index_dtype, counts=counts,
+                        compression_level=compression_level
+                    )
+                    for mmap in (True, False):
+                        found = list(d2v.pairlist.read_binary_pairlist(
+                            path, mmap=mmap))
+                        self.assertEqual(len(found), 2)
+                        I, J, found_counts = found[0]
+                        self.assertEqual(I.dtype, index_dtype)
+                        self.assertEqual(found_counts is None, not counts)
+                        self.assertEqual(
+                            list(d2v.pairlist.iter_block_pairs(found)),
+                            pair_list
+                        )
+
+        # Blocks of pairs from a symmetric pair count matrix.
+        matrix = d2v.pairlist.pairlist_to_coo(
+            Counter(pair_list), shape=(10, 10), symmetric=True)
+        blocks = d2v.pairlist.matrix_pair_blocks(matrix, block_size=2)
+        self.assertEqual(
+            list(d2v.pairlist.iter_block_pairs(blocks)),
+            sorted(tuple(sorted(pair)) for pair in pair_list)
+        )
+
+        # The dtype of the counts depends on weighting, not the matrix.
+        for weighted, dtype in [(False, np.int64), (True, np.float64)]:
+            for I, J, counts in d2v.pairlist.matrix_pair_blocks(
+                matrix.astype(np.float64), weighted=weighted
+            ):
+                self.assertEqual(counts.dtype, dtype)
+
+
 
 class TestDictionary(TestCase):
 
@@ -547,6 +1441,17 @@ class TestDictionary(TestCase):
         self.assertEqual(keys, expected_keys)
 
 
+    def test_merge(self):
+        dictionary1 = d2v.dictionary.Dictionary()
+        dictionary1.add_many(['a', 'b', 'c'])
+        dictionary2 = d2v.dictionary.Dictionary()
+        dictionary2.add_many(['d', 'b', 'e'])
+
+        remap = dictionary1.merge(dictionary2)
+        self.assertEqual(remap, [3, 1, 4])
+        self.assertEqual(dictionary1.keys, ['a', 'b', 'c', 'd', 'e'])
+
+
     def test_read_write_dictionary(self):
         keys = ['a', 'b', 'c', 'd']
         path = os.path.join(d2v.CONSTANTS.TEST_DIR, 'read-write-dictionary.txt')
@@ -563,6 +1468,642 @@ class TestDictionary(TestCase):
 
 
 
+    def test_binary_dictionary(self):
+        keys = ['profile,,1', 'profile,title,ai', 'skill,name,é', 'a', 'b']
+        text_path = os.path.join(
+            d2v.CONSTANTS.TEST_DIR, 'binary-dictionary.txt')
+        binary_path = os.path.join(
+            d2v.CONSTANTS.TEST_DIR, 'binary-dictionary.bin')
+        ensure_dir(d2v.CONSTANTS.TEST_DIR)
+        dictionary = d2v.dictionary.Dictionary()
+        dictionary.add_many(keys)
+        d2v.dictionary.write_binary_dictionary(binary_path, dictionary)
+
+        with d2v.dictionary.read_binary_dictionary(binary_path) as mapped:
+            self.assertEqual(len(mapped), len(keys))
+            self.assertEqual(list(mapped.keys), keys)
+            self.assertEqual(mapped.keys[2], 'skill,name,é')
+            self.assertEqual(mapped.get_many(keys), list(range(len(keys))))
+            self.assertEqual(mapped, dictionary)
+            self.assertNotIn('c', mapped)
+            with self.assertRaises(KeyError):
+                mapped['c']
+
+            # Round trip with the text format.
+            d2v.dictionary.write_dictionary(text_path, mapped)
+            self.assertEqual(
+                d2v.dictionary.read_dictionary(text_path), dictionary)
+
+        # Empty dictionaries work too.
+        d2v.dictionary.write_binary_dictionary(
+            binary_path, d2v.dictionary.Dictionary())
+        with d2v.dictionary.read_binary_dictionary(binary_path) as mapped:
+            self.assertEqual(len(mapped), 0)
+            self.assertNotIn('a', mapped)
+
+
+
+class TestTokenizer(TestCase):
+
+    def test_tokenizers(self):
+        string = 'Deep-learning, for AI!  Deep learning.'
+        self.assertEqual(
+            d2v.tokenizer.WhitespaceTokenizer()(string),
+            ['deep-learning,', 'for', 'ai!', 'deep', 'learning.']
+        )
+        regex = d2v.tokenizer.RegexTokenizer()
+        expected = ['deep', 'learning', 'for', 'ai', 'deep', 'learning']
+        self.assertEqual(regex(string), expected)
+
+        cached = d2v.tokenizer.CachedTokenizer(regex, maxsize=2)
+        self.assertEqual(list(cached(string)), expected)
+        self.assertIs(cached(string), cached(string))
+
+    def test_ingest_tokenizers(self):
+        tokenizers = {
+            ('profile', 'title'): d2v.tokenizer.RegexTokenizer(r'[a-z]{3,}'),
+            None: d2v.tokenizer.CachedTokenizer(
+                d2v.tokenizer.RegexTokenizer()),
+        }
+        graph, dictionary = d2v.ingestion.ingest(
+            sample_objects(), None, tokenizers=tokenizers)
+        titles = [key for key in dictionary.keys if ',title,' in key]
+        self.assertEqual(titles, [
+            'profile,title,aws', 'profile,title,engineer',
+            'profile,title,for', 'profile,title,research',
+            'profile,title,software', 'profile,title,developer',
+            'profile,title,deep', 'profile,title,learning',
+            'profile,title,tools'
+        ])
+        self.assertIn('skill,category,dev', dictionary)
+
+        # The default tokenizer matches the behavior without tokenizers.
+        self.assertEqual(
+            d2v.ingestion.ingest(
+                sample_objects(), None,
+                tokenizers=d2v.tokenizer.WhitespaceTokenizer()
+            ),
+            d2v.ingestion.ingest(sample_objects(), None)
+        )
+
+        # Models ingested with tokenizers can't be updated, since the new
+        # objects might not be tokenized the same way.
+        path = os.path.join(d2v.CONSTANTS.TEST_DIR, 'test-ingest-tokenizers')
+        ensure_dir(path)
+        d2v.ingestion.ingest(sample_objects(), path, tokenizers=tokenizers)
+        with self.assertRaises(ValueError):
+            d2v.ingestion.ingest_incremental(
+                [{'d2v-id': 'profile,,3', 'title': 'AI, tools'}], path)
+        clear_path(path)
+
+
+
+class TestReader(TestCase):
+
+    def test_read_jsonl(self):
+        path = os.path.join(d2v.CONSTANTS.TEST_DIR, 'test-read-jsonl')
+        ensure_dir(path)
+        objects = sample_objects()
+        paths = [
+            os.path.join(path, 'objects-1.jsonl'),
+            os.path.join(path, 'objects-2.jsonl.gz'),
+        ]
+        with open(paths[0], 'w') as jsonl_file:
+            for obj in objects[:4]:
+                jsonl_file.write(json.dumps(obj) + '\n')
+            jsonl_file.write('\n')
+        with gzip.open(paths[1], 'wt') as jsonl_file:
+            for obj in objects[4:]:
+                jsonl_file.write(json.dumps(obj) + '\n')
+
+        # Chunk boundaries can fall anywhere within a line, and chunks can be
+        # shorter than a line, but each object is read once, in order.
+        for chunk_size in [1, 7, 64, 2**22]:
+            stats = {}
+            batches = list(d2v.reader.iter_jsonl_batches(
+                paths, processes=2, chunk_size=chunk_size, prefetch=2,
+                stats=stats
+            ))
+            self.assertEqual(sum(batches, []), objects)
+            self.assertEqual(stats['reader']['objects'], len(objects))
+            self.assertEqual(
+                stats['reader']['bytes'],
+                os.path.getsize(paths[0])
+                + sum(len(json.dumps(obj)) + 1 for obj in objects[4:])
+            )
+
+        # Each file is parsed in chunks, including the gzipped one, which is
+        # decompressed as a stream.
+        batches = list(d2v.reader.iter_jsonl_batches(
+            paths, processes=2, chunk_size=2**22))
+        self.assertEqual([len(batch) for batch in batches], [4, 2])
+        many_objects = [
+            {'d2v-id': 'doc,,{}'.format(i), 'text': 'x' * (i % 7)}
+            for i in range(100)
+        ]
+        gzip_path = os.path.join(path, 'objects-3.jsonl.gz')
+        with gzip.open(gzip_path, 'wt') as jsonl_file:
+            for obj in many_objects:
+                jsonl_file.write(json.dumps(obj) + '\n')
+        batches = list(d2v.reader.iter_jsonl_batches(
+            [gzip_path], processes=2, chunk_size=256, prefetch=2))
+        self.assertGreater(len(batches), 10)
+        self.assertTrue(all(len(batch) < 10 for batch in batches))
+        self.assertEqual(sum(batches, []), many_objects)
+
+        # The objects can be ingested directly.
+        self.assertEqual(
+            d2v.ingestion.ingest(
+                d2v.reader.read_jsonl(paths, processes=2), None),
+            d2v.ingestion.ingest(objects, None)
+        )
+
+        # Errors while reading are raised to the consumer.
+        with self.assertRaises(FileNotFoundError):
+            list(d2v.reader.read_jsonl(paths + ['missing.jsonl']))
+
+        clear_path(path)
+
+
+class TestModel(TestCase):
+
+    def test_model(self):
+        path = os.path.join(d2v.CONSTANTS.TEST_DIR, 'test-model')
+        ensure_dir(path)
+        d2v.ingestion.ingest(
+            sample_objects(), path, outputs=d2v.ingestion.ARTIFACTS)
+        expected_dictionary = d2v.dictionary.read_dictionary(
+            os.path.join(path, 'dictionary.txt'))
+
+        def check_model(model, mmap):
+            self.assertEqual(
+                isinstance(model.dictionary,
+                    d2v.dictionary.MappedDictionary),
+                mmap
+            )
+            self.assertEqual(model.dictionary, expected_dictionary)
+            for name, (_, npz_name) in d2v.model.MATRICES.items():
+                found = model.load_matrix(name)
+                expected = scipy.sparse.load_npz(os.path.join(path, npz_name))
+                self.assertIsInstance(found, scipy.sparse.csr_matrix)
+                self.assertEqual(found.shape, expected.shape)
+                self.assertTrue(np.array_equal(
+                    found.toarray(), expected.toarray()))
+                self.assertEqual(found.data.flags.writeable, not mmap)
+            self.assertIs(model.pairs, model.load_matrix('pairs'))
+
+        with d2v.model.Model(path) as model:
+            check_model(model, True)
+        with d2v.model.Model(path, mmap=False) as model:
+            check_model(model, False)
+
+        # Without dictionary.txt, the binary dictionary is read into memory.
+        os.rename(
+            os.path.join(path, 'dictionary.txt'),
+            os.path.join(path, 'dictionary.txt.moved')
+        )
+        with d2v.model.Model(path, mmap=False) as model:
+            check_model(model, False)
+        os.rename(
+            os.path.join(path, 'dictionary.txt.moved'),
+            os.path.join(path, 'dictionary.txt')
+        )
+
+        # Without raw artifacts, the model falls back to the .npz files.
+        os.remove(os.path.join(path, 'dictionary.bin'))
+        for name in os.listdir(path):
+            if name.endswith('.csr'):
+                clear_path(os.path.join(path, name))
+        with d2v.model.Model(path) as model:
+            check_model(model, False)
+
+        # Raw artifacts can be added to an existing model.
+        d2v.model.convert_model(path)
+        with d2v.model.Model(path) as model:
+            check_model(model, True)
+
+        # Incremental ingestion keeps the raw artifacts up to date.
+        d2v.ingestion.ingest_incremental([{
+            'd2v-id': 'profile,,3', 'title': 'Data engineer',
+            'skills': [{'$ref': 'skill,,1'}]
+        }], path)
+        expected_dictionary = d2v.dictionary.read_dictionary(
+            os.path.join(path, 'dictionary.txt'))
+        with d2v.model.Model(path) as model:
+            check_model(model, True)
+
+        clear_path(path)
+
+
+
+class TestRelayout(TestCase):
+
+    def test_namespace_layout(self):
+        dictionary = d2v.dictionary.Dictionary()
+        dictionary.add_many([
+            'a,x,1', 'b,,1', 'a,x,2', 'a,y,1', 'b,,2', 'a,x,3'])
+        with self.assertRaises(ValueError):
+            d2v.dictionary.namespace_ranges(dictionary)
+
+        laid_out, remap = d2v.dictionary.namespace_layout(dictionary)
+        self.assertEqual(
+            laid_out.keys,
+            ['a,x,1', 'a,x,2', 'a,x,3', 'b,,1', 'b,,2', 'a,y,1']
+        )
+        self.assertEqual(remap.tolist(), [0, 3, 1, 5, 4, 2])
+        self.assertEqual(
+            d2v.dictionary.namespace_ranges(laid_out),
+            {('a', 'x'): (0, 3), ('b', None): (3, 5), ('a', 'y'): (5, 6)}
+        )
+
+        # Laying out again changes nothing.
+        _, remap = d2v.dictionary.namespace_layout(laid_out)
+        self.assertEqual(remap.tolist(), list(range(6)))
+
+    def test_relayout_model(self):
+        path = os.path.join(d2v.CONSTANTS.TEST_DIR, 'test-relayout')
+        ensure_dir(path)
+        d2v.ingestion.ingest(
+            sample_objects(), path, outputs=d2v.ingestion.ARTIFACTS)
+        with d2v.model.Model(path, mmap=False) as model:
+            keys = list(model.dictionary.keys)
+            matrices = {
+                name: model.load_matrix(name).toarray()
+                for name in d2v.model.MATRICES
+            }
+            counts = np.array(model.counts)
+        # Each embedding holds its id.
+        np.save(
+            os.path.join(path, 'embeddings.npy'),
+            np.repeat(np.arange(len(keys), dtype=np.float32), 2)
+            .reshape(-1, 2)
+        )
+
+        remap = d2v.model.relayout_model(path)
+        self.assertNotEqual(remap.tolist(), list(range(len(remap))))
+        with d2v.model.Model(path) as model:
+            self.assertEqual(
+                [model.dictionary.keys[index] for index in remap], keys)
+            self.assertEqual(
+                d2v.dictionary.read_dictionary(
+                    os.path.join(path, 'dictionary.txt')),
+                model.dictionary
+            )
+            for name, (raw_name, npz_name) in d2v.model.MATRICES.items():
+                expected = matrices[name]
+                found = model.load_matrix(name).toarray()
+                self.assertTrue(np.array_equal(
+                    found[np.ix_(remap, remap)], expected))
+                self.assertTrue(np.array_equal(
+                    scipy.sparse.load_npz(os.path.join(path, npz_name))
+                    .toarray(),
+                    found
+                ))
+            self.assertTrue(np.array_equal(
+                d2v.model.load_binary_pairs(
+                    os.path.join(path, 'pairs.bin'), len(remap)).toarray(),
+                model.pairs.toarray()
+            ))
+            self.assertTrue(np.array_equal(model.counts[remap], counts))
+            self.assertTrue(np.array_equal(
+                model.embeddings[remap, 0], np.arange(len(remap))))
+
+            # Each namespace's embeddings are a view of its rows.
+            ranges = model.namespace_ranges
+            self.assertEqual(
+                ranges, d2v.dictionary.namespace_ranges(model.dictionary))
+            self.assertEqual(
+                sum(stop - start for start, stop in ranges.values()),
+                len(remap)
+            )
+            skills = model.namespace_embeddings('skill', 'name')
+            self.assertTrue(np.shares_memory(skills, model.embeddings))
+            start, stop = ranges['skill', 'name']
+            self.assertEqual(
+                [keys[int(index)] for index in skills[:, 0]],
+                [model.dictionary.keys[index] for index in range(start, stop)]
+            )
+            self.assertTrue(all(
+                key.startswith('skill,name,')
+                for key in model.dictionary.keys[start:stop]
+            ))
+        clear_path(path)
+
+
+
+class TestTrainer(TestCase):
+
+    def test_sample_pairs(self):
+        """Pairs are sampled in proportion to their counts, in either order."""
+        pairs = scipy.sparse.csr_matrix(np.array([
+            [0, 3, 1],
+            [3, 0, 0],
+            [1, 0, 0],
+        ]))
+        trainer = d2v.trainer.SGNSTrainer(pairs, dimensions=4, seed=0)
+        I, J = trainer.sample_pairs(40000)
+        found = Counter(zip(I.tolist(), J.tolist()))
+        self.assertEqual(set(found), {(0, 1), (1, 0), (0, 2), (2, 0)})
+        self.assertAlmostEqual(
+            (found[0, 1] + found[1, 0]) / 40000, 0.75, delta=0.01)
+        self.assertAlmostEqual(found[0, 1] / 40000, 0.375, delta=0.01)
+
+        negatives = trainer.sample_negatives((2, 3))
+        self.assertEqual(negatives.shape, (2, 3))
+        self.assertTrue(np.all((negatives >= 0) & (negatives < 3)))
+
+    def test_train(self):
+        path = os.path.join(d2v.CONSTANTS.TEST_DIR, 'test-trainer')
+        ensure_dir(path)
+        d2v.ingestion.ingest(sample_objects(), path)
+
+        def train(seed):
+            stats = {}
+            trainer = d2v.trainer.train_model(
+                path, 10000, dimensions=8, batch_size=100, learning_rate=0.025,
+                seed=seed, stats=stats
+            )
+            return trainer, stats
+
+        trainer, stats = train(0)
+        self.assertEqual(trainer.embeddings.dtype, np.float32)
+        self.assertEqual(
+            trainer.embeddings.shape[0],
+            len(d2v.dictionary.read_dictionary(
+                os.path.join(path, 'dictionary.txt')))
+        )
+        self.assertEqual(stats['train']['pairs'], 10000)
+        self.assertEqual(stats['train']['steps'], 100)
+        self.assertGreater(stats['train']['pairs_per_second'], 0)
+
+        # Training lowers the loss from its initial value, log(2) for each
+        # of the 1 + 5 samples.
+        self.assertLess(stats['train']['loss'], 6 * np.log(2))
+
+        # The same seed gives the same embeddings.
+        same_trainer, _ = train(0)
+        self.assertTrue(np.array_equal(
+            trainer.embeddings, same_trainer.embeddings))
+        other_trainer, _ = train(1)
+        self.assertFalse(np.array_equal(
+            trainer.embeddings, other_trainer.embeddings))
+        clear_path(path)
+
+
+
+class TestSampler(TestCase):
+
+    def test_alias_table(self):
+        """Indices are sampled in proportion to their weights."""
+        rng = np.random.default_rng(0)
+        for weights in [
+            [1], [1, 1, 1], [0, 3, 1], [5, 0, 0, 1, 2, 0], rng.random(50),
+            rng.random(50) ** 8, 1 / np.arange(1, 1001)
+        ]:
+            weights = np.asarray(weights, dtype=float)
+            table = d2v.sampler.AliasTable(weights)
+            # The probability of each index implied by the table.
+            probabilities = table.prob / len(table)
+            np.add.at(
+                probabilities, table.alias, (1 - table.prob) / len(table))
+            np.testing.assert_allclose(
+                probabilities, weights / weights.sum(), atol=1e-12)
+
+        samples = d2v.sampler.AliasTable([0, 3, 1]).sample(10000, rng)
+        self.assertEqual(samples.shape, (10000,))
+        self.assertEqual(set(samples.tolist()), {1, 2})
+        self.assertAlmostEqual(np.mean(samples == 1), 0.75, delta=0.02)
+        with self.assertRaises(ValueError):
+            d2v.sampler.AliasTable([0, 0])
+
+    def test_negative_sampler(self):
+        path = os.path.join(d2v.CONSTANTS.TEST_DIR, 'test-sampler')
+        ensure_dir(path)
+        d2v.ingestion.ingest(sample_objects(), path)
+        model = d2v.model.Model(path)
+        dictionary = model.dictionary
+
+        # Counts are the number of occurrences of each id as a child,
+        # including repeats within an object ('dev dev').
+        self.assertEqual(model.counts[dictionary['profile,title,for']], 2)
+        self.assertEqual(model.counts[dictionary['skill,category,dev']], 2)
+        self.assertEqual(model.counts[dictionary['joblist,,1']], 0)
+
+        sampler = d2v.sampler.NegativeSampler(
+            dictionary, model.counts, seed=0)
+        title = ('profile', 'title')
+        samples = sampler.sample(title, (1000, 10))
+        self.assertEqual(samples.shape, (1000, 10))
+        self.assertTrue(all(
+            dictionary.namespace(index) == title
+            for index in set(samples.ravel().tolist())
+        ))
+        # 'for' has count 2, and the 9 other words of titles count 1.
+        self.assertAlmostEqual(
+            np.mean(samples == dictionary['profile,title,for']),
+            2 ** 0.75 / (9 + 2 ** 0.75), delta=0.01
+        )
+
+        ids = dictionary.get_many(['skill,name,agile', 'profile,title,ai'])
+        samples = sampler.sample_like(ids, 5)
+        self.assertEqual(samples.shape, (2, 5))
+        for index, row in zip(ids, samples):
+            self.assertTrue(all(
+                dictionary.namespace(sample) == dictionary.namespace(index)
+                for sample in row.tolist()
+            ))
+
+        # Only the tables of namespaces whose counts change are rebuilt.
+        skill_table = sampler.table(('skill', 'name'))
+        d2v.ingestion.ingest_incremental([{
+            'd2v-id': 'profile,,3', 'title': 'Data engineer',
+            'skills': [{'$ref': 'skill,,1'}]
+        }], path)
+        dictionary = d2v.dictionary.read_dictionary(
+            os.path.join(path, 'dictionary.txt'))
+        stale = sampler.update(
+            dictionary, np.load(os.path.join(path, 'counts.npy')))
+        self.assertEqual(
+            stale, {('profile', 'title'), ('profile', None), ('skill', None)})
+        self.assertIs(sampler.table(('skill', 'name')), skill_table)
+        self.assertIn(
+            dictionary['profile,title,data'],
+            sampler.sample(title, 1000).tolist()
+        )
+        model.close()
+        clear_path(path)
+
+
+
+class TestGilbert(TestCase):
+
+    def test_head_size_for_coverage(self):
+        counts = np.array([1, 10, 0, 5, 4])
+        self.assertEqual(d2v.gilbert.head_size_for_coverage(counts, 0.5), 1)
+        self.assertEqual(d2v.gilbert.head_size_for_coverage(counts, 0.75), 2)
+        self.assertEqual(d2v.gilbert.head_size_for_coverage(counts, 1), 4)
+        self.assertEqual(d2v.gilbert.head_size_for_coverage([0, 0], 1), 0)
+
+    def test_head_tail_embeddings(self):
+        counts = np.array([1, 10, 0, 5, 4, 1])
+        store = d2v.gilbert.HeadTailEmbeddings(
+            counts, dimensions=8, head_size=2, tail_dimensions=2, seed=0)
+        self.assertEqual(len(store), 6)
+        self.assertEqual(np.flatnonzero(store.is_head).tolist(), [1, 3])
+        self.assertEqual(store.head.shape, (2, 8))
+        self.assertEqual(store.tail.shape, (4, 2))
+
+        vectors = store.lookup([3, 0, 3])
+        self.assertEqual(vectors.shape, (3, 8))
+        self.assertEqual(vectors.dtype, np.float32)
+        np.testing.assert_array_equal(vectors[0], store.head[store.rows[3]])
+        np.testing.assert_array_equal(vectors[0], vectors[2])
+        np.testing.assert_allclose(
+            vectors[1], store.tail[store.rows[0]] @ store.projection,
+            rtol=1e-6
+        )
+
+        # Updates to head vectors add up; updates to tail vectors go back
+        # through the projection.
+        updates = np.ones((3, 8), dtype=np.float32)
+        tail = store.tail[store.rows[0]].copy()
+        projection = store.projection.copy()
+        store.add([3, 0, 3], updates)
+        np.testing.assert_allclose(store.lookup([3])[0], vectors[0] + 2)
+        np.testing.assert_allclose(
+            store.tail[store.rows[0]], tail + projection.sum(axis=1),
+            rtol=1e-6
+        )
+        np.testing.assert_allclose(
+            store.projection, projection + tail[:, None], rtol=1e-6)
+
+        # Tail ids can share hashed buckets.
+        hashed = d2v.gilbert.HeadTailEmbeddings(
+            counts, dimensions=8, head_size=2, tail_buckets=2, seed=0)
+        self.assertEqual(hashed.tail.shape, (2, 2))
+        self.assertTrue(np.all(hashed.rows[~hashed.is_head] < 2))
+
+        # A long-tailed vocabulary takes several times less memory.
+        zipf_counts = (10**6 / np.arange(1, 10**5 + 1)).astype(np.int64)
+        store = d2v.gilbert.HeadTailEmbeddings(
+            zipf_counts, head_size=2000, seed=0)
+        self.assertGreater(store.dense_nbytes / store.nbytes, 3)
+
+    def test_save_load(self):
+        path = os.path.join(d2v.CONSTANTS.TEST_DIR, 'test-gilbert')
+        store = d2v.gilbert.HeadTailEmbeddings(
+            np.arange(20), dimensions=4, head_size=5, seed=0)
+        store.save(path)
+        loaded = d2v.gilbert.HeadTailEmbeddings.load(path)
+        self.assertFalse(loaded.head.flags.writeable)
+        np.testing.assert_array_equal(
+            loaded.lookup(np.arange(20)), store.lookup(np.arange(20)))
+        clear_path(path)
+
+    def test_train_head_tail(self):
+        """The trainer learns through a head-tail store."""
+        pairs = scipy.sparse.csr_matrix(np.array([
+            [0, 5, 1, 0],
+            [5, 0, 0, 1],
+            [1, 0, 0, 2],
+            [0, 1, 2, 0],
+        ]))
+        store = d2v.gilbert.HeadTailEmbeddings(
+            pairs.sum(axis=1).A1, dimensions=8, head_size=2, seed=0)
+        trainer = d2v.trainer.SGNSTrainer(
+            pairs, dimensions=8, batch_size=16, negatives=1, seed=0,
+            store=store
+        )
+        tail = store.tail.copy()
+        loss = trainer.train(1000)
+        self.assertIsNone(trainer.embeddings)
+        self.assertTrue(np.isfinite(loss))
+        self.assertFalse(np.array_equal(store.tail, tail))
+
+        # The context vectors can be held in a second store, so that no
+        # dense matrix is allocated.
+        context_store = d2v.gilbert.HeadTailEmbeddings(
+            pairs.sum(axis=1).A1, dimensions=8, head_size=2, seed=1)
+        context_tail = context_store.tail.copy()
+        trainer = d2v.trainer.SGNSTrainer(
+            pairs, dimensions=8, batch_size=16, negatives=2, seed=0,
+            store=store, context_store=context_store
+        )
+        loss = trainer.train(1000)
+        self.assertIsNone(trainer.embeddings)
+        self.assertIsNone(trainer.context)
+        self.assertTrue(np.isfinite(loss))
+        self.assertFalse(np.array_equal(context_store.tail, context_tail))
+
+
+
+class TestLinalg(TestCase):
+
+    def test_ppmi_matrix(self):
+        counts = np.array([
+            [0, 4, 1, 0],
+            [4, 2, 0, 3],
+            [1, 0, 0, 5],
+            [0, 3, 5, 1],
+        ])
+        for shift, alpha in [(1, 1), (2, 0.75)]:
+            # Small blocks check that rows are handled across blocks.
+            found = d2v.linalg.ppmi_matrix(
+                scipy.sparse.csr_matrix(counts), shift=shift, alpha=alpha,
+                block_size=3
+            )
+            self.assertEqual(found.dtype, np.float32)
+            rows = counts.sum(axis=1)
+            columns = counts.sum(axis=0) ** alpha
+            with np.errstate(divide='ignore'):
+                expected = np.log(
+                    counts * columns.sum() / np.outer(rows, columns) / shift)
+            expected = np.maximum(expected, 0)
+            np.testing.assert_allclose(found.toarray(), expected, rtol=1e-6)
+            self.assertTrue(np.all(found.data > 0))
+
+    def test_randomized_svd(self):
+        rng = np.random.default_rng(0)
+        # A sparse matrix of rank 5.
+        left = rng.random((60, 5)) * (rng.random((60, 5)) < 0.3)
+        right = rng.random((5, 40)) * (rng.random((5, 40)) < 0.3)
+        matrix = scipy.sparse.csr_matrix(left @ right)
+        U, S, Vt = d2v.linalg.randomized_svd(
+            matrix, 5, block_size=7, threads=2)
+        self.assertEqual(
+            (U.shape, S.shape, Vt.shape), ((60, 5), (5,), (5, 40)))
+        np.testing.assert_allclose(
+            S, np.linalg.svd(matrix.toarray(), compute_uv=False)[:5],
+            rtol=1e-4
+        )
+        np.testing.assert_allclose(
+            (U * S) @ Vt, matrix.toarray(), atol=1e-4)
+
+        # The same seed gives the same vectors, however the work is split.
+        same_U, _, _ = d2v.linalg.randomized_svd(
+            matrix, 5, block_size=7, threads=2)
+        self.assertTrue(np.array_equal(U, same_U))
+        split_U, _, _ = d2v.linalg.randomized_svd(
+            matrix, 5, block_size=60, threads=1)
+        np.testing.assert_allclose(split_U, U, atol=1e-4)
+
+    def test_solve_model(self):
+        path = os.path.join(d2v.CONSTANTS.TEST_DIR, 'test-linalg')
+        ensure_dir(path)
+        d2v.ingestion.ingest(sample_objects(), path)
+        stats = {}
+        embeddings = d2v.linalg.solve_model(path, dimensions=4, stats=stats)
+        num_ids = len(d2v.dictionary.read_dictionary(
+            os.path.join(path, 'dictionary.txt')))
+        self.assertEqual(embeddings.shape, (num_ids, 4))
+        self.assertEqual(embeddings.dtype, np.float32)
+        self.assertGreater(stats['svd']['ppmi_nnz'], 0)
+        self.assertTrue(np.array_equal(
+            embeddings, d2v.linalg.solve_model(path, dimensions=4)))
+        clear_path(path)
+
+
+
 class TestData:
 
     """Access a small, consistent test dataset."""
@@ -604,6 +2145,70 @@ class TestData:
  
 
 
+def sample_objects():
+    """A small set of objects that reference one another."""
+    return [
+        {
+            'd2v-id': 'joblist,,1',
+            'profiles': [{'$ref': 'profile,,1'}, {'$ref': 'profile,,2'}]
+        },
+        {
+            'd2v-id': 'profile,,1',
+            'title': 'AWS Engineer for AI research',
+            'skills': [{'$ref': 'skill,,1'}, {'$ref': 'skill,,2'}]
+        },
+        {
+            'd2v-id': 'profile,,2',
+            'title': 'Software developer for deep learning tools',
+            'skills': [{'$ref': 'skill,,2'}, {'$ref': 'skill,,3'}],
+            'years': 5
+        },
+        {'d2v-id': 'skill,,1', 'name': 'orchestration', 'category': 'ops'},
+        {'d2v-id': 'skill,,2', 'name': 'jenkins', 'category': 'devops'},
+        {'d2v-id': 'skill,,3', 'name': 'agile', 'category': 'dev dev'},
+    ]
+
+
+def assert_same_ingestion(test_case, path, expected_path):
+    """
+    Check that the artifacts written by `ingest` into `path` match those
+    written into `expected_path`.
+    """
+    test_case.assertEqual(
+        d2v.dictionary.read_dictionary(os.path.join(path, 'dictionary.txt')),
+        d2v.dictionary.read_dictionary(
+            os.path.join(expected_path, 'dictionary.txt'))
+    )
+    for name in ['graph.npz', 'pairs.npz', 'expanded-graph.npz']:
+        found = scipy.sparse.load_npz(os.path.join(path, name))
+        expected = scipy.sparse.load_npz(os.path.join(expected_path, name))
+        test_case.assertEqual(found.shape, expected.shape)
+        test_case.assertTrue(np.array_equal(
+            found.todense(), expected.todense()))
+    test_case.assertTrue(np.array_equal(
+        np.load(os.path.join(path, 'counts.npy')),
+        np.load(os.path.join(expected_path, 'counts.npy'))
+    ))
+    found, expected = [
+        list(d2v.pairlist.read_binary_pairlist(os.path.join(p, 'pairs.bin')))
+        for p in (path, expected_path)
+    ]
+    if any(c is not None and c.dtype.kind == 'f' for _, _, c in expected):
+        # Weighted counts are floats, so compare them as written.
+        test_case.assertEqual(len(found), len(expected))
+        for found_block, expected_block in zip(found, expected):
+            for found_array, expected_array in zip(
+                found_block, expected_block
+            ):
+                test_case.assertTrue(
+                    np.array_equal(found_array, expected_array))
+        return
+    test_case.assertEqual(
+        list(d2v.pairlist.iter_block_pairs(found)),
+        list(d2v.pairlist.iter_block_pairs(expected))
+    )
+
+
 def ensure_dir(path):
     """
     Make sure that path is an empty directory.  
@@ -0,0 +1,70 @@
+import re
+import functools
+
+
+class WhitespaceTokenizer:
+    """
+    Lowercases a string and splits it on whitespace.  This is the default
+    behavior of `d2v.d2v_id.as_list`.
+    """
+    def __call__(self, string):
+        return string.lower().split()
+
+
+class RegexTokenizer:
+    """
+    Tokenizes a string by finding every match of a compiled regular
+    expression, by default runs of word characters, so that punctuation is
+    stripped.  The whole string is lowercased once, before matching, rather
+    than token by token.
+
+    Inputs
+     - pattern - str - regular expression matching a single token.
+     - lowercase - bool - whether to lowercase strings before matching.
+    """
+    def __init__(self, pattern=r'\w+', lowercase=True):
+        self.pattern = re.compile(pattern)
+        self.lowercase = lowercase
+
+    def __call__(self, string):
+        if self.lowercase:
+            string = string.lower()
+        return self.pattern.findall(string)
+
+
+class CachedTokenizer:
+    """
+    Wraps a `tokenizer`, remembering the tokens of the `maxsize` most
+    recently used strings.  This pays off for fields whose values repeat
+    often, like categories.  Tokens are returned as tuples, so that cached
+    results can't be modified.
+    """
+    def __init__(self, tokenizer, maxsize=2**16):
+        self.tokenizer = tokenizer
+        self.maxsize = maxsize
+        self.tokenize = functools.lru_cache(maxsize)(
+            lambda string: tuple(tokenizer(string)))
+
+    def __call__(self, string):
+        return self.tokenize(string)
+
+    def __getstate__(self):
+        # The cache can't be pickled; it is rebuilt when unpickling.
+        return {'tokenizer': self.tokenizer, 'maxsize': self.maxsize}
+
+    def __setstate__(self, state):
+        self.__init__(state['tokenizer'], state['maxsize'])
+
+
+def get_tokenizer(tokenizers, obj_type, field):
+    """
+    Get the tokenizer that applies to strings in `field` of objects of type
+    `obj_type`.  `tokenizers` is either None (meaning the default,
+    `WhitespaceTokenizer`), a single tokenizer used for every field, or a
+    dict mapping (type, field) namespaces to tokenizers.  In a dict, the key
+    None gives the tokenizer for namespaces not listed.  A tokenizer is any
+    callable taking a string and returning its tokens.
+    """
+    if isinstance(tokenizers, dict):
+        return tokenizers.get((obj_type, field), tokenizers.get(None))
+    return tokenizers
@@ -0,0 +1,258 @@
+"""
+Train embeddings by skip-gram with negative sampling (SGNS) on the pair
+counts written by `d2v.ingestion.ingest`:
+
+    python -m d2v.trainer path/to/model --num-pairs 10000000 --seed 0
+
+Training pairs are sampled in proportion to their counts, so that every
+cooccurrence counted during ingestion is, in expectation, one training
+example.  Updates are vectorized over minibatches of thousands of pairs.  The
+embeddings are saved in the model directory as 'embeddings.npy', with one row
+per id in the dictionary.
+"""
+import os
+import time
+import argparse
+import numpy as np
+import scipy.sparse
+import d2v
+
+
+class SGNSTrainer:
+    """
+    Learns an embedding for each id from a symmetric pair count matrix, by
+    skip-gram with negative sampling.
+
+    Each step samples `batch_size` pairs (i, j) with probability proportional
+    to their counts, each in a random order, since pairs are unordered.  For
+    each pair, `negatives` ids are drawn from the unigram distribution of the
+    pairs (the row sums of the matrix) raised to `power`.  The embedding of i
+    is then moved towards the context vector of j, and away from those of the
+    negative ids, by gathering the rows involved, computing their dot
+    products and sigmoids for the whole batch at once, and scatter-adding the
+    gradients back.  Rows are float32.
+
+    Inputs
+     - pairs_adjacency - scipy.sparse matrix - symmetric pair counts, like
+        the 'pairs.npz' written by `d2v.ingestion.ingest`.  Counts may be
+        weighted (floats).
+     - dimensions - int - the length of each embedding.
+     - negatives - int - the number of negative samples per pair.
+     - batch_size - int - the number of pairs per step.
+     - learning_rate - float - the learning rate at the start of each call
+        to `train`.  It decays linearly to `min_learning_rate` at the end.
+        The updates to an id within a batch add up, so a vocabulary much
+        smaller than `batch_size` needs a smaller learning rate.
+     - min_learning_rate - float - the learning rate at the end of `train`.
+     - power - float - exponent applied to unigram counts when drawing
+        negative samples.
+     - seed - int or None - seed for initialization and sampling.  Training
+        with the same seed and arguments gives the same embeddings.
+     - store - object or None - if given, holds the embeddings in place of
+        a dense array, through its `lookup(ids)` and `add(ids, updates)`
+        methods, like `d2v.gilbert.HeadTailEmbeddings`.
+     - context_store - object or None - if given, holds the context vectors
+        in place of a dense array of zeros, like `store`.  Without it, the
+        context vectors take a dense num_ids x `dimensions` float32 array
+        during training, so `store` alone only saves the memory of the
+        embeddings, which are what is kept for serving.
+    """
+    def __init__(
+        self, pairs_adjacency, dimensions=100, negatives=5, batch_size=4096,
+        learning_rate=0.025, min_learning_rate=0.0001, power=0.75, seed=None,
+        store=None, context_store=None
+    ):
+        self.dimensions = dimensions
+        self.negatives = negatives
+        self.batch_size = batch_size
+        self.learning_rate = learning_rate
+        self.min_learning_rate = min_learning_rate
+        self.rng = np.random.default_rng(seed)
+
+        pairs_adjacency = scipy.sparse.csr_matrix(pairs_adjacency)
+        upper = scipy.sparse.triu(pairs_adjacency).tocoo()
+        if upper.nnz == 0:
+            raise ValueError('There are no pairs to train on.')
+        self.I = upper.row.astype(np.int64)
+        self.J = upper.col.astype(np.int64)
+        self.pair_cumulative = np.cumsum(upper.data, dtype=np.float64)
+        unigrams = np.asarray(pairs_adjacency.sum(axis=1)).ravel()
+        self.negative_cumulative = np.cumsum(
+            np.power(unigrams, power, dtype=np.float64))
+
+        num_ids = pairs_adjacency.shape[0]
+        self.store = store
+        if store is None:
+            self.embeddings = (
+                (self.rng.random((num_ids, dimensions), dtype=np.float32)
+                    - 0.5)
+                / dimensions
+            )
+        else:
+            self.embeddings = None
+        self.context_store = context_store
+        if context_store is None:
+            self.context = np.zeros((num_ids, dimensions), dtype=np.float32)
+        else:
+            self.context = None
+
+    def sample_pairs(self, size):
+        """Sample `size` pairs `(I, J)`, in proportion to their counts."""
+        indices = np.searchsorted(
+            self.pair_cumulative,
+            self.rng.random(size) * self.pair_cumulative[-1], side='right'
+        )
+        I, J = self.I[indices], self.J[indices]
+        swap = self.rng.random(size) < 0.5
+        return np.where(swap, J, I), np.where(swap, I, J)
+
+    def sample_negatives(self, shape):
+        """Sample an array of negative ids of the given `shape`."""
+        return np.searchsorted(
+            self.negative_cumulative,
+            self.rng.random(shape) * self.negative_cumulative[-1],
+            side='right'
+        )
+
+    def step(self, I, J, learning_rate):
+        """
+        Update the embeddings of the ids `I` and the context vectors of the
+        ids `J` and of negative samples, for one batch of pairs.  Returns the
+        batch's mean loss.
+        """
+        N = self.sample_negatives((len(I), self.negatives))
+        if self.store is None:
+            embeddings = self.embeddings[I]
+        else:
+            embeddings = self.store.lookup(I)
+        if self.context_store is None:
+            positive = self.context[J]
+            negative = self.context[N]
+        else:
+            positive = self.context_store.lookup(J)
+            negative = self.context_store.lookup(N.ravel()).reshape(
+                N.shape + (self.dimensions,))
+
+        positive_scores = sigmoid(np.einsum('bd,bd->b', embeddings, positive))
+        negative_scores = sigmoid(
+            np.einsum('bd,bkd->bk', embeddings, negative))
+        loss = -(
+            np.log(positive_scores + 1e-7).sum()
+            + np.log(1 - negative_scores + 1e-7).sum()
+        ) / len(I)
+
+        # Gradient ascent on log(sigmoid(e . p)) + sum(log(sigmoid(-e . n))).
+        positive_gradients = (learning_rate * (1 - positive_scores))[:, None]
+        negative_gradients = (-learning_rate * negative_scores)[:, :, None]
+        embedding_updates = positive_gradients * positive + np.einsum(
+            'bkx,bkd->bd', negative_gradients, negative)
+        context_updates = np.concatenate([
+            positive_gradients * embeddings,
+            (negative_gradients * embeddings[:, None, :]).reshape(
+                -1, self.dimensions)
+        ])
+        context_ids = np.concatenate([J, N.ravel()])
+        if self.context_store is None:
+            scatter_add(self.context, context_ids, context_updates)
+        else:
+            self.context_store.add(context_ids, context_updates)
+        if self.store is None:
+            scatter_add(self.embeddings, I, embedding_updates)
+        else:
+            self.store.add(I, embedding_updates)
+        return float(loss)
+
+    def train(self, num_pairs, stats=None):
+        """
+        Train on `num_pairs` sampled pairs, in batches of `batch_size`.
+        Returns the mean loss over the last batches (about 1% of training).
+        If `stats` is given, stats['train'] is set to a dict reporting the
+        number of 'pairs' and 'steps', the 'seconds' elapsed,
+        'pairs_per_second', and the final 'loss'.
+        """
+        if num_pairs < 1:
+            raise ValueError('num_pairs must be positive.')
+        num_steps = -(-num_pairs // self.batch_size)
+        recent = max(1, num_steps // 100)
+        losses = []
+        start = time.perf_counter()
+        for step in range(num_steps):
+            size = min(self.batch_size, num_pairs - step * self.batch_size)
+            learning_rate = self.learning_rate - (
+                self.learning_rate - self.min_learning_rate
+            ) * step / num_steps
+            I, J = self.sample_pairs(size)
+            losses.append(self.step(I, J, learning_rate))
+        seconds = time.perf_counter() - start
+        loss = float(np.mean(losses[-recent:]))
+        if stats is not None:
+            stats['train'] = {
+                'pairs': num_pairs,
+                'steps': num_steps,
+                'seconds': seconds,
+                'pairs_per_second': num_pairs / seconds,
+                'loss': loss,
+            }
+        return loss
+
+
+def sigmoid(x):
+    return 1 / (1 + np.exp(-np.clip(x, -30, 30)))
+
+
+def scatter_add(target, indices, values):
+    """
+    Add each row of `values` to the row of `target` given by `indices`,
+    accumulating repeated indices, like `np.add.at(target, indices, values)`.
+    The rows are summed per index by multiplying `values` by a sparse 0/1
+    matrix, which is several times faster than `np.add.at` for whole rows.
+    """
+    unique_indices, inverse = np.unique(indices, return_inverse=True)
+    summing = scipy.sparse.csr_matrix(
+        (
+            np.ones(len(indices), dtype=values.dtype),
+            (inverse, np.arange(len(indices)))
+        ),
+        shape=(len(unique_indices), len(indices))
+    )
+    target[unique_indices] += summing @ values
+
+
+def train_model(path, num_pairs, stats=None, **kwargs):
+    """
+    Train embeddings on the pairs of the model directory `path` (see
+    `d2v.model.Model`), with an `SGNSTrainer` taking the keyword arguments
+    `kwargs`, on `num_pairs` sampled pairs.  Returns the trainer.
+    """
+    with d2v.model.Model(path) as model:
+        trainer = SGNSTrainer(model.pairs, **kwargs)
+    trainer.train(num_pairs, stats=stats)
+    return trainer
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('path', help='model directory holding pairs')
+    parser.add_argument('--num-pairs', type=int, default=10**6)
+    parser.add_argument('--dimensions', type=int, default=100)
+    parser.add_argument('--negatives', type=int, default=5)
+    parser.add_argument('--batch-size', type=int, default=4096)
+    parser.add_argument('--learning-rate', type=float, default=0.025)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    stats = {}
+    trainer = train_model(
+        args.path, args.num_pairs, dimensions=args.dimensions,
+        negatives=args.negatives, batch_size=args.batch_size,
+        learning_rate=args.learning_rate, seed=args.seed, stats=stats
+    )
+    np.save(os.path.join(args.path, 'embeddings.npy'), trainer.embeddings)
+    print('{} pairs in {:.3f} s: {:.0f} pairs/s, loss {:.4f}'.format(
+        stats['train']['pairs'], stats['train']['seconds'],
+        stats['train']['pairs_per_second'], stats['train']['loss']
+    ))
+
+
+if __name__ == '__main__':
+    main()